@@ -20,6 +20,7 @@ from chromite.buildbot import cbuildbot_config
 from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.buildbot import constants
 from chromite.buildbot import portage_utilities
+from chromite.lib import chroot_server
 from chromite.lib import cros_build_lib
 from chromite.lib import gclient
 from chromite.lib import git
@@ -509,17 +510,27 @@ def GenerateStackTraces(buildroot, board, gzipped_test_tarball,
                             debug_level=logging.DEBUG, error_code_ok=True)
   symbol_dir = os.path.join('/build', board, 'usr', 'lib', 'debug', 'breakpad')
   board_path = os.path.join('/build', board)
+  dump_files = []
   for curr_dir, _subdirs, files in os.walk(temp_dir):
     for curr_file in files:
+      # Skip crash files that were purposely generated or if
+      # breakpad symbols are absent.
+      if curr_file.endswith('.dmp') and (
+          not got_symbols or curr_file.find('crasher_nobreakpad') == 0):
+        continue
+      dump_files.append((curr_dir, curr_file))
+
+  with cros_build_lib.ContextManagerStack() as stack:
+    # Enter the chroot once for all of the files, rather than once per file,
+    # but only if there are any.
+    if dump_files:
+      stack.Add(chroot_server.ChrootServer, buildroot)
+    for curr_dir, curr_file in dump_files:
       full_file_path = os.path.join(curr_dir, curr_file)
       processed_file_path = '%s.txt' % full_file_path
 
       # Distinguish whether the current file is a minidump or asan_log.
       if curr_file.endswith('.dmp'):
-        # Skip crash files that were purposely generated or if
-        # breakpad symbols are absent.
-        if not got_symbols or curr_file.find('crasher_nobreakpad') == 0:
-          continue
         # Precess the minidump from within chroot.
         minidump = git.ReinterpretPathForChroot(full_file_path)
         cwd = os.path.join(buildroot, 'src', 'scripts')
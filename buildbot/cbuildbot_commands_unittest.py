@@ -13,6 +13,7 @@ import constants
 sys.path.insert(0, constants.SOURCE_ROOT)
 from chromite.buildbot import cbuildbot_commands as commands
 from chromite.buildbot import cbuildbot_results as results_lib
+from chromite.lib import chroot_server
 from chromite.lib import cros_build_lib_unittest
 from chromite.lib import cros_test_lib
 from chromite.lib import git
@@ -140,6 +141,7 @@ class CBuildBotTest(cros_build_lib_unittest.RunCommandTempDirTestCase):
     osutils.Touch(tarfile)
     dump_file_dir, dump_file_name = os.path.split(dump_file)
     ret = [(dump_file_dir, [''], [dump_file_name])]
+    server = self.PatchObject(chroot_server, 'ChrootServer')
     with mock.patch('os.walk', return_value=ret):
       gzipped_test_tarball = os.path.join(self.tempdir, 'test_results.tgz')
       commands.GenerateStackTraces(self._buildroot, self._board,
@@ -147,9 +149,23 @@ class CBuildBotTest(cros_build_lib_unittest.RunCommandTempDirTestCase):
       self.assertCommandContains([gzipped_test_tarball])
       self.assertCommandContains(['tar', 'xf', tarfile, '*.dmp'])
       self.assertCommandContains(['minidump_stackwalk'])
+      server.assert_called_once_with(self._buildroot)
       self.assertCommandContains(['tar', 'uf', tarfile])
       self.assertFalse(os.path.exists(tarfile))
 
+  def testGenerateStackTracesNoDumps(self):
+    """Test that no chroot server is started if there are no dumps."""
+    os.makedirs(os.path.join(self._chroot, 'tmp'))
+    osutils.Touch(os.path.join(self.tempdir, 'test_results.tar'))
+    server = self.PatchObject(chroot_server, 'ChrootServer')
+    with mock.patch('os.walk', return_value=[]):
+      gzipped_test_tarball = os.path.join(self.tempdir, 'test_results.tgz')
+      self.assertEqual(
+          commands.GenerateStackTraces(self._buildroot, self._board,
+                                       gzipped_test_tarball, self.tempdir,
+                                       True), [])
+      self.assertFalse(server.called)
+
   def testUprevAllPackages(self):
     """Test if we get None in revisions.pfq indicating Full Builds."""
     commands.UprevPackages(self._buildroot, [self._board], self._overlays)
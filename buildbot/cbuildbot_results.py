@@ -4,6 +4,7 @@
 
 """Classes for collecting results of our BuildStages as they run."""
 
+import collections
 import datetime
 import math
 import os
@@ -98,6 +99,13 @@ class PackageBuildFailure(BuildScriptFailure):
             % (self.shortname, ' '.join(sorted(self.failed_packages))))
 
 
+# The resources used by a parallel step or task. Times are in seconds, and
+# max_rss is in kilobytes. user_time, sys_time and max_rss are None if they
+# couldn't be measured (e.g. for steps run in threads).
+StepUsage = collections.namedtuple(
+    'StepUsage', ['name', 'wall_time', 'user_time', 'sys_time', 'max_rss'])
+
+
 class RecordedTraceback(object):
   """This class represents a traceback recorded in the list of results."""
 
@@ -132,6 +140,10 @@ class _Results(object):
     # names to previous records.
     self._previous = {}
 
+    # List of StepUsage objects for the parallel steps and tasks that have
+    # finished.
+    self._usage_log = []
+
   def Clear(self):
     """Clear existing stage results."""
     self.__init__()
@@ -206,6 +218,22 @@ class _Results(object):
     """
     return self._results_log
 
+  def RecordUsage(self, usage):
+    """Store off the resources used by a parallel step or task.
+
+       Args:
+         usage: A StepUsage object.
+    """
+    self._usage_log.append(usage)
+
+  def GetUsage(self):
+    """Fetch the resources used by parallel steps and tasks.
+
+       Returns:
+         A list of StepUsage objects, in the order the steps finished.
+    """
+    return self._usage_log
+
   def GetPrevious(self):
     """Fetch stage results.
 
@@ -306,4 +334,31 @@ class _Results(object):
         out.write(x.traceback)
         out.write('\n')
 
+  def ReportUsage(self, out, limit=20):
+    """Report the parallel steps and tasks that took the longest.
+
+    Args:
+      out: The file object to write the report to.
+      limit: The most steps and tasks to report.
+    """
+    if not self._usage_log:
+      return
+
+    line = '*' * 60 + '\n'
+    edge = '*' * 2
+
+    out.write(line)
+    out.write(edge + ' Slowest Parallel Steps\n')
+    out.write(line)
+    usage_log = sorted(self._usage_log, key=lambda x: x.wall_time,
+                       reverse=True)
+    for usage in usage_log[:limit]:
+      timestr = datetime.timedelta(seconds=math.ceil(usage.wall_time))
+      details = ''
+      if usage.user_time is not None:
+        details = ' (user %.1fs, sys %.1fs, max rss %d MiB)' % (
+            usage.user_time, usage.sys_time, usage.max_rss / 1024)
+      out.write('%s %s %s%s\n' % (edge, timestr, usage.name, details))
+    out.write(line)
+
 Results = _Results()
@@ -2046,7 +2046,7 @@ class ArchiveStage(BoardSpecificBuilderStage):
       success = False
       try:
         with bg_task_runner(UploadArtifact, queue=hw_test_upload_queue,
-                            processes=num_upload_processes):
+                            processes=num_upload_processes, adaptive=True):
           steps = [ArchiveAutotestTarballs, ArchivePayloads]
           parallel.RunParallelSteps(steps)
         success = True
@@ -2083,7 +2083,7 @@ class ArchiveStage(BoardSpecificBuilderStage):
 
     def ArchiveReleaseArtifacts(num_upload_processes=10):
       with bg_task_runner(UploadArtifact, queue=release_upload_queue,
-                          processes=num_upload_processes):
+                          processes=num_upload_processes, adaptive=True):
         steps = [ArchiveDebugSymbols, BuildAndArchiveAllImages,
                  ArchiveFirmwareImages]
         parallel.RunParallelSteps(steps)
@@ -2101,7 +2101,7 @@ class ArchiveStage(BoardSpecificBuilderStage):
       with bg_task_runner(UploadSymbols, queue=upload_symbols_queue,
                           processes=1):
         with bg_task_runner(UploadArtifact, queue=upload_queue,
-                            processes=num_upload_processes):
+                            processes=num_upload_processes, adaptive=True):
           parallel.RunParallelSteps(steps)
 
     def MarkAsLatest():
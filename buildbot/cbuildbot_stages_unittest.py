@@ -1584,6 +1584,30 @@ class BuildStagesResultsTest(cros_test_lib.TestCase):
       self.assertEqual(expectedLines[i], actualLines[i])
     self.assertEqual(len(expectedLines), len(actualLines))
 
+  def testStagesReportUsage(self):
+    """Tests reporting the slowest parallel steps."""
+    results_lib.Results.Clear()
+    usage = StringIO.StringIO()
+    results_lib.Results.ReportUsage(usage)
+    self.assertEqual(usage.getvalue(), '')
+
+    results_lib.Results.RecordUsage(
+        results_lib.StepUsage('Fast', 1, 0.5, 0.25, 2048))
+    results_lib.Results.RecordUsage(
+        results_lib.StepUsage('Slow', 61, None, None, None))
+    results_lib.Results.RecordUsage(
+        results_lib.StepUsage('Medium', 2, 1.0, 0.0, 1024))
+    results_lib.Results.ReportUsage(usage, limit=2)
+
+    expectedResults = (
+        "************************************************************\n"
+        "** Slowest Parallel Steps\n"
+        "************************************************************\n"
+        "** 0:01:01 Slow\n"
+        "** 0:00:02 Medium (user 1.0s, sys 0.0s, max rss 1 MiB)\n"
+        "************************************************************\n")
+    self.assertEqual(usage.getvalue(), expectedResults)
+
   def testSaveCompletedStages(self):
     """Tests that we can save out completed stages."""
 
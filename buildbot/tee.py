@@ -4,20 +4,30 @@
 
 """Module that handles tee-ing output to a file."""
 
+import distutils.version
 import errno
 import fcntl
+import glob
+import gzip
 import os
 import multiprocessing
+import re
 import select
 import signal
 import subprocess
 import sys
+import time
 import traceback
 from chromite.lib import cros_build_lib
 
 
-# Max amount of data we're hold in the buffer at a given time.
-_BUFSIZE = 1024
+# Max amount of data we read from the pipe at a time. Whatever is in the pipe
+# is read at once, rather than line by line, so that chatty builds don't cost
+# a write per line to every output.
+_BUFSIZE = 64 * 1024
+
+# How often to make the data written to compressed logs readable, in seconds.
+_FLUSH_INTERVAL = 5
 
 # Custom signal handlers so we can catch the exception and handle
 # it.
@@ -34,28 +44,123 @@ def _TeeProcessSignalHandler(signum, frame):
   This is used to decide whether or not to kill our parent."""
   raise ToldToDie(signum)
 
-def _output(line, output_files, complain):
-  """Print line to output_files.
+def BackupLog(log_file, backup_limit=25):
+  """Rename a log out of the way, keeping at most backup_limit old logs.
+
+  The log is renamed to log_file.N, where N is one more than the newest of the
+  old logs.
+
+  Args:
+    log_file: The absolute path to the log.
+    backup_limit: The most old logs to keep.
+  """
+  if os.path.exists(log_file):
+    old_logs = sorted(glob.glob(log_file + '.*'),
+                      key=distutils.version.LooseVersion)
+
+    if len(old_logs) >= backup_limit:
+      os.remove(old_logs[0])
+
+    last = 0
+    if old_logs:
+      last = int(old_logs.pop().rpartition('.')[2])
+
+    os.rename(log_file, log_file + '.' + str(last + 1))
+
+
+class _CompressedLog(object):
+  """A gzipped log, which is started afresh whenever it gets too big.
+
+  The log is flushed every _FLUSH_INTERVAL seconds, so that everything but the
+  last few seconds of it can be read with zcat while it is being written.
+
+  When the log gets too big, it is renamed to a part: for log.gz, the parts are
+  log.part1.gz, log.part2.gz and so on. Parts are numbered after any left by
+  earlier runs, and are never removed, so they don't disturb the backups of
+  earlier logs made by BackupLog.
+  """
+
+  def __init__(self, path, rotate_size=None):
+    """Initialize.
+
+    Args:
+      path: The path of the log.
+      rotate_size: When the compressed log reaches this many bytes, rename it
+        to the next part and start a new one.
+    """
+    self._path = path
+    self._rotate_size = rotate_size
+    self._raw = self._file = None
+    self._last_flush = 0
+    self._part = self._GetLastPart()
+    self._Open()
+
+  def _GetPartPath(self, part):
+    """Return the path of the given part of the log."""
+    stem, ext = os.path.splitext(self._path)
+    return '%s.part%d%s' % (stem, part, ext)
+
+  def _GetLastPart(self):
+    """Return the number of the newest existing part of the log, or 0."""
+    stem, ext = os.path.splitext(self._path)
+    pattern = re.compile(r'%s\.part(\d+)%s$' % (re.escape(stem),
+                                                re.escape(ext)))
+    parts = [0]
+    for path in glob.glob('%s.part*%s' % (stem, ext)):
+      m = pattern.match(path)
+      if m:
+        parts.append(int(m.group(1)))
+    return max(parts)
+
+  def _Open(self):
+    self._raw = open(self._path, 'wb')
+    self._file = gzip.GzipFile(os.path.basename(self._path), 'wb',
+                               fileobj=self._raw)
+    self._last_flush = time.time()
+
+  def Write(self, data):
+    """Append data to the log."""
+    self._file.write(data)
+    if time.time() - self._last_flush >= _FLUSH_INTERVAL:
+      self.Flush()
+      if self._rotate_size and self._raw.tell() >= self._rotate_size:
+        self.Close()
+        self._part += 1
+        os.rename(self._path, self._GetPartPath(self._part))
+        self._Open()
+
+  def Flush(self):
+    """Make everything written so far readable."""
+    self._file.flush()
+    self._last_flush = time.time()
+
+  def Close(self):
+    self._file.close()
+    self._raw.close()
+
+
+def _output(data, output_files, complain):
+  """Print data to output_files.
 
   Args:
-    line: Line to print.
+    data: Data to print.
     output_files: List of files to print to.
     complain: Print a warning if we get EAGAIN errors. Only one error
-              is printed per line.
+              is printed per chunk of data.
   """
   for f in output_files:
     offset = 0
-    while offset < len(line):
+    while offset < len(data):
       select.select([], [f], [])
       try:
-        offset += os.write(f.fileno(), line[offset:])
+        offset += os.write(f.fileno(), data[offset:])
       except OSError as ex:
         if ex.errno == errno.EINTR:
           continue
         elif ex.errno != errno.EAGAIN:
           raise
 
-      if offset < len(line) and complain:
+      if offset < len(data) and complain:
         flags = fcntl.fcntl(f.fileno(), fcntl.F_GETFL, 0)
         if flags & os.O_NONBLOCK:
           warning = '\nWarning: %s/%d is non-blocking.\n' % (f.name,
@@ -67,17 +172,43 @@ def _output(line, output_files, complain):
         _output(warning, output_files, False)
 
 
-def _tee(input_file, output_files, complain):
-  """Read lines from input_file and write to output_files."""
-  for line in iter(lambda: input_file.readline(_BUFSIZE), ''):
-    _output(line, output_files, complain)
+def _tee(input_file, output_files, complain, logs=()):
+  """Read data from input_file as it arrives and write to output_files.
+
+  Args:
+    input_file: The file to read from.
+    output_files: List of files to print to.
+    complain: Print a warning if we get EAGAIN errors.
+    logs: List of _CompressedLog objects to write to as well. They are
+      flushed whenever no data has arrived for _FLUSH_INTERVAL seconds.
+  """
+  fd = input_file.fileno()
+  pending = False
+  while True:
+    try:
+      if pending and not select.select([fd], [], [], _FLUSH_INTERVAL)[0]:
+        for log in logs:
+          log.Flush()
+        pending = False
+        continue
+      data = os.read(fd, _BUFSIZE)
+    except (OSError, select.error) as ex:
+      if ex.args[0] == errno.EINTR:
+        continue
+      raise
+    if not data:
+      break
+    _output(data, output_files, complain)
+    for log in logs:
+      log.Write(data)
+    pending = bool(logs)
 
 
 class _TeeProcess(multiprocessing.Process):
   """Replicate output to multiple file handles."""
 
   def __init__(self, output_filenames, complain, error_fd,
-               master_pid):
+               master_pid, compress=False, rotate_size=None):
     """Write to stdout and supplied filenames.
 
     Args:
@@ -86,11 +217,16 @@ class _TeeProcess(multiprocessing.Process):
       error: The fd to write exceptions/errors to during
         shutdown.
       master_pid: Pid to SIGTERM if we shutdown uncleanly.
+      compress: Gzip the files; see _CompressedLog.
+      rotate_size: With compress, start new files when they reach this many
+        bytes; see _CompressedLog.
     """
 
     self._reader_pipe, self.writer_pipe = os.pipe()
     self._output_filenames = output_filenames
     self._complain = complain
+    self._compress = compress
+    self._rotate_size = rotate_size
     # Dupe the fd on the offchance it's stdout/stderr,
     # which we screw with.
     self._error_handle = os.fdopen(os.dup(error_fd), 'w', 0)
@@ -113,6 +249,7 @@ class _TeeProcess(multiprocessing.Process):
     """Main function for tee subprocess."""
 
     failed = True
+    logs = []
     try:
       signal.signal(signal.SIGINT, _TeeProcessSignalHandler)
       signal.signal(signal.SIGTERM, _TeeProcessSignalHandler)
@@ -126,10 +263,13 @@ class _TeeProcess(multiprocessing.Process):
       # Create list of files to write to.
       output_files = [os.fdopen(sys.stdout.fileno(), 'w', 0)]
       for filename in self._output_filenames:
-        output_files.append(open(filename, 'w', 0))
+        if self._compress:
+          logs.append(_CompressedLog(filename, self._rotate_size))
+        else:
+          output_files.append(open(filename, 'w', 0))
 
-      # Read all lines from input_file and write to output_files.
-      _tee(input_file, output_files, self._complain)
+      # Read everything from input_file and write to output_files.
+      _tee(input_file, output_files, self._complain, logs)
       failed = False
     except ToldToDie:
       failed = False
@@ -145,6 +285,13 @@ class _TeeProcess(multiprocessing.Process):
       # Close input file.
       input_file.close()
 
+      # Finish the compressed logs, so that they can be read to the end.
+      for log in logs:
+        try:
+          log.Close()
+        except Exception, e:
+          self._error_handle.write("\nTee failed closing log: %s\n" % e)
+
       if failed:
         try:
           os.kill(self.master_pid, signal.SIGTERM)
@@ -161,10 +308,19 @@ class _TeeProcess(multiprocessing.Process):
 
 class Tee(cros_build_lib.MasterPidContextManager):
   """Class that handles tee-ing output to a file."""
-  def __init__(self, output_file):
-    """Initializes object with path to log file."""
+  def __init__(self, output_file, compress=False, rotate_size=None):
+    """Initializes object with path to log file.
+
+    Args:
+      output_file: The path of the log.
+      compress: Gzip the log as it is written.
+      rotate_size: With compress, whenever the log reaches this many bytes,
+        start a new one; see _CompressedLog.
+    """
     cros_build_lib.MasterPidContextManager.__init__(self)
     self._file = output_file
+    self._compress = compress
+    self._rotate_size = rotate_size
     self._old_stdout = None
     self._old_stderr = None
     self._old_stdout_fd = None
@@ -188,7 +344,8 @@ class Tee(cros_build_lib.MasterPidContextManager):
 
     # Create a tee subprocess.
     self._tee = _TeeProcess([self._file], True, self._old_stderr_fd,
-                            os.getpid())
+                            os.getpid(), compress=self._compress,
+                            rotate_size=self._rotate_size)
     self._tee.start()
 
     # Redirect stdout and stderr to the tee subprocess.
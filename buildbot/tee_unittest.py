@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unit tests for tee.py."""
+
+import gzip
+import os
+import sys
+
+import constants
+if __name__ == '__main__':
+  sys.path.insert(0, constants.SOURCE_ROOT)
+
+from chromite.buildbot import tee
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+
+# pylint: disable=W0212
+
+
+class TeeTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for the tee module."""
+
+  def testTee(self):
+    """Verify everything written to the input reaches every output."""
+    reader, writer = os.pipe()
+    data = ''.join('line %d\n' % x for x in xrange(20000))
+    paths = [os.path.join(self.tempdir, x) for x in ('a', 'b')]
+    outputs = [open(x, 'w', 0) for x in paths]
+    pid = os.fork()
+    if pid == 0:
+      os.close(reader)
+      # Write partial lines too.
+      for i in xrange(0, len(data), 1000):
+        os.write(writer, data[i:i + 1000])
+      os._exit(0)
+    os.close(writer)
+    with os.fdopen(reader, 'r', 0) as input_file:
+      tee._tee(input_file, outputs, True)
+    os.waitpid(pid, 0)
+    for f, path in zip(outputs, paths):
+      f.close()
+      self.assertEqual(osutils.ReadFile(path), data)
+
+  def testTeeContext(self):
+    """Verify Tee copies stdout and stderr of us and our children."""
+    path = os.path.join(self.tempdir, 'log')
+    with tee.Tee(path):
+      print 'stdout'
+      sys.stdout.flush()
+      cros_build_lib.RunCommand(['sh', '-c', 'echo child; echo err >&2'],
+                                print_cmd=False)
+    self.assertEqual(osutils.ReadFile(path), 'stdout\nchild\nerr\n')
+
+  def testCompressedLog(self):
+    """Verify compressed logs can be read while written, and are rotated."""
+    self.PatchObject(tee, '_FLUSH_INTERVAL', 0)
+    path = os.path.join(self.tempdir, 'log.gz')
+    log = tee._CompressedLog(path, rotate_size=100)
+    log.Write('first\n')
+    self.assertEqual(gzip.open(path).read(6), 'first\n')
+
+    data = os.urandom(200)
+    log.Write(data)
+    log.Write('last\n')
+    log.Close()
+    self.assertEqual(gzip.open(os.path.join(self.tempdir, 'log.part1.gz'))
+                     .read(), 'first\n' + data)
+    self.assertEqual(gzip.open(path).read(), 'last\n')
+
+  def testRotateManyParts(self):
+    """Verify rotation keeps every part, and the backups of older logs."""
+    self.PatchObject(tee, '_FLUSH_INTERVAL', 0)
+    path = os.path.join(self.tempdir, 'log.gz')
+    backups = [path + '.%d' % x for x in xrange(1, 26)]
+    old_part = os.path.join(self.tempdir, 'log.part1.gz')
+    for x in backups + [old_part]:
+      osutils.WriteFile(x, 'old')
+
+    log = tee._CompressedLog(path, rotate_size=100)
+    chunks = [os.urandom(200) for _ in xrange(30)]
+    for chunk in chunks:
+      log.Write(chunk)
+    log.Close()
+
+    for x in backups + [old_part]:
+      self.assertEqual(osutils.ReadFile(x), 'old')
+    for i, chunk in enumerate(chunks):
+      part = os.path.join(self.tempdir, 'log.part%d.gz' % (i + 2))
+      self.assertEqual(gzip.open(part).read(), chunk)
+    self.assertEqual(gzip.open(path).read(), '')
+
+  def testTeeCompressed(self):
+    """Verify Tee can write a compressed log."""
+    path = os.path.join(self.tempdir, 'log.gz')
+    with tee.Tee(path, compress=True):
+      cros_build_lib.RunCommand(['echo', 'child'], print_cmd=False)
+    self.assertEqual(gzip.open(path).read(), 'child\n')
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -36,6 +36,9 @@ class SDKFetcher(object):
 
   TARBALL_CACHE = 'tarballs'
   MISC_CACHE = 'misc'
+  # The least recently used SDKs are evicted from the tarball cache when it
+  # grows past this many bytes.
+  TARBALL_CACHE_SIZE = 20 * 1024 ** 3
 
   TARGET_TOOLCHAIN_KEY = 'target_toolchain'
 
@@ -49,7 +52,8 @@ class SDKFetcher(object):
     self.gs_ctx = gs.GSContext.Cached(cache_dir, init_boto=True)
     self.cache_base = os.path.join(cache_dir, COMMAND_NAME)
     self.tarball_cache = cache.TarballCache(
-        os.path.join(self.cache_base, self.TARBALL_CACHE))
+        os.path.join(self.cache_base, self.TARBALL_CACHE),
+        max_size=self.TARBALL_CACHE_SIZE)
     self.misc_cache = cache.DiskCache(
         os.path.join(self.cache_base, self.MISC_CACHE))
     self.board = board
@@ -60,13 +64,13 @@ class SDKFetcher(object):
     config = cbuildbot_config.FindCanonicalConfigForBoard(board)
     return '%s/%s' % (constants.DEFAULT_ARCHIVE_BUCKET, config['name'])
 
-  def _UpdateTarball(self, url, ref):
-    """Worker function to fetch tarballs"""
-    with osutils.TempDirContextManager(
-        base_dir=self.tarball_cache.staging_dir) as tempdir:
-      local_path = os.path.join(tempdir, os.path.basename(url))
-      self.gs_ctx.Copy(url, tempdir)
-      ref.SetDefault(local_path, lock=True)
+  def _UpdateTarball(self, url, _tempdir):
+    """Worker function to fetch tarballs.
+
+    The tarball is streamed straight into the cache, which extracts it as it
+    is downloaded.
+    """
+    return self.gs_ctx.Open(url)
 
   def _GetMetadata(self, version):
     """Return metadata (in the form of a dict) for a given version."""
@@ -162,7 +166,6 @@ class SDKFetcher(object):
       version = self.GetDefaultVersion()
     components = list(components)
 
-    key_map = {}
     fetch_urls = {}
     version_base = os.path.join(self.gs_base, version)
 
@@ -176,19 +179,13 @@ class SDKFetcher(object):
       components.remove(self.TARGET_TOOLCHAIN_KEY)
 
     fetch_urls.update((t, os.path.join(version_base, t)) for t in components)
+    urls = dict(((self.board, version, key), url)
+                for key, url in fetch_urls.iteritems())
+    refs = self.tarball_cache.ParallelSetDefault(
+        urls, lambda cache_key, tempdir: self._UpdateTarball(urls[cache_key],
+                                                             tempdir))
+    key_map = dict((cache_key[2], ref) for cache_key, ref in refs.iteritems())
     try:
-      for key, url in fetch_urls.iteritems():
-        cache_key = (self.board, version, key)
-        ref = self.tarball_cache.Lookup(cache_key)
-        key_map[key] = ref
-        ref.Acquire()
-        if not ref.Exists(lock=True):
-          # TODO(rcui): Parallelize this.  Requires acquiring locks *before*
-          # generating worker processes; therefore the functionality needs to
-          # be moved into the DiskCache class itself -
-          # i.e.,DiskCache.ParallelSetDefault().
-          self._UpdateTarball(url, ref)
-
       yield self.SDKContext(version, key_map)
     finally:
       # TODO(rcui): Move to using cros_build_lib.ContextManagerStack()
@@ -7,9 +7,9 @@
 """This module tests the cros image command."""
 
 import copy
+import cStringIO
 import mock
 import os
-import shutil
 import sys
 
 sys.path.insert(0, os.path.abspath('%s/../../..' % os.path.dirname(__file__)))
@@ -43,12 +43,9 @@ class ParserTest(cros_test_lib.MockTempDirTestCase):
       self.assertEquals(bootstrap.inst.options.cache_dir, self.tempdir)
 
 
-def _GSCopyMock(_self, path, dest):
-  """Used to simulate a GS Copy operation."""
-  with osutils.TempDirContextManager() as tempdir:
-    local_path = os.path.join(tempdir, os.path.basename(path))
-    osutils.Touch(local_path)
-    shutil.move(local_path, dest)
+def _GSOpenMock(_self, _path):
+  """Used to simulate a GS Open operation."""
+  return cStringIO.StringIO()
 
 
 def _DependencyMockCtx(f):
@@ -114,6 +111,14 @@ class SDKFetcherMock(partial_mock.PartialMock):
     self.entered = False
     self.gs_mock = gs_unittest.GSContextMock()
     self.gs_mock.SetDefaultCmdResult()
+    # Tarballs are extracted by the cache after _UpdateTarball returns.
+    self.untar_patcher = mock.patch.object(cache, 'Untar')
+
+  def PreStart(self):
+    self.untar_patcher.start()
+
+  def PreStop(self):
+    self.untar_patcher.stop()
 
   @_DependencyMockCtx
   def _target__init__(self, inst, *args, **kwargs):
@@ -132,10 +137,9 @@ class SDKFetcherMock(partial_mock.PartialMock):
 
   @_DependencyMockCtx
   def _UpdateTarball(self, inst, *args, **kwargs):
-    with mock.patch.object(gs.GSContext, 'Copy', autospec=True,
-                           side_effect=_GSCopyMock):
-      with mock.patch.object(cache, 'Untar'):
-        return self.backup['_UpdateTarball'](inst, *args, **kwargs)
+    with mock.patch.object(gs.GSContext, 'Open', autospec=True,
+                           side_effect=_GSOpenMock):
+      return self.backup['_UpdateTarball'](inst, *args, **kwargs)
 
   @_DependencyMockCtx
   def _GetMetadata(self, inst, *args, **kwargs):
@@ -4,16 +4,32 @@
 
 """Contains on-disk caching functionality."""
 
+import collections
+import contextlib
+import json
 import logging
 import os
 import shutil
+import threading
+import time
+import urllib2
 
 from chromite.lib import cros_build_lib
 from chromite.lib import locking
 from chromite.lib import osutils
+from chromite.lib import parallel
 
 # pylint: disable=W0212
 
+# How many bytes of a tarball to read from its source at a time.
+_STREAM_BUFSIZE = 1024 * 1024
+
+# The number of CacheReferences acquired by this process, by key path.  Locks
+# are per-process, so the cache must not touch the locks of these keys when
+# looking for entries to evict: closing any lock file in use by this process
+# would drop the locks that this process holds on it.
+_acquired_paths = collections.Counter()
+
 def EntryLock(f):
   """Decorator that provides monitor access control."""
   def new_f(self, *args, **kwargs):
@@ -84,6 +100,7 @@ class CacheReference(object):
           'Attempting to acquire an already acquired reference.')
 
     self.acquired = True
+    _acquired_paths[self.path] += 1
     self._lock.__enter__()
 
   def Release(self):
@@ -93,7 +110,11 @@ class CacheReference(object):
           'Attempting to release an unacquired reference.')
 
     self.acquired = False
+    self.read_locked = False
     self._lock.__exit__(None, None, None)
+    _acquired_paths[self.path] -= 1
+    if not _acquired_paths[self.path]:
+      del _acquired_paths[self.path]
 
   def __enter__(self):
     self.Acquire()
@@ -105,6 +126,7 @@ class CacheReference(object):
   def _ReadLock(self):
     self._lock.read_lock()
     self.read_locked = True
+    self._cache._Touch(self.key)
 
   @WriteLock
   def _Assign(self, path):
@@ -169,6 +191,7 @@ class CacheReference(object):
   def Unlock(self):
     """Release read lock on the reference."""
     self._lock.unlock()
+    self.read_locked = False
 
 
 class DiskCache(object):
@@ -177,14 +200,27 @@ class DiskCache(object):
   Key entries can be files or directories.  Access to the cache is provided
   through CacheReferences, which are retrieved by using the cache Lookup()
   method.
+
+  The cache keeps an index of the size of each entry, and when it was last
+  read-locked.  If the cache has a max_size, the least recently used entries
+  are evicted whenever an insert takes the cache over it.  Entries that are
+  locked are never evicted.
   """
-  # TODO(rcui): Add LRU cleanup functionality.
 
   _STAGING_DIR = 'staging'
+  _INDEX = 'index.json'
+
+  def __init__(self, cache_dir, max_size=None):
+    """Initialize.
 
-  def __init__(self, cache_dir):
+    Arguments:
+      cache_dir: The directory to store the cache in.
+      max_size: If set, the most bytes the entries of the cache should take.
+    """
     self._cache_dir = cache_dir
     self.staging_dir = os.path.join(cache_dir, self._STAGING_DIR)
+    self.max_size = max_size
+    self._index_path = os.path.join(cache_dir, self._INDEX)
 
     osutils.SafeMakedirs(self._cache_dir)
     osutils.SafeMakedirs(self.staging_dir)
@@ -207,12 +243,83 @@ class DiskCache(object):
   def _TempDirContext(self):
     return osutils.TempDirContextManager(base_dir=self.staging_dir)
 
+  @contextlib.contextmanager
+  def _IndexContext(self):
+    """Lock the index of the cache, and yield it for modification.
+
+    The index maps the path of each entry to a dict of its key, its size and
+    its last access time.  Entries inserted before the cache had an index are
+    missing from it, and so are never evicted.
+    """
+    with locking.FileLock(self._index_path + '.lock', verbose=False) as lock:
+      lock.write_lock()
+      index = {}
+      if os.path.exists(self._index_path):
+        try:
+          index = json.loads(osutils.ReadFile(self._index_path))
+        except ValueError:
+          logging.warning('Discarding corrupt cache index %s',
+                          self._index_path)
+      yield index
+      osutils.WriteFile(self._index_path, json.dumps(index), atomic=True)
+
+  def _Touch(self, key):
+    """Record that a key has been accessed."""
+    with self._IndexContext() as index:
+      entry = index.get(self._GetKeyPath(key))
+      if entry is not None:
+        entry['atime'] = time.time()
+
+  def GetSize(self):
+    """Returns the number of bytes taken by the entries of the cache."""
+    with self._IndexContext() as index:
+      return sum(x['size'] for x in index.itervalues())
+
+  def _Evict(self, max_size):
+    """Evict the least recently used entries until the cache fits max_size.
+
+    Entries that are locked, by this or any other process, are skipped.
+    """
+    with self._IndexContext() as index:
+      total = sum(x['size'] for x in index.itervalues())
+      for path, entry in sorted(index.items(), key=lambda x: x[1]['atime']):
+        if total <= max_size:
+          break
+        if path in _acquired_paths:
+          continue
+        ref = CacheReference(self, tuple(entry['key']))
+        try:
+          with ref._entry_lock:
+            ref._entry_lock.write_lock(blocking=False)
+            with ref._lock:
+              ref._lock.write_lock(blocking=False)
+              logging.debug('Evicting %s from the cache.', path)
+              self._RemoveEntry(ref.key)
+        except locking.LockNotAcquiredError:
+          continue
+        total -= entry['size']
+        del index[path]
+
   def _Insert(self, key, path):
     """Insert a file or a directory into the cache at a given key."""
     self._Remove(key)
     key_path = self._GetKeyPath(key)
     osutils.SafeMakedirs(os.path.dirname(key_path))
     shutil.move(path, key_path)
+    with self._IndexContext() as index:
+      index[key_path] = {'key': key, 'size': _GetSize(key_path),
+                         'atime': time.time()}
+    if self.max_size is not None:
+      self._Evict(self.max_size)
+
+  def _PrepareEntry(self, path, _tempdir):
+    """Turn a fetched path into the path to insert into the cache.
+
+    Subclasses that transform what they are given before inserting it do so
+    here.  The result may be written to tempdir, a directory in the staging
+    area.
+    """
+    return path
 
   def _InsertText(self, key, text):
     """Inserts a file containing |text| into the cache."""
@@ -221,33 +328,248 @@ class DiskCache(object):
       osutils.WriteFile(file_path, text)
       self._Insert(key, file_path)
 
-  def _Remove(self, key):
-    """Remove a key from the cache."""
+  def _RemoveEntry(self, key):
+    """Remove a key from the cache, without updating the index."""
     if self._KeyExists(key):
       with self._TempDirContext() as tempdir:
         shutil.move(self._GetKeyPath(key), tempdir)
 
+  def _Remove(self, key):
+    """Remove a key from the cache."""
+    self._RemoveEntry(key)
+    with self._IndexContext() as index:
+      index.pop(self._GetKeyPath(key), None)
+
   def Lookup(self, key):
     """Get a reference to a given key."""
     return CacheReference(self, key)
 
+  def ParallelSetDefault(self, keys, fetch, processes=None):
+    """Ensure that a set of keys exist, fetching the missing ones in parallel.
+
+    The locks of all of the keys are taken up front, in sorted order so that
+    processes preparing overlapping sets of keys can't deadlock.  The missing
+    entries are then fetched in a pool of processes, and each one is inserted
+    into the cache as soon as it has been fetched.
 
-def Untar(path, cwd, sudo=False):
-  """Untar a tarball."""
+    Arguments:
+      keys: The keys to ensure exist.
+      fetch: Function called as fetch(key, tempdir) in a background process
+        for each missing key.  It should fetch the default value of the key
+        into tempdir, a directory in the staging area, and return its path.
+      processes: The most entries to fetch at once.
+
+    Returns:
+      A dict of acquired and read-locked CacheReferences, by key.  The caller
+      must release them.
+    """
+    refs = {}
+    missing = []
+    success = False
+    try:
+      for key in sorted(set(keys)):
+        ref = refs[key] = self.Lookup(key)
+        ref.Acquire()
+        ref._entry_lock.__enter__()
+        try:
+          ref._entry_lock.write_lock()
+          if ref._Exists():
+            ref._ReadLock()
+          else:
+            ref._lock.write_lock()
+            missing.append(ref)
+        finally:
+          if ref not in missing:
+            ref._entry_lock.__exit__(None, None, None)
+
+      if missing:
+        with self._TempDirContext() as tempdir:
+          inputs = []
+          for i, ref in enumerate(missing):
+            key_dir = os.path.join(tempdir, str(i))
+            os.mkdir(key_dir)
+            inputs.append([ref.key, key_dir])
+
+          def _Fetch(key, key_dir):
+            return key, self._PrepareEntry(fetch(key, key_dir), key_dir)
+
+          for key, path in parallel.IterTasksInProcessPool(
+              _Fetch, inputs, processes=processes, ordered=False):
+            ref = refs[key]
+            # The entry is already prepared, so bypass any _Insert override.
+            DiskCache._Insert(self, key, path)
+            ref._ReadLock()
+            missing.remove(ref)
+            ref._entry_lock.__exit__(None, None, None)
+      success = True
+    finally:
+      if not success:
+        for ref in missing:
+          ref._entry_lock.__exit__(None, None, None)
+        for ref in refs.itervalues():
+          if ref.acquired:
+            ref.Release()
+
+    return refs
+
+
+def _GetSize(path):
+  """Returns the number of bytes taken by a file or directory."""
+  size = os.lstat(path).st_size
+  for root, dirs, files in os.walk(path):
+    for name in dirs + files:
+      size += os.lstat(os.path.join(root, name)).st_size
+  return size
+
+
+# The magic numbers that start the output of each compressor.
+_COMPRESSION_MAGIC = (
+    ('\x1f\x8b', cros_build_lib.COMP_GZIP),
+    ('BZh', cros_build_lib.COMP_BZIP2),
+    ('\xfd7zXZ\x00', cros_build_lib.COMP_XZ),
+)
+
+
+def _GetCompression(head):
+  """Detect the compression of a tarball from its first bytes."""
+  for magic, compression in _COMPRESSION_MAGIC:
+    if head.startswith(magic):
+      return compression
+  return cros_build_lib.COMP_NONE
+
+
+def _GetUntarCommand(compression):
+  """Returns the tar command to extract a tarball with a given compression."""
+  cmd = ['tar']
+  if compression != cros_build_lib.COMP_NONE:
+    cmd += ['-I', cros_build_lib.FindCompressor(compression)]
+  return cmd + ['-xpf']
+
+
+def _PumpTarball(source, head, fd, keep_path, read_errors):
+  """Copy a tarball from source into fd, and optionally into keep_path.
+
+  Arguments:
+    source: The file object to read the tarball from.
+    head: The data already read from source.
+    fd: The file descriptor to write the tarball to.
+    keep_path: If set, the path to also write the tarball to.
+    read_errors: A list that errors reading source are appended to.  If
+      writing to fd fails, the command reading it has exited, and the rest
+      of the tarball is only written to keep_path.
+  """
+  dest = os.fdopen(fd, 'wb')
+  keep = open(keep_path, 'wb') if keep_path else None
+  try:
+    data = head
+    while data:
+      if keep is not None:
+        keep.write(data)
+      if dest is not None:
+        try:
+          dest.write(data)
+        except IOError:
+          dest.close()
+          dest = None
+          if keep is None:
+            break
+      try:
+        data = source.read(_STREAM_BUFSIZE)
+      except Exception as e:
+        read_errors.append(e)
+        break
+  finally:
+    if keep is not None:
+      keep.close()
+    if dest is not None:
+      try:
+        dest.close()
+      except IOError:
+        pass
+
+
+def Untar(source, cwd, sudo=False, compression=None, keep_path=None):
+  """Untar a tarball.
+
+  The tarball is decompressed by a parallel decompressor where one is
+  installed.  Tarballs that aren't local files are extracted as they are
+  read, so they never need to be stored on disk.
+
+  Arguments:
+    source: The path of the tarball, an http:// or https:// URL, or a file
+      object to read it from.  File objects are closed once they are read.
+    cwd: The directory to extract the tarball into.
+    sudo: Whether to run tar with sudo.
+    compression: The compression of the tarball, one of
+      cros_build_lib.COMP_*.  If unset, it is detected from the tarball.
+    keep_path: If set, the tarball is also written to this path as it is
+      read.
+  """
   functor = cros_build_lib.SudoRunCommand if sudo else cros_build_lib.RunCommand
-  functor(['tar', '-xpf', path], cwd=cwd, debug_level=logging.DEBUG)
+  if isinstance(source, basestring):
+    if source.startswith(('http://', 'https://')):
+      source = urllib2.urlopen(source)
+    elif keep_path is None:
+      # Let tar read local tarballs itself.
+      if compression is None:
+        with open(source, 'rb') as f:
+          compression = _GetCompression(f.read(16))
+      functor(_GetUntarCommand(compression) + [source], cwd=cwd,
+              debug_level=logging.DEBUG)
+      return
+    else:
+      source = open(source, 'rb')
+
+  try:
+    head = source.read(_STREAM_BUFSIZE)
+    if compression is None:
+      compression = _GetCompression(head)
+
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, 'rb')
+    read_errors = []
+    pump = threading.Thread(
+        target=_PumpTarball,
+        args=(source, head, write_fd, keep_path, read_errors))
+    pump.daemon = True
+    pump.start()
+    try:
+      functor(_GetUntarCommand(compression) + ['-'], cwd=cwd, input=reader,
+              debug_level=logging.DEBUG)
+    finally:
+      reader.close()
+      pump.join()
+      # A failure to read the tarball is the cause of any failure of tar.
+      if read_errors:
+        raise read_errors[0]
+  finally:
+    source.close()
 
 
 class TarballCache(DiskCache):
   """Supports caching of extracted tarball contents."""
 
-  def __init__(self, cache_dir):
-    DiskCache.__init__(self, cache_dir)
+  def __init__(self, cache_dir, max_size=None):
+    DiskCache.__init__(self, cache_dir, max_size=max_size)
 
-  def _Insert(self, key, tarball_path):
-    """Insert a tarball and its extracted contents into the cache."""
-    with osutils.TempDirContextManager(base_dir=self.staging_dir) as tempdir:
-      extract_path = os.path.join(tempdir, 'extract')
-      os.mkdir(extract_path)
-      Untar(tarball_path, extract_path)
-      DiskCache._Insert(self, key, extract_path)
+  def _PrepareEntry(self, tarball, tempdir):
+    """Extract a tarball into tempdir.
+
+    Arguments:
+      tarball: The path or URL of the tarball, or a file object to stream it
+        from.  See Untar.
+      tempdir: A directory in the staging area.
+    """
+    extract_path = os.path.join(tempdir, 'extract')
+    os.mkdir(extract_path)
+    Untar(tarball, extract_path)
+    return extract_path
+
+  def _Insert(self, key, tarball):
+    """Insert the extracted contents of a tarball into the cache.
+
+    The tarball can be anything _PrepareEntry accepts, so tarballs can be
+    streamed into the cache without being downloaded first.
+    """
+    with self._TempDirContext() as tempdir:
+      DiskCache._Insert(self, key, self._PrepareEntry(tarball, tempdir))
@@ -0,0 +1,250 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the cache.py module."""
+
+import contextlib
+import cStringIO
+import mock
+import os
+import sys
+import tarfile
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import cache
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+from chromite.lib import parallel
+
+# pylint: disable=W0212
+
+
+class DiskCacheTest(cros_test_lib.TempDirTestCase):
+  """Tests for the size index and eviction of DiskCache."""
+
+  def setUp(self):
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+    self.cache = cache.DiskCache(self.cache_dir, max_size=2500)
+
+  def _Insert(self, name, size=1000):
+    with self.cache.Lookup((name,)) as ref:
+      ref.AssignText('x' * size)
+
+  def _Keys(self):
+    return sorted(x for x in ('a', 'b', 'c', 'd')
+                  if self.cache.Lookup((x,))._Exists())
+
+  def testSize(self):
+    """Verify the index tracks the size of files and directories."""
+    self.cache.max_size = None
+    self._Insert('a', 100)
+    self.assertEqual(self.cache.GetSize(), 100)
+
+    path = os.path.join(self.tempdir, 'dir')
+    osutils.WriteFile(os.path.join(path, 'sub', 'file'), 'x' * 50,
+                      makedirs=True)
+    with self.cache.Lookup(('b',)) as ref:
+      ref.Assign(path)
+    self.assertTrue(self.cache.GetSize() > 150)
+
+    with self.cache.Lookup(('b',)) as ref:
+      ref.Remove(('b',))
+    self.assertEqual(self.cache.GetSize(), 100)
+
+  def testEvictLeastRecentlyUsed(self):
+    """Verify the least recently used entries are evicted first."""
+    self._Insert('a')
+    self._Insert('b')
+    # Using 'a' makes 'b' the least recently used.
+    with self.cache.Lookup(('a',)) as ref:
+      self.assertTrue(ref.Exists(lock=True))
+    self._Insert('c')
+    self.assertEqual(self._Keys(), ['a', 'c'])
+    self.assertEqual(self.cache.GetSize(), 2000)
+
+  def testEvictSkipsLocked(self):
+    """Verify entries locked by this or other processes aren't evicted."""
+    self._Insert('a')
+    self._Insert('b')
+    ref = self.cache.Lookup(('a',))
+    ref.Acquire()
+    self.assertTrue(ref.Exists(lock=True))
+
+    # Hold a read lock on 'b' from another process.
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      try:
+        os.close(writer)
+        other = cache.DiskCache(self.cache_dir).Lookup(('b',))
+        other.Acquire()
+        other.Exists(lock=True)
+        os.read(reader, 1)
+      finally:
+        os._exit(0)
+    os.close(reader)
+    try:
+      # Wait for the child to lock 'b'.
+      while not self._LockedElsewhere('b'):
+        pass
+      self._Insert('c')
+      self._Insert('d')
+      # Nothing could be evicted except 'c'.
+      self.assertEqual(self._Keys(), ['a', 'b', 'd'])
+    finally:
+      os.close(writer)
+      os.waitpid(pid, 0)
+      ref.Release()
+
+    self._Insert('c')
+    self.assertEqual(self._Keys(), ['c', 'd'])
+
+  def _LockedElsewhere(self, name):
+    """Returns whether another process holds the lock of an entry."""
+    lock = self.cache._LockForKey((name,))
+    try:
+      lock.write_lock(blocking=False)
+      return False
+    except cache.locking.LockNotAcquiredError:
+      return True
+    finally:
+      lock.close()
+
+
+class ParallelSetDefaultTest(cros_test_lib.TempDirTestCase):
+  """Tests for DiskCache.ParallelSetDefault."""
+
+  def setUp(self):
+    self.cache = cache.DiskCache(os.path.join(self.tempdir, 'cache'))
+    self.fetched = os.path.join(self.tempdir, 'fetched')
+    os.mkdir(self.fetched)
+
+  def _Fetch(self, key, tempdir):
+    """Fetch the default of a key, recording that it was fetched."""
+    osutils.Touch(os.path.join(self.fetched, key[0]))
+    path = os.path.join(tempdir, 'value')
+    osutils.WriteFile(path, 'fetched %s' % key[0])
+    return path
+
+  def _Release(self, refs):
+    for ref in refs.itervalues():
+      ref.Release()
+
+  def testFetchMissing(self):
+    """Verify only missing keys are fetched, and all are read-locked."""
+    with self.cache.Lookup(('a',)) as ref:
+      ref.AssignText('cached a')
+
+    refs = self.cache.ParallelSetDefault([('a',), ('b',), ('c',), ('b',)],
+                                         self._Fetch)
+    try:
+      self.assertEqual(sorted(refs), [('a',), ('b',), ('c',)])
+      self.assertEqual(sorted(os.listdir(self.fetched)), ['b', 'c'])
+      self.assertEqual(osutils.ReadFile(refs[('a',)].path), 'cached a')
+      self.assertEqual(osutils.ReadFile(refs[('c',)].path), 'fetched c')
+      for ref in refs.itervalues():
+        self.assertTrue(ref.acquired)
+        self.assertTrue(ref.read_locked)
+    finally:
+      self._Release(refs)
+    self.assertEqual(os.listdir(self.cache.staging_dir), [])
+
+  def testFetchFailure(self):
+    """Verify all locks are released if fetching fails."""
+    def _Fetch(key, tempdir):
+      if key == ('b',):
+        raise ValueError('fetch failed')
+      return self._Fetch(key, tempdir)
+
+    self.assertRaises(parallel.BackgroundFailure,
+                      self.cache.ParallelSetDefault, [('a',), ('b',)], _Fetch)
+    self.assertFalse(cache._acquired_paths)
+    self.assertFalse(self.cache.Lookup(('b',))._Exists())
+    # The locks can be taken again.
+    refs = self.cache.ParallelSetDefault([('a',), ('b',)], self._Fetch)
+    self._Release(refs)
+
+  def testTarballCache(self):
+    """Verify fetched tarballs are extracted."""
+    tarball_cache = cache.TarballCache(os.path.join(self.tempdir, 'tarballs'))
+    def _Fetch(_key, tempdir):
+      path = os.path.join(tempdir, 'file')
+      osutils.WriteFile(path, 'contents')
+      tarball = os.path.join(tempdir, 'file.tar')
+      with contextlib.closing(tarfile.open(tarball, 'w')) as tar:
+        tar.add(path, arcname='file')
+      return tarball
+
+    refs = tarball_cache.ParallelSetDefault([('a',)], _Fetch)
+    try:
+      self.assertEqual(
+          osutils.ReadFile(os.path.join(refs[('a',)].path, 'file')),
+          'contents')
+    finally:
+      self._Release(refs)
+
+
+class UntarTest(cros_test_lib.TempDirTestCase):
+  """Tests for extracting tarballs, including streamed ones."""
+
+  def setUp(self):
+    src = os.path.join(self.tempdir, 'src')
+    osutils.WriteFile(os.path.join(src, 'dir', 'file'), 'contents',
+                      makedirs=True)
+    self.tarball = os.path.join(self.tempdir, 'src.tar.gz')
+    with contextlib.closing(tarfile.open(self.tarball, 'w:gz')) as tar:
+      tar.add(os.path.join(src, 'dir'), arcname='dir')
+    self.dest = os.path.join(self.tempdir, 'dest')
+    os.mkdir(self.dest)
+
+  def _AssertExtracted(self, path=None):
+    path = path or self.dest
+    self.assertEqual(osutils.ReadFile(os.path.join(path, 'dir', 'file')),
+                     'contents')
+
+  def testPath(self):
+    """Verify local tarballs are extracted."""
+    cache.Untar(self.tarball, self.dest)
+    self._AssertExtracted()
+
+  def testStream(self):
+    """Verify tarballs are extracted from file objects as they are read."""
+    keep_path = os.path.join(self.tempdir, 'kept.tar.gz')
+    source = open(self.tarball, 'rb')
+    cache.Untar(source, self.dest, keep_path=keep_path)
+    self._AssertExtracted()
+    self.assertTrue(source.closed)
+    self.assertEqual(osutils.ReadFile(keep_path),
+                     osutils.ReadFile(self.tarball))
+
+  def testStreamCompression(self):
+    """Verify the compression of streams is detected, or can be given."""
+    data = osutils.ReadFile(self.tarball)
+    cache.Untar(cStringIO.StringIO(data), self.dest)
+    self._AssertExtracted()
+
+    self.assertRaises(cros_build_lib.RunCommandError, cache.Untar,
+                      cStringIO.StringIO(data), self.dest,
+                      compression=cros_build_lib.COMP_BZIP2)
+
+  def testReadError(self):
+    """Verify errors reading the tarball are raised."""
+    source = mock.Mock(name='source')
+    source.name = self.tarball
+    source.read.side_effect = IOError('connection reset')
+    self.assertRaises(IOError, cache.Untar, source, self.dest)
+    self.assertTrue(source.close.called)
+
+  def testInsertStream(self):
+    """Verify a TarballCache can insert a streamed tarball."""
+    tarball_cache = cache.TarballCache(os.path.join(self.tempdir, 'cache'))
+    with tarball_cache.Lookup(('a',)) as ref:
+      ref.SetDefault(open(self.tarball, 'rb'))
+      self._AssertExtracted(ref.path)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
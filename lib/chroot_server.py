@@ -0,0 +1,321 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Run commands in the chroot without entering it for each command.
+
+Every RunCommand(enter_chroot=True) normally runs the command through a fresh
+cros_sdk, which checks the mounts of the chroot and runs sudo each time. A
+ChrootServer instead enters the chroot once, and starts a server inside it
+that runs commands sent to it over a unix socket in the chroot's /tmp. While
+the server is running, RunCommand sends it the commands it would otherwise
+run with cros_sdk:
+
+  with chroot_server.ChrootServer(buildroot):
+    for dump in dumps:
+      cros_build_lib.RunCommand(['minidump_stackwalk', dump], enter_chroot=True)
+
+Like cros_sdk, commands run in the environment of the chroot plus extra_env,
+and in the chroot's copy of cwd. Their output is sent back once they exit,
+rather than as it is written.
+"""
+
+import errno
+import getpass
+import json
+import os
+import signal
+import socket
+import struct
+import subprocess
+import threading
+import time
+
+from chromite.buildbot import constants
+from chromite.lib import cros_build_lib
+from chromite.lib import osutils
+
+# The header of every message: the length of its JSON part.
+_LENGTH = struct.Struct('!I')
+
+# The longest path a unix socket can be bound to or connected to.
+_MAX_SOCKET_PATH = 107
+
+# The directory cros_sdk runs commands in if cwd is outside the source tree.
+_DEFAULT_CWD = 'trunk/src/scripts'
+
+
+class ChrootServerError(Exception):
+  """Raised when the chroot server can't be used."""
+
+
+class ChrootServerUnavailable(ChrootServerError):
+  """Raised when the chroot server can't be reached to send it a command."""
+
+
+def _RecvAll(sock, length):
+  """Read exactly length bytes from sock."""
+  chunks = []
+  while length:
+    data = sock.recv(min(length, 1024 * 1024))
+    if not data:
+      raise ChrootServerError('Connection closed unexpectedly')
+    chunks.append(data)
+    length -= len(data)
+  return ''.join(chunks)
+
+
+def _SendMessage(sock, header, *payloads):
+  """Send header, a JSON-able dict, followed by some strings."""
+  header = dict(header, payloads=[len(x) for x in payloads])
+  data = json.dumps(header)
+  sock.sendall(_LENGTH.pack(len(data)) + data + ''.join(payloads))
+
+
+def _RecvMessage(sock):
+  """Receive a message sent by _SendMessage.
+
+  Returns:
+    A tuple of the header and the list of payloads.
+  """
+  length, = _LENGTH.unpack(_RecvAll(sock, _LENGTH.size))
+  header = json.loads(_RecvAll(sock, length))
+  return header, [_RecvAll(sock, x) for x in header.pop('payloads')]
+
+
+def _KillOnDisconnect(conn, proc, done):
+  """Kill proc if the client that asked for it goes away before it exits."""
+  try:
+    conn.recv(1)
+  except socket.error:
+    pass
+  if not done.is_set() and proc.poll() is None:
+    try:
+      os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+      pass
+
+
+def _HandleRequest(conn, header, stdin):
+  """Run the command requested in header, and send back the result."""
+  env = os.environ.copy()
+  env.update(header['extra_env'] or {})
+  cwd = header['cwd'] or os.path.join(os.path.expanduser('~'), _DEFAULT_CWD)
+  try:
+    proc = subprocess.Popen(
+        header['cmd'], cwd=cwd, env=env, close_fds=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+        stderr=(subprocess.STDOUT if header['combine_stdout_stderr'] else
+                subprocess.PIPE),
+        preexec_fn=os.setsid)
+  except OSError as e:
+    _SendMessage(conn, {'errno': e.errno, 'error': e.strerror})
+    return
+
+  done = threading.Event()
+  watcher = threading.Thread(target=_KillOnDisconnect, args=(conn, proc, done))
+  watcher.daemon = True
+  watcher.start()
+  output, error = proc.communicate(stdin)
+  done.set()
+  _SendMessage(conn, {'returncode': proc.returncode}, output, error or '')
+
+
+def Serve(path):
+  """Run commands sent to the unix socket at path, until told to stop.
+
+  This runs inside the chroot. Each command runs in its own thread, so a
+  client can run any number of commands at once.
+  """
+  osutils.SafeUnlink(path)
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(077)
+  try:
+    listener.bind(path)
+  finally:
+    os.umask(old_umask)
+  try:
+    listener.listen(64)
+    while True:
+      try:
+        conn, _ = listener.accept()
+      except socket.error as e:
+        if e.errno == errno.EINTR:
+          continue
+        raise
+      # Read requests here, so that a shutdown request stops us at once.
+      try:
+        header, payloads = _RecvMessage(conn)
+      except (ChrootServerError, socket.error, ValueError):
+        conn.close()
+        continue
+      if header.get('shutdown'):
+        conn.close()
+        break
+      thread = threading.Thread(target=_ServeRequest,
+                                args=(conn, header, payloads))
+      thread.daemon = True
+      thread.start()
+  finally:
+    listener.close()
+    os.unlink(path)
+
+
+def _ServeRequest(conn, header, payloads):
+  """Handle a request that has already been read from conn."""
+  try:
+    _HandleRequest(conn, header, *payloads)
+  except (ChrootServerError, socket.error):
+    pass
+  finally:
+    conn.close()
+
+
+class ChrootServer(object):
+  """Start a server in the chroot, and run commands with it.
+
+  Used as a context manager, the server is started and RunCommand uses it
+  until the context exits. If the server can't be started, a warning is
+  printed and RunCommand carries on using cros_sdk.
+  """
+
+  def __init__(self, buildroot, start_timeout=120):
+    """Initialize.
+
+    Args:
+      buildroot: The source tree whose chroot to run commands in.
+      start_timeout: How many seconds to wait for the server to start.
+    """
+    self._buildroot = os.path.realpath(buildroot)
+    self._start_timeout = start_timeout
+    name = 'cros_chroot_server.%d.sock' % os.getpid()
+    self._path = os.path.join(self._buildroot, constants.DEFAULT_CHROOT_DIR,
+                              'tmp', name)
+    self._chroot_path = os.path.join('/tmp', name)
+    self._handle = None
+    self._pid = None
+
+  def GetChrootPath(self, path):
+    """Returns the path in the chroot of a path in the source tree.
+
+    Returns None if path is outside of the source tree.
+    """
+    relpath = os.path.relpath(os.path.realpath(path), self._buildroot)
+    if relpath == os.pardir or relpath.startswith(os.pardir + os.sep):
+      return None
+    user = os.getenv('USER') or getpass.getuser()
+    return os.path.normpath(os.path.join('/home', user, 'trunk', relpath))
+
+  def Start(self):
+    """Start the server, and wait for it to be ready.
+
+    Raises:
+      ChrootServerError if the server could not be started.
+    """
+    if len(self._path) > _MAX_SOCKET_PATH:
+      raise ChrootServerError('Path of socket is too long: %s' % self._path)
+
+    script = os.path.join(self._buildroot, constants.CHROMITE_BIN_SUBDIR,
+                          'cros_chroot_server')
+    cmd = [self.GetChrootPath(script), '--socket', self._chroot_path]
+    # Don't mistake the socket of an old server for ours.
+    osutils.SafeUnlink(self._path)
+    try:
+      self._handle = cros_build_lib.RunCommandAsync(
+          cmd, enter_chroot=True, cwd=self._buildroot, redirect_stdout=True,
+          combine_stdout_stderr=True, error_code_ok=True)
+    except cros_build_lib.RunCommandError as e:
+      raise ChrootServerError('Could not start the chroot server: %s' % e)
+    self._pid = os.getpid()
+
+    end = time.time() + self._start_timeout
+    while not os.path.exists(self._path):
+      if self._handle.poll() is not None or time.time() > end:
+        self._handle.cancel()
+        output = self._handle.result().output
+        self._handle = None
+        raise ChrootServerError(
+            'The chroot server did not start:\n%s' % (output,))
+      time.sleep(0.1)
+
+  def Stop(self):
+    """Stop the server, if this process started it."""
+    if self._handle is None or self._pid != os.getpid():
+      return
+    handle, self._handle = self._handle, None
+    try:
+      sock = self._Connect()
+      try:
+        _SendMessage(sock, {'shutdown': True})
+      finally:
+        sock.close()
+      handle.wait(timeout=10)
+    except (ChrootServerError, socket.error) as e:
+      cros_build_lib.Warning('Could not stop the chroot server: %s', e)
+    handle.cancel()
+
+  def _Connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(self._path)
+    except socket.error as e:
+      sock.close()
+      raise ChrootServerUnavailable(
+          'Could not connect to the chroot server: %s' % e)
+    return sock
+
+  def Run(self, cmd, cwd=None, extra_env=None, input=None,
+          combine_stdout_stderr=False):
+    """Run a command in the chroot.
+
+    If we're interrupted, closing the connection kills the command.
+
+    Args:
+      cmd: The command to run, as a list of arguments.
+      cwd: The directory to run the command in, outside the chroot. If it is
+        outside the source tree, src/scripts is used, like cros_sdk.
+      extra_env: Variables to add to the environment of the chroot.
+      input: The input of the command.
+      combine_stdout_stderr: Combine stderr into stdout.
+
+    Returns:
+      A tuple of the exit code, stdout and stderr of the command.
+
+    Raises:
+      OSError if the command could not be run.
+      ChrootServerUnavailable if the server could not be reached, in which
+        case the command was not run.
+      ChrootServerError if the server was lost while running the command.
+    """
+    # pylint: disable=W0622
+    request = {
+        'cmd': cmd,
+        'cwd': self.GetChrootPath(cwd or os.getcwd()),
+        'extra_env': extra_env,
+        'combine_stdout_stderr': combine_stdout_stderr,
+    }
+    sock = self._Connect()
+    try:
+      _SendMessage(sock, request, input or '')
+      header, payloads = _RecvMessage(sock)
+    except socket.error as e:
+      raise ChrootServerError('Lost the chroot server: %s' % e)
+    finally:
+      sock.close()
+    if 'errno' in header:
+      raise OSError(header['errno'], header['error'])
+    return (header['returncode'],) + tuple(payloads)
+
+  def __enter__(self):
+    try:
+      self.Start()
+    except ChrootServerError as e:
+      cros_build_lib.Warning('%s; entering the chroot for every command', e)
+    else:
+      cros_build_lib.SetChrootServer(self)
+    return self
+
+  def __exit__(self, _type, _value, _traceback):
+    if self._handle is not None and self._pid == os.getpid():
+      cros_build_lib.SetChrootServer(None)
+    self.Stop()
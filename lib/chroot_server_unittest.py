@@ -0,0 +1,170 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the chroot_server.py module."""
+
+import getpass
+import os
+import socket
+import sys
+import threading
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import chroot_server
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+
+
+class ChrootServerTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for running commands with a chroot server.
+
+  The server runs in a thread of the test, rather than in a chroot.
+  """
+
+  def setUp(self):
+    self.server = chroot_server.ChrootServer(self.tempdir)
+    # Commands run in the same directories as they would outside the chroot.
+    self.PatchObject(chroot_server.ChrootServer, 'GetChrootPath',
+                     side_effect=lambda path: path)
+    path = self.server._path  # pylint: disable=W0212
+    osutils.SafeMakedirs(os.path.dirname(path))
+    self.thread = threading.Thread(target=chroot_server.Serve, args=(path,))
+    self.thread.daemon = True
+    self.thread.start()
+    while not os.path.exists(path):
+      self.thread.join(0.01)
+
+  def tearDown(self):
+    # pylint: disable=W0212
+    cros_build_lib.SetChrootServer(None)
+    sock = self.server._Connect()
+    chroot_server._SendMessage(sock, {'shutdown': True})
+    sock.close()
+    self.thread.join(10)
+    self.assertFalse(self.thread.isAlive())
+    self.assertFalse(os.path.exists(self.server._path))
+
+  def testRun(self):
+    """Verify commands run with the given cwd, environment and input."""
+    self.assertEqual(
+        self.server.Run(['sh', '-c', 'echo $FOO; pwd; cat; echo err >&2'],
+                        cwd=self.tempdir, extra_env={'FOO': 'bar'},
+                        input='in\n'),
+        (0, 'bar\n%s\nin\n' % os.path.realpath(self.tempdir), 'err\n'))
+    self.assertEqual(
+        self.server.Run(['sh', '-c', 'echo out; echo err >&2; exit 3'],
+                        cwd=self.tempdir, combine_stdout_stderr=True),
+        (3, 'out\nerr\n', ''))
+    self.assertRaises(OSError, self.server.Run, ['/does/not/exist'],
+                      cwd=self.tempdir)
+
+  def testParallel(self):
+    """Verify the server runs commands at the same time."""
+    results = []
+    fifo = os.path.join(self.tempdir, 'fifo')
+    os.mkfifo(fifo)
+    reader = threading.Thread(target=lambda: results.append(
+        self.server.Run(['cat', fifo], cwd=self.tempdir)))
+    reader.start()
+    self.server.Run(['sh', '-c', 'echo hi > %s' % fifo], cwd=self.tempdir)
+    reader.join(10)
+    self.assertEqual(results, [(0, 'hi\n', '')])
+
+  def testRunCommand(self):
+    """Verify RunCommand uses the server for commands in the chroot."""
+    cros_build_lib.SetChrootServer(self.server)
+    result = cros_build_lib.RunCommand(
+        'echo $FOO; cat; echo err >&2', shell=True, enter_chroot=True,
+        cwd=self.tempdir, extra_env={'FOO': 'bar'}, input='in\n',
+        redirect_stdout=True, redirect_stderr=True)
+    self.assertEqual((result.returncode, result.output, result.error),
+                     (0, 'bar\nin\n', 'err\n'))
+
+    log = os.path.join(self.tempdir, 'log')
+    result = cros_build_lib.RunCommand(
+        ['sh', '-c', 'echo out; echo err >&2; exit 3'], enter_chroot=True,
+        cwd=self.tempdir, combine_stdout_stderr=True, error_code_ok=True,
+        log_stdout_to_file=log)
+    self.assertEqual(result.returncode, 3)
+    self.assertEqual(osutils.ReadFile(log), 'out\nerr\n')
+
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      cros_build_lib.RunCommand, ['sh', '-c', 'exit 1'],
+                      enter_chroot=True, cwd=self.tempdir)
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      cros_build_lib.RunCommand, ['/does/not/exist'],
+                      enter_chroot=True, cwd=self.tempdir)
+
+  def testServerUnavailable(self):
+    """Verify RunCommand falls back to cros_sdk if the server is gone."""
+    # pylint: disable=W0212
+    cros_build_lib.SetChrootServer(self.server)
+    self.PatchObject(chroot_server.ChrootServer, 'Run',
+                     side_effect=chroot_server.ChrootServerUnavailable('gone'))
+    build = self.PatchObject(cros_build_lib, '_BuildCommand',
+                             return_value=(['echo', 'fallback'], None))
+    result = cros_build_lib.RunCommand(['true'], enter_chroot=True,
+                                       cwd=self.tempdir, redirect_stdout=True)
+    self.assertEqual(result.output, 'fallback\n')
+    self.assertTrue(build.called)
+    self.assertEqual(cros_build_lib._chroot_server, None)
+
+  def testServerLost(self):
+    """Verify losing the server while a command runs is a RunCommandError."""
+    cros_build_lib.SetChrootServer(self.server)
+    self.PatchObject(chroot_server.ChrootServer, 'Run',
+                     side_effect=chroot_server.ChrootServerError('lost'))
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      cros_build_lib.RunCommand, ['true'], enter_chroot=True,
+                      cwd=self.tempdir, error_code_ok=True)
+
+  def testDisconnect(self):
+    """Verify commands are killed if the client goes away."""
+    pid_file = os.path.join(self.tempdir, 'pid')
+    sock = self.server._Connect()  # pylint: disable=W0212
+    chroot_server._SendMessage(  # pylint: disable=W0212
+        sock, {'cmd': ['sh', '-c', 'echo $$ > %s; exec sleep 60' % pid_file],
+               'cwd': self.tempdir, 'extra_env': None,
+               'combine_stdout_stderr': False}, '')
+    while not os.path.exists(pid_file) or not osutils.ReadFile(pid_file):
+      self.thread.join(0.01)
+    pid = int(osutils.ReadFile(pid_file))
+    sock.shutdown(socket.SHUT_RDWR)
+    sock.close()
+    for _ in xrange(1000):
+      try:
+        os.kill(pid, 0)
+      except OSError:
+        break
+      self.thread.join(0.01)
+    else:
+      self.fail('Command was not killed')
+
+
+class GetChrootPathTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for ChrootServer.GetChrootPath."""
+
+  def testGetChrootPath(self):
+    os.environ['USER'] = 'chronos'
+    server = chroot_server.ChrootServer(self.tempdir)
+    trunk = '/home/chronos/trunk'
+    self.assertEqual(server.GetChrootPath(self.tempdir), trunk)
+    self.assertEqual(
+        server.GetChrootPath(os.path.join(self.tempdir, 'src', 'scripts')),
+        os.path.join(trunk, 'src', 'scripts'))
+    self.assertEqual(server.GetChrootPath(os.path.dirname(self.tempdir)), None)
+    self.assertEqual(server.GetChrootPath(self.tempdir + 'x'), None)
+
+  def testGetChrootPathNoUser(self):
+    """Verify the user is looked up when $USER is not set."""
+    os.environ.pop('USER', None)
+    self.PatchObject(getpass, 'getuser', return_value='chronos')
+    server = chroot_server.ChrootServer(self.tempdir)
+    self.assertEqual(server.GetChrootPath(self.tempdir), '/home/chronos/trunk')
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -0,0 +1,200 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Record every command run by RunCommand, to find where time is spent.
+
+Profiling is turned on by setting the CROS_COMMAND_PROFILE environment
+variable to a directory (or by calling Enable, which does the same). Every
+process that inherits the variable then appends a record for each command it
+runs to its own log in that directory, as one JSON object per line. Summarize
+aggregates the logs of all of the processes by command, or by the function
+that ran the command.
+
+This module must not import cros_build_lib, which uses it.
+"""
+
+import collections
+import json
+import os
+import sys
+import time
+
+ENVVAR = 'CROS_COMMAND_PROFILE'
+
+# How many frames of the caller's stack to record.
+STACK_DEPTH = 3
+
+# Files whose frames are skipped when looking for the caller of a command,
+# because they only wrap RunCommand (or, for this module, record it).
+_WRAPPER_FILES = frozenset(['command_profile.py', 'cros_build_lib.py',
+                            'functools.py'])
+
+
+def Enable(path):
+  """Record commands run by this process and its children in path."""
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  os.environ[ENVVAR] = path
+
+
+def IsEnabled():
+  """Returns whether commands should be recorded."""
+  return bool(os.environ.get(ENVVAR))
+
+
+def GetLogPath(path, pid=None):
+  """Returns the log that process pid (by default, this one) records to."""
+  return os.path.join(path, 'commands.%d.json' % (pid or os.getpid()))
+
+
+def GetCaller(depth=STACK_DEPTH):
+  """Returns the innermost frames of the stack outside of RunCommand.
+
+  Returns:
+    A list of 'file:line:function' strings, innermost first.
+  """
+  frames = []
+  frame = sys._getframe(1)  # pylint: disable=W0212
+  while frame is not None and len(frames) < depth:
+    code = frame.f_code
+    filename = os.path.basename(code.co_filename)
+    if filename not in _WRAPPER_FILES:
+      frames.append('%s:%d:%s' % (filename, frame.f_lineno, code.co_name))
+    frame = frame.f_back
+  return frames
+
+
+def _GetSubcommand(argv):
+  """Returns the first argument of argv that isn't an option, if any."""
+  for arg in argv[1:]:
+    if not arg.startswith('-'):
+      return os.path.basename(arg) if arg.startswith('/') else arg
+  return None
+
+
+def Record(argv, cwd, enter_chroot, start, returncode, output_bytes,
+           caller=None):
+  """Record a command that has finished, if profiling is enabled.
+
+  Errors writing the record are ignored, so that profiling never breaks the
+  build.
+
+  Args:
+    argv: The command that was run, before entering the chroot.
+    cwd: The directory the command was run in.
+    enter_chroot: Whether the command was run inside the chroot.
+    start: The time.time() the command started at.
+    returncode: The exit code of the command.
+    output_bytes: The number of bytes of output produced by the command.
+    caller: The stack of the caller, as returned by GetCaller. By default,
+      the stack of our caller is used.
+  """
+  path = os.environ.get(ENVVAR)
+  if not path:
+    return
+  if isinstance(argv, basestring):
+    argv = ['/bin/bash', '-c', argv]
+  record = {
+      'argv0': os.path.basename(argv[0]) if argv else '',
+      'subcommand': _GetSubcommand(argv),
+      'cwd': cwd,
+      'enter_chroot': bool(enter_chroot),
+      'start': start,
+      'duration': time.time() - start,
+      'returncode': returncode,
+      'output_bytes': output_bytes,
+      'caller': GetCaller() if caller is None else caller,
+      'pid': os.getpid(),
+  }
+  try:
+    with open(GetLogPath(path), 'a') as f:
+      f.write(json.dumps(record) + '\n')
+  except EnvironmentError:
+    pass
+
+
+def LoadRecords(path):
+  """Yield the records of all of the processes that logged to path."""
+  for name in sorted(os.listdir(path)):
+    if not (name.startswith('commands.') and name.endswith('.json')):
+      continue
+    with open(os.path.join(path, name)) as f:
+      for line in f:
+        try:
+          yield json.loads(line)
+        except ValueError:
+          # The process was killed while writing the record.
+          continue
+
+
+class Summary(object):
+  """Aggregated statistics about a group of commands."""
+
+  __slots__ = ('key', 'count', 'total', 'longest', 'failures',
+               'output_bytes')
+
+  def __init__(self, key):
+    self.key = key
+    self.count = 0
+    self.total = 0.0
+    self.longest = 0.0
+    self.failures = 0
+    self.output_bytes = 0
+
+  def Add(self, record):
+    self.count += 1
+    self.total += record['duration']
+    self.longest = max(self.longest, record['duration'])
+    if record['returncode']:
+      self.failures += 1
+    self.output_bytes += record['output_bytes'] or 0
+
+  @property
+  def mean(self):
+    return self.total / self.count if self.count else 0.0
+
+
+def _CommandKey(record):
+  """Group records by command (e.g. 'git rev-parse')."""
+  key = record['argv0']
+  if record['subcommand']:
+    key += ' ' + record['subcommand']
+  if record['enter_chroot']:
+    key += ' (chroot)'
+  return key
+
+
+def _CallerKey(record, depth=1):
+  """Group records by the function(s) that ran them."""
+  # Drop the line numbers, so all of the commands run by a function are
+  # grouped together.
+  frames = ['%s:%s' % (x.split(':')[0], x.split(':')[-1])
+            for x in record['caller'][:depth]]
+  return ' < '.join(frames) or '<unknown>'
+
+
+def Summarize(records, by='command', depth=1):
+  """Aggregate records into Summary objects, longest total time first.
+
+  Args:
+    records: An iterable of records, e.g. from LoadRecords.
+    by: 'command' to group by the command run, or 'caller' to group by the
+      function that ran it.
+    depth: With by='caller', how many frames of the caller to group by.
+  """
+  if by == 'command':
+    get_key = _CommandKey
+  elif by == 'caller':
+    get_key = lambda record: _CallerKey(record, depth)
+  else:
+    raise ValueError('Unknown grouping %r' % (by,))
+
+  summaries = collections.OrderedDict()
+  for record in records:
+    key = get_key(record)
+    summary = summaries.get(key)
+    if summary is None:
+      summary = summaries[key] = Summary(key)
+    summary.Add(record)
+  return sorted(summaries.itervalues(), key=lambda x: x.total, reverse=True)
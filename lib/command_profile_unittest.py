@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the command_profile.py module."""
+
+import imp
+import os
+import py_compile
+import shutil
+import sys
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import command_profile
+from chromite.lib import cros_build_lib
+from chromite.lib import cros_test_lib
+from chromite.lib import osutils
+
+
+class CommandProfileTest(cros_test_lib.TempDirTestCase):
+  """Tests for recording and summarizing commands."""
+
+  def setUp(self):
+    self.path = os.path.join(self.tempdir, 'profile')
+    old = os.environ.pop(command_profile.ENVVAR, None)
+    if old is not None:
+      self.addCleanup(os.environ.__setitem__, command_profile.ENVVAR, old)
+    self.addCleanup(os.environ.pop, command_profile.ENVVAR, None)
+
+  def _RunCommands(self):
+    cros_build_lib.RunCommand(['seq', '3'], redirect_stdout=True,
+                              print_cmd=False)
+    cros_build_lib.RunCommand(['sh', '-c', 'exit 3'], error_code_ok=True,
+                              print_cmd=False)
+    cros_build_lib.RunCommandAsync(['seq', '10'], redirect_stdout=True,
+                                   print_cmd=False).result()
+
+  def testDisabled(self):
+    """Verify nothing is recorded unless profiling is enabled."""
+    self.assertFalse(command_profile.IsEnabled())
+    self._RunCommands()
+    self.assertFalse(os.path.exists(self.path))
+
+  def testRecord(self):
+    """Verify RunCommand and RunCommandAsync record their commands."""
+    command_profile.Enable(self.path)
+    self._RunCommands()
+    records = list(command_profile.LoadRecords(self.path))
+    self.assertEqual([(x['argv0'], x['subcommand'], x['returncode'],
+                       x['output_bytes']) for x in records],
+                     [('seq', '3', 0, 6), ('sh', 'exit 3', 3, 0),
+                      ('seq', '10', 0, 21)])
+    for record in records:
+      self.assertEqual(record['pid'], os.getpid())
+      self.assertFalse(record['enter_chroot'])
+      self.assertTrue(record['duration'] >= 0)
+      self.assertTrue(record['caller'][0].startswith(
+          'command_profile_unittest.py:'))
+      self.assertTrue(record['caller'][0].endswith(':_RunCommands'))
+
+  def testCallerFromBytecode(self):
+    """Verify the module skips its own frames when loaded from a .pyc."""
+    source = os.path.join(self.tempdir, 'command_profile.py')
+    shutil.copy(os.path.splitext(command_profile.__file__)[0] + '.py', source)
+    py_compile.compile(source)
+    os.unlink(source)
+    module = imp.load_compiled('command_profile_pyc', source + 'c')
+    self.assertTrue(module.__file__.endswith('.pyc'))
+
+    module.Enable(self.path)
+    module.Record(['true'], None, False, 0, 0, 0)
+    record, = module.LoadRecords(self.path)
+    self.assertTrue(record['caller'][0].endswith(':testCallerFromBytecode'))
+
+  def testSummarize(self):
+    """Verify records are grouped by command and by caller."""
+    command_profile.Enable(self.path)
+    self._RunCommands()
+    self._RunCommands()
+    # A truncated record is ignored.
+    log = command_profile.GetLogPath(self.path)
+    osutils.WriteFile(log, osutils.ReadFile(log)[:-10])
+
+    summaries = command_profile.Summarize(
+        command_profile.LoadRecords(self.path))
+    self.assertEqual(sorted((x.key, x.count, x.failures) for x in summaries),
+                     [('seq 10', 1, 0), ('seq 3', 2, 0),
+                      ('sh exit 3', 2, 2)])
+    self.assertEqual([x.total for x in summaries],
+                     sorted((x.total for x in summaries), reverse=True))
+
+    summaries = command_profile.Summarize(
+        command_profile.LoadRecords(self.path), by='caller', depth=2)
+    self.assertEqual([(x.key, x.count) for x in summaries],
+                     [('command_profile_unittest.py:_RunCommands < '
+                       'command_profile_unittest.py:testSummarize', 5)])
+    self.assertRaises(ValueError, command_profile.Summarize, [], by='bogus')
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -4,6 +4,7 @@
 
 """Common python commands used by various build scripts."""
 
+import collections
 import contextlib
 from datetime import datetime
 from email.utils import formatdate
@@ -28,6 +29,7 @@ _path = os.path.realpath(__file__)
 _path = os.path.normpath(os.path.join(os.path.dirname(_path), '..', '..'))
 sys.path.insert(0, _path)
 from chromite.buildbot import constants
+from chromite.lib import command_profile
 from chromite.lib import signals
 # Now restore it so that relative scripts don't get cranky.
 sys.path.pop(0)
@@ -35,6 +37,12 @@ del _path
 
 STRICT_SUDO = False
 
+# How much output to read at once when streaming the output of a command.
+_STREAM_BUFSIZE = 64 * 1024
+
+# The chroot_server.ChrootServer, if any, that runs commands in the chroot
+# rather than cros_sdk.
+_chroot_server = None
 
 logger = logging.getLogger('chromite')
 
@@ -164,6 +172,128 @@ def SudoRunCommand(cmd, user='root', **kwds):
   return RunCommand(sudo_cmd, **kwds)
 
 
+class _OutputCapture(object):
+  """Collect the output of a command as it is read from a pipe.
+
+  Output can be passed to a callback as it arrives, kept in memory, or both.
+  When a cap is set, only the beginning and the end of the output are kept in
+  memory, and the whole output can be saved to a file instead.
+
+  Attributes:
+    total_bytes: How many bytes of output were written, kept or not.
+    omitted: How many bytes were trimmed from the middle of the output.
+  """
+
+  def __init__(self, callback=None, lines=False, keep=True, max_output=None,
+               spill_file=None):
+    """Create a new _OutputCapture object.
+
+    Args:
+      callback: If set, a function to pass the output to as it arrives.
+      lines: If True, pass complete lines (including the newline) to the
+        callback, rather than chunks as they are read.
+      keep: Whether to keep the output in memory for GetOutput.
+      max_output: If set, keep at most this many bytes in memory: half from
+        the beginning of the output, and half from the end.  GetOutput
+        marks where the output was trimmed.
+      spill_file: If set, the path of a file to write all of the output to.
+    """
+    self._callback = callback
+    self._lines = lines
+    self._partial = ''
+    self._keep = keep
+    self._max_output = max_output
+    self._head = []
+    self._head_size = 0
+    self._tail = collections.deque()
+    self._tail_size = 0
+    self.total_bytes = 0
+    self.omitted = 0
+    self._spill = open(spill_file, 'w') if spill_file else None
+
+  def _Keep(self, data):
+    """Keep data in memory, trimming the middle of the output if needed."""
+    if self._max_output is None:
+      self._head.append(data)
+      return
+    head_room = self._max_output // 2 - self._head_size
+    if head_room > 0:
+      self._head.append(data[:head_room])
+      self._head_size += len(self._head[-1])
+      data = data[head_room:]
+    if not data:
+      return
+    self._tail.append(data)
+    self._tail_size += len(data)
+    tail_max = self._max_output - self._max_output // 2
+    while self._tail_size > tail_max:
+      excess = self._tail_size - tail_max
+      first = self._tail[0]
+      if len(first) <= excess:
+        self._tail.popleft()
+        dropped = len(first)
+      else:
+        self._tail[0] = first[excess:]
+        dropped = excess
+      self._tail_size -= dropped
+      self.omitted += dropped
+
+  def Write(self, data):
+    """Handle a chunk of output."""
+    self.total_bytes += len(data)
+    if self._keep:
+      self._Keep(data)
+    if self._spill is not None:
+      self._spill.write(data)
+    if self._callback is not None:
+      if not self._lines:
+        self._callback(data)
+        return
+      lines = (self._partial + data).split('\n')
+      self._partial = lines.pop()
+      for line in lines:
+        self._callback(line + '\n')
+
+  def Close(self):
+    """Handle the end of the output."""
+    if self._partial:
+      self._callback(self._partial)
+      self._partial = ''
+    if self._spill is not None:
+      self._spill.close()
+      self._spill = None
+
+  def GetOutput(self):
+    """Return the output that was kept, or None if none was."""
+    if not self._keep:
+      return None
+    marker = ''
+    if self.omitted:
+      marker = '\n[... %d bytes omitted ...]\n' % self.omitted
+    return ''.join(self._head) + marker + ''.join(self._tail)
+
+
+def _PrintOutput(data):
+  """Pass output that RunCommand isn't capturing through to our stdout."""
+  sys.stdout.write(data)
+  sys.stdout.flush()
+
+
+def _StreamOutput(proc, capture):
+  """Read the output of proc from its stdout pipe until it closes."""
+  fd = proc.stdout.fileno()
+  try:
+    while True:
+      data = os.read(fd, _STREAM_BUFSIZE)
+      if not data:
+        break
+      capture.Write(data)
+  finally:
+    proc.stdout.close()
+    capture.Close()
+  proc.wait()
+
+
 def _KillChildProcess(proc, kill_timeout, cmd, original_handler, signum, frame):
   """Functor that when curried w/ the appropriate arguments, is used as a signal
   handler by RunCommand.
@@ -252,15 +382,172 @@ class _Popen(subprocess.Popen):
 
 
 #pylint: disable=W0622
+def _GetTempfile():
+  """Return an unbuffered temporary file for the output of a command."""
+  try:
+    return tempfile.TemporaryFile(bufsize=0)
+  except EnvironmentError as e:
+    if e.errno != errno.ENOENT:
+      raise
+    # This can occur if we were pointed at a specific location for our
+    # TMP, but that location has since been deleted.  Suppress that issue
+    # in this particular case since our usage gurantees deletion,
+    # and since this is primarily triggered during hard cgroups shutdown.
+    return tempfile.TemporaryFile(bufsize=0, dir='/tmp')
+
+
+def _ReadTempfile(f):
+  """Return the contents of a temporary file written by a command."""
+  f.seek(0)
+  data = f.read()
+  f.close()
+  return data
+
+
+def _BuildCommand(cmd, shell, env, extra_env, enter_chroot, chroot_args):
+  """Return the (cmd, env) to run for the arguments of RunCommand."""
+  if isinstance(cmd, basestring):
+    if not shell:
+      raise Exception('Cannot run a string command without a shell')
+    cmd = ['/bin/bash', '-c', cmd]
+  elif shell:
+    raise Exception('Cannot run an array command with a shell')
+
+  # If we are using enter_chroot we need to use enterchroot pass env through
+  # to the final command.
+  env = env.copy() if env is not None else os.environ.copy()
+  if enter_chroot:
+    wrapper = ['cros_sdk']
+
+    if chroot_args:
+      wrapper += chroot_args
+
+    if extra_env:
+      wrapper.extend('%s=%s' % (k, v) for k, v in extra_env.iteritems())
+
+    cmd = wrapper + ['--'] + cmd
+
+  elif extra_env:
+    env.update(extra_env)
+
+  for var in constants.ENV_PASSTHRU:
+    if var not in env and var in os.environ:
+      env[var] = os.environ[var]
+
+  return cmd, env
+
+
+def _LogCommand(cmd, cwd, debug_level):
+  """Log a command that is about to be run."""
+  # Note we reformat the argument into a form that can be directly
+  # copy/pasted into a term- thus the map(repr, cmd) bit needs to stay.
+  if cwd:
+    logger.log(debug_level, 'RunCommand: %s in %s',
+               ' '.join(map(repr, cmd)), cwd)
+  else:
+    logger.log(debug_level, 'RunCommand: %r', ' '.join(map(repr, cmd)))
+
+
+def SetChrootServer(server):
+  """Run RunCommand(enter_chroot=True) commands with a chroot server.
+
+  Args:
+    server: A chroot_server.ChrootServer, or None to go back to cros_sdk.
+  """
+  global _chroot_server
+  _chroot_server = server
+
+
+def _RunWithChrootServer(server, cmd, cwd, extra_env, input, stdout, stderr):
+  """Run cmd with a chroot server, writing its output where _Popen would.
+
+  If the server can't be reached, it is no longer used, and the command is
+  left for the caller to run with cros_sdk.
+
+  Returns:
+    The exit code of the command, or None if it was not run.
+
+  Raises:
+    RunCommandError if the server was lost while running the command.
+  """
+  # chroot_server imports this module, so it can only be imported here.
+  from chromite.lib import chroot_server
+
+  if isinstance(cmd, basestring):
+    cmd = ['/bin/bash', '-c', cmd]
+  try:
+    returncode, output, error = server.Run(
+        cmd, cwd=cwd, extra_env=extra_env, input=input,
+        combine_stdout_stderr=stderr == subprocess.STDOUT)
+  except chroot_server.ChrootServerUnavailable as e:
+    Warning('%s; entering the chroot for every command', e)
+    SetChrootServer(None)
+    return None
+  except chroot_server.ChrootServerError as e:
+    raise RunCommandError(str(e), CommandResult(cmd=cmd), exception=e)
+  for f, data, default in ((stdout, output, sys.stdout),
+                           (stderr, error, sys.stderr)):
+    if f is None:
+      f = default
+    elif f == subprocess.STDOUT:
+      continue
+    f.write(data)
+    f.flush()
+  return returncode
+
+
+def _CollectOutput(cmd_result, stdin, stdout, stderr, log_stdout_to_file):
+  """Read the output of a command that RunCommand ran into cmd_result."""
+  if hasattr(stdin, 'close'):
+    stdin.close()
+
+  if stdout and stdout != subprocess.PIPE and not log_stdout_to_file:
+    cmd_result.output = _ReadTempfile(stdout)
+
+  if stderr and stderr != subprocess.STDOUT:
+    cmd_result.error = _ReadTempfile(stderr)
+
+
+def _OutputBytes(cmd_result, capture=None):
+  """Returns how many bytes of output a command produced.
+
+  Args:
+    cmd_result: The CommandResult of the command.
+    capture: If set, the _OutputCapture its stdout was read through. It
+      counts all of the output, including any that wasn't kept.
+  """
+  if capture is not None:
+    return capture.total_bytes + len(cmd_result.error or '')
+  return len(cmd_result.output or '') + len(cmd_result.error or '')
+
+
+def _CommandFailed(cmd_result, cwd, extra_env, error_message):
+  """Return the RunCommandError to raise for a command that failed."""
+  msg = 'Failed command "%r", cwd=%s, extra env=%r' % (cmd_result.cmd, cwd,
+                                                       extra_env)
+  if error_message:
+    msg += '\n%s' % error_message
+  return RunCommandError(msg, cmd_result)
+
+
 def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                redirect_stdout=False, redirect_stderr=False,
                cwd=None, input=None, enter_chroot=False, shell=False,
                env=None, extra_env=None, ignore_sigint=False,
                combine_stdout_stderr=False, log_stdout_to_file=None,
                chroot_args=None, debug_level=logging.INFO,
-               error_code_ok=False, kill_timeout=1, log_output=False):
+               error_code_ok=False, kill_timeout=1, log_output=False,
+               output_callback=None, callback_lines=False, max_output=None,
+               output_spill_file=None):
   """Runs a command.
 
+  If the CROS_COMMAND_PROFILE environment variable is set, every command is
+  recorded there; see the command_profile module.
+
+  Commands that enter the chroot are run with the chroot server set by
+  SetChrootServer, if any, unless they use chroot_args or output_callback or
+  max_output.
+
   Args:
     cmd: cmd to run.  Should be input to subprocess.Popen. If a string, shell
       must be true. Otherwise the command must be an array of arguments, and
@@ -272,7 +559,8 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
     redirect_stdout: returns the stdout.
     redirect_stderr: holds stderr output until input is communicated.
     cwd: the working directory to run this cmd.
-    input: input to pipe into this command through stdin.
+    input: input to pipe into this command through stdin.  May also be a
+      file object, which the command reads from directly.
     enter_chroot: this command should be run from within the chroot.  If set,
       cwd must point to the scripts directory.
     shell: Controls whether we add a shell as a command interpreter.  See cmd
@@ -302,6 +590,18 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                   process to shutdown from a SIGTERM before we SIGKILL it.
                   Specified in seconds.
     log_output: Log the command and its output automatically.
+    output_callback: If set, stdout is read from a pipe as the command runs,
+      and passed to this function as it arrives, rather than being printed.
+      It is also kept in the result if stdout is redirected.
+    callback_lines: If True, pass output_callback one line at a time
+      (including the newline) rather than chunks as they are read.
+    max_output: If set, keep at most this many bytes of stdout in memory: the
+      beginning and the end of the output, with a marker where the rest was
+      omitted. Use this for commands with a lot of output, so that it isn't
+      all held in memory. If stdout isn't redirected, it is still printed.
+      The command profile still counts all of the output.
+    output_spill_file: If set, with max_output or output_callback, write all
+      of stdout to this file as well.
   Returns:
     A CommandResult object.
 
@@ -320,31 +620,31 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
   # a self-explanatory exception will be thrown.
   kill_timeout = float(kill_timeout)
 
-  def _get_tempfile():
-    try:
-      return tempfile.TemporaryFile(bufsize=0)
-    except EnvironmentError as e:
-      if e.errno != errno.ENOENT:
-        raise
-      # This can occur if we were pointed at a specific location for our
-      # TMP, but that location has since been deleted.  Suppress that issue
-      # in this particular case since our usage gurantees deletion,
-      # and since this is primarily triggered during hard cgroups shutdown.
-      return tempfile.TemporaryFile(bufsize=0, dir='/tmp')
-
   # Modify defaults based on parameters.
   # Note that tempfiles must be unbuffered else attempts to read
   # what a separate process did to that file can result in a bad
   # view of the file.
+  capture = None
   if log_stdout_to_file:
     stdout = open(log_stdout_to_file, 'w+')
+  elif output_callback or max_output is not None:
+    # Read the output through a pipe as it's written, rather than letting it
+    # pile up in a temporary file.
+    stdout = subprocess.PIPE
+    keep = bool(redirect_stdout or mute_output or log_output)
+    if output_callback is None and not keep:
+      # Nothing is capturing the output, so print it as usual.
+      output_callback = _PrintOutput
+    capture = _OutputCapture(
+        callback=output_callback, lines=callback_lines, keep=keep,
+        max_output=max_output, spill_file=output_spill_file)
   elif redirect_stdout or mute_output or log_output:
-    stdout = _get_tempfile()
+    stdout = _GetTempfile()
 
   if combine_stdout_stderr:
     stderr = subprocess.STDOUT
   elif redirect_stderr or mute_output or log_output:
-    stderr = _get_tempfile()
+    stderr = _GetTempfile()
 
   # If subprocesses have direct access to stdout or stderr, they can bypass
   # our buffers, so we need to flush to ensure that output is not interleaved.
@@ -352,47 +652,32 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
     sys.stdout.flush()
     sys.stderr.flush()
 
-  if input:
-    stdin = subprocess.PIPE
-
-  if isinstance(cmd, basestring):
-    if not shell:
-      raise Exception('Cannot run a string command without a shell')
-    cmd = ['/bin/bash', '-c', cmd]
-    shell = False
-  elif shell:
-    raise Exception('Cannot run an array command with a shell')
-
-  # If we are using enter_chroot we need to use enterchroot pass env through
-  # to the final command.
-  env = env.copy() if env is not None else os.environ.copy()
-  if enter_chroot:
-    wrapper = ['cros_sdk']
-
-    if chroot_args:
-      wrapper += chroot_args
-
-    if extra_env:
-      wrapper.extend('%s=%s' % (k, v) for k, v in extra_env.iteritems())
-
-    cmd = wrapper + ['--'] + cmd
-
-  elif extra_env:
-    env.update(extra_env)
-
-  for var in constants.ENV_PASSTHRU:
-    if var not in env and var in os.environ:
-      env[var] = os.environ[var]
+  if isinstance(input, file):
+    stdin = input.fileno()
+    input = None
+  elif input:
+    if capture is None:
+      stdin = subprocess.PIPE
+    else:
+      # We can't write input while we read the output, so feed it from a
+      # temporary file instead.
+      stdin = _GetTempfile()
+      stdin.write(input)
+      stdin.seek(0)
+      input = None
+
+  server = None
+  if (enter_chroot and not chroot_args and capture is None and
+      stdin in (None, subprocess.PIPE)):
+    server = _chroot_server
+
+  argv = cmd
+  cmd, env = _BuildCommand(cmd, shell, env, extra_env, enter_chroot,
+                           chroot_args)
 
   # Print out the command before running.
   if print_cmd or log_output:
-    # Note we reformat the argument into a form that can be directly
-    # copy/pasted into a term- thus the map(repr, cmd) bit needs to stay.
-    if cwd:
-      logger.log(debug_level, 'RunCommand: %s in %s',
-                 ' '.join(map(repr, cmd)), cwd)
-    else:
-      logger.log(debug_level, 'RunCommand: %r', ' '.join(map(repr, cmd)))
+    _LogCommand(cmd, cwd, debug_level)
 
   cmd_result.cmd = cmd
 
@@ -401,43 +686,46 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
   # upon invocation of getsignal.  See signals.SignalModuleUsable for the
   # details and upstream python bug.
   use_signals = signals.SignalModuleUsable()
+  start = time.time()
   try:
-    proc = _Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout,
-                  stderr=stderr, shell=False, env=env,
-                  close_fds=True)
-
-    if use_signals:
-      if ignore_sigint:
-        old_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
-      else:
-        old_sigint = signal.getsignal(signal.SIGINT)
-        signal.signal(signal.SIGINT,
-                      functools.partial(_KillChildProcess, proc, kill_timeout,
-                                        cmd, old_sigint))
-
-      old_sigterm = signal.getsignal(signal.SIGTERM)
-      signal.signal(signal.SIGTERM,
-                    functools.partial(_KillChildProcess, proc, kill_timeout,
-                                      cmd, old_sigterm))
+    if server is not None:
+      cmd_result.returncode = _RunWithChrootServer(
+          server, argv, cwd, extra_env, input, stdout, stderr)
+    if cmd_result.returncode is not None:
+      _CollectOutput(cmd_result, stdin, stdout, stderr, log_stdout_to_file)
+    else:
+      proc = _Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout,
+                    stderr=stderr, shell=False, env=env,
+                    close_fds=True)
 
-    try:
-      (cmd_result.output, cmd_result.error) = proc.communicate(input)
-    finally:
       if use_signals:
-        signal.signal(signal.SIGINT, old_sigint)
-        signal.signal(signal.SIGTERM, old_sigterm)
+        if ignore_sigint:
+          old_sigint = signal.signal(signal.SIGINT, signal.SIG_IGN)
+        else:
+          old_sigint = signal.getsignal(signal.SIGINT)
+          signal.signal(signal.SIGINT,
+                        functools.partial(_KillChildProcess, proc,
+                                          kill_timeout, cmd, old_sigint))
+
+        old_sigterm = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM,
+                      functools.partial(_KillChildProcess, proc, kill_timeout,
+                                        cmd, old_sigterm))
 
-      if stdout and not log_stdout_to_file:
-        stdout.seek(0)
-        cmd_result.output = stdout.read()
-        stdout.close()
+      try:
+        if capture is not None:
+          _StreamOutput(proc, capture)
+          cmd_result.output = capture.GetOutput()
+        else:
+          (cmd_result.output, cmd_result.error) = proc.communicate(input)
+      finally:
+        if use_signals:
+          signal.signal(signal.SIGINT, old_sigint)
+          signal.signal(signal.SIGTERM, old_sigterm)
 
-      if stderr and stderr != subprocess.STDOUT:
-        stderr.seek(0)
-        cmd_result.error = stderr.read()
-        stderr.close()
+        _CollectOutput(cmd_result, stdin, stdout, stderr, log_stdout_to_file)
 
-    cmd_result.returncode = proc.returncode
+      cmd_result.returncode = proc.returncode
 
     if log_output:
       if cmd_result.output:
@@ -450,11 +738,8 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                      "error_ok will be removed in Q1 2013.  Was invoked "
                      "with args=%r", cmd)
 
-    if not error_ok and not error_code_ok and proc.returncode:
-      msg = 'Failed command "%r", cwd=%s, extra env=%r' % (cmd, cwd, extra_env)
-      if error_message:
-        msg += '\n%s' % error_message
-      raise RunCommandError(msg, cmd_result)
+    if not error_ok and not error_code_ok and cmd_result.returncode:
+      raise _CommandFailed(cmd_result, cwd, extra_env, error_message)
   # TODO(sosa): is it possible not to use the catch-all Exception here?
   except OSError as e:
     estr = str(e)
@@ -471,9 +756,13 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
     else:
       Warning(str(e))
   finally:
+    returncode = cmd_result.returncode
     if proc is not None:
       # Ensure the process is dead.
       _KillChildProcess(proc, kill_timeout, cmd, None, None, None)
+      returncode = proc.returncode
+    command_profile.Record(argv, cwd, enter_chroot, start, returncode,
+                           _OutputBytes(cmd_result, capture))
 
   return cmd_result
 
@@ -482,6 +771,226 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
 DebugRunCommand = functools.partial(RunCommand, debug_level=logging.DEBUG)
 
 
+class CommandHandle(object):
+  """A command started in the background by RunCommandAsync.
+
+  Output is collected in temporary files, so any number of commands can run
+  at once without us reading from them. The command is killed if the handle
+  is used as a context manager and the command is still running on exit.
+  """
+
+  def __init__(self, proc, cmd_result, stdin, stdout, stderr, kill_timeout,
+               check_result, on_collect=None):
+    """Create a new CommandHandle object. Use RunCommandAsync instead.
+
+    Args:
+      proc: The _Popen object of the command.
+      cmd_result: The CommandResult to fill in once the command exits.
+      stdin: The temporary file holding the command's input, or None.
+      stdout: The temporary file collecting the command's stdout, or None.
+      stderr: The temporary file collecting the command's stderr, or None.
+      kill_timeout: See RunCommand.
+      check_result: Function taking the CommandResult once the command has
+        exited, which raises a RunCommandError if the command failed.
+      on_collect: Function taking the CommandResult once its output has been
+        collected, whether or not the command was cancelled.
+    """
+    self._proc = proc
+    self._cmd_result = cmd_result
+    self._stdin = stdin
+    self._stdout = stdout
+    self._stderr = stderr
+    self._kill_timeout = kill_timeout
+    self._check_result = check_result
+    self._on_collect = on_collect
+    self._collected = False
+
+  @property
+  def cmd(self):
+    """The command that is running."""
+    return self._cmd_result.cmd
+
+  @property
+  def pid(self):
+    """The pid of the command."""
+    return self._proc.pid
+
+  def poll(self):
+    """Return the exit code of the command, or None if it is still running."""
+    return self._proc.poll()
+
+  def wait(self, timeout=None):
+    """Wait for the command to exit.
+
+    While we wait, SIGINT and SIGTERM kill the command, like RunCommand.
+
+    Args:
+      timeout: If set, the most seconds to wait.
+
+    Returns:
+      The exit code of the command, or None if it is still running.
+    """
+    if self._proc.returncode is not None:
+      return self._proc.returncode
+
+    use_signals = signals.SignalModuleUsable()
+    if use_signals:
+      handlers = {}
+      for signum in (signal.SIGINT, signal.SIGTERM):
+        handlers[signum] = signal.getsignal(signum)
+        signal.signal(signum, functools.partial(
+            _KillChildProcess, self._proc, self._kill_timeout, self.cmd,
+            handlers[signum]))
+    try:
+      if timeout is None:
+        return self._proc.wait()
+      end = time.time() + timeout
+      while self._proc.poll() is None and time.time() < end:
+        time.sleep(min(0.1, max(0, end - time.time())))
+      return self._proc.returncode
+    finally:
+      if use_signals:
+        for signum, handler in handlers.iteritems():
+          signal.signal(signum, handler)
+
+  def result(self):
+    """Wait for the command to exit, and return its CommandResult.
+
+    Raises:
+      RunCommandError if the command failed, unless error_code_ok was passed
+      to RunCommandAsync.
+    """
+    self.wait()
+    if not self._collected:
+      self._collected = True
+      self._Collect()
+      self._check_result(self._cmd_result)
+    return self._cmd_result
+
+  def cancel(self):
+    """Kill the command if it is still running.
+
+    Like RunCommand, the command is sent SIGTERM, and then SIGKILL if it
+    hasn't exited after kill_timeout seconds.
+    """
+    _KillChildProcess(self._proc, self._kill_timeout, self.cmd, None, None,
+                      None)
+    if not self._collected:
+      self._collected = True
+      self._Collect()
+
+  def _Collect(self):
+    """Read the output of the command, and clean up its files."""
+    self._cmd_result.returncode = self._proc.returncode
+    if self._stdin is not None:
+      self._stdin.close()
+    if self._stdout is not None:
+      self._cmd_result.output = _ReadTempfile(self._stdout)
+    if self._stderr is not None:
+      self._cmd_result.error = _ReadTempfile(self._stderr)
+    if self._on_collect is not None:
+      self._on_collect(self._cmd_result)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _type, _value, _traceback):
+    self.cancel()
+
+
+def RunCommandAsync(cmd, print_cmd=True, error_message=None,
+                    redirect_stdout=False, redirect_stderr=False, cwd=None,
+                    input=None, enter_chroot=False, shell=False, env=None,
+                    extra_env=None, combine_stdout_stderr=False,
+                    chroot_args=None, debug_level=logging.INFO,
+                    error_code_ok=False, kill_timeout=1):
+  """Start a command in the background, and return a CommandHandle for it.
+
+  This lets many independent commands run at once from a single process,
+  without forking Python for each of them. For example:
+    handles = [RunCommandAsync(['git', 'fetch'], cwd=x) for x in projects]
+    results = [x.result() for x in handles]
+
+  Args:
+    cmd: The command to run. See RunCommand.
+    print_cmd: prints the command before running it.
+    error_message: Included in the RunCommandError raised by
+      CommandHandle.result if the command fails.
+    redirect_stdout: Collect stdout in the result, rather than printing it.
+    redirect_stderr: Collect stderr in the result, rather than printing it.
+    cwd: the working directory to run this cmd.
+    input: input to pipe into this command through stdin.
+    enter_chroot: See RunCommand.
+    shell: See RunCommand.
+    env: See RunCommand.
+    extra_env: See RunCommand.
+    combine_stdout_stderr: Combines stdout and stderr streams into stdout.
+    chroot_args: An array of arguments for the chroot environment wrapper.
+    debug_level: The debug level of RunCommandAsync's logging.
+    error_code_ok: If True, CommandHandle.result doesn't raise an exception
+      when the command returns a non-zero exit code.
+    kill_timeout: If the command is cancelled, how long should we give it to
+      shutdown from a SIGTERM before we SIGKILL it. Specified in seconds.
+
+  Returns:
+    A CommandHandle object.
+
+  Raises:
+    RunCommandError if the command could not be started.
+  """
+  kill_timeout = float(kill_timeout)
+  argv = cmd
+  cmd, env = _BuildCommand(cmd, shell, env, extra_env, enter_chroot,
+                           chroot_args)
+
+  stdin = stdout = stderr = None
+  if redirect_stdout:
+    stdout = _GetTempfile()
+  if combine_stdout_stderr:
+    stderr = subprocess.STDOUT
+  elif redirect_stderr:
+    stderr = _GetTempfile()
+  if input:
+    stdin = _GetTempfile()
+    stdin.write(input)
+    stdin.seek(0)
+
+  # If subprocesses have direct access to stdout or stderr, they can bypass
+  # our buffers, so we need to flush to ensure that output is not interleaved.
+  if stdout is None or stderr is None:
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+  if print_cmd:
+    _LogCommand(cmd, cwd, debug_level)
+
+  # Profile the command from where it was started, not where it finished.
+  caller = command_profile.GetCaller() if command_profile.IsEnabled() else []
+  start = time.time()
+  try:
+    proc = _Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr,
+                  shell=False, env=env, close_fds=True)
+  except OSError as e:
+    estr = str(e)
+    if e.errno == errno.EACCES:
+      estr += '; does the program need `chmod a+x`?'
+    raise RunCommandError(estr, CommandResult(cmd=cmd), exception=e)
+
+  def _CheckResult(cmd_result):
+    if not error_code_ok and cmd_result.returncode:
+      raise _CommandFailed(cmd_result, cwd, extra_env, error_message)
+
+  def _Profile(cmd_result):
+    command_profile.Record(argv, cwd, enter_chroot, start,
+                           cmd_result.returncode, _OutputBytes(cmd_result),
+                           caller=caller)
+
+  if stderr == subprocess.STDOUT:
+    stderr = None
+  return CommandHandle(proc, CommandResult(cmd=cmd), stdin, stdout, stderr,
+                       kill_timeout, _CheckResult, on_collect=_Profile)
+
+
 class DieSystemExit(SystemExit):
   """Custom Exception used so we can intercept this if necessary."""
 
@@ -22,6 +22,7 @@ import urllib
 import __builtin__
 
 from chromite.buildbot import constants
+from chromite.lib import command_profile
 from chromite.lib import cros_build_lib
 from chromite.lib import git
 from chromite.lib import cros_test_lib
@@ -471,6 +472,110 @@ class TestRunCommandLogging(cros_test_lib.TempDirTestCase):
     self.assertEqual(osutils.ReadFile(log), 'monkeys4\nmonkeys5\n')
 
 
+class TestRunCommandStreaming(cros_test_lib.OutputTestCase,
+                              cros_test_lib.MockTempDirTestCase):
+  """Tests for streaming the output of RunCommand."""
+
+  def testCallbackLines(self):
+    """Verify output is passed to the callback a line at a time."""
+    lines = []
+    ret = cros_build_lib.RunCommand(
+        ['sh', '-c', 'echo one; echo two; printf three'],
+        output_callback=lines.append, callback_lines=True, print_cmd=False)
+    self.assertEqual(lines, ['one\n', 'two\n', 'three'])
+    self.assertTrue(ret.output is None)
+    self.assertEqual(ret.returncode, 0)
+
+  def testCallbackWithInput(self):
+    """Verify input is fed to the command while its output is streamed."""
+    chunks = []
+    ret = cros_build_lib.RunCommand(
+        ['cat'], input='x' * 100000, output_callback=chunks.append,
+        redirect_stdout=True, print_cmd=False)
+    self.assertEqual(''.join(chunks), 'x' * 100000)
+    self.assertEqual(ret.output, 'x' * 100000)
+
+  def testMaxOutput(self):
+    """Verify only the head and tail are kept, and the rest is spilled."""
+    spill = os.path.join(self.tempdir, 'output')
+    record = self.PatchObject(command_profile, 'Record')
+    ret = cros_build_lib.RunCommand(
+        ['seq', '100000'], redirect_stdout=True, max_output=20,
+        output_spill_file=spill, print_cmd=False)
+    full = osutils.ReadFile(spill)
+    self.assertEqual(ret.output,
+                     '1\n2\n3\n4\n5\n\n[... %d bytes omitted ...]\n'
+                     '99\n100000\n' % (len(full) - 20))
+    self.assertTrue(full.startswith('1\n2\n'))
+    self.assertTrue(full.endswith('\n99999\n100000\n'))
+    self.assertEqual(len(full.splitlines()), 100000)
+    # The profile counts all of the output, not just what was kept.
+    self.assertEqual(record.call_args[0][5], len(full))
+
+  def testMaxOutputPrinted(self):
+    """Verify output that isn't redirected is still printed."""
+    with self.OutputCapturer() as capture:
+      ret = cros_build_lib.RunCommand(['seq', '1000'], max_output=20,
+                                      print_cmd=False)
+    self.assertTrue(ret.output is None)
+    self.assertEqual(capture.GetStdout(),
+                     ''.join('%d\n' % i for i in range(1, 1001)))
+
+  def testCaptureTrimming(self):
+    """Verify the tail is trimmed correctly across chunks."""
+    capture = cros_build_lib._OutputCapture(max_output=6)
+    for chunk in ('ab', 'cdef', 'g', 'hijkl'):
+      capture.Write(chunk)
+    capture.Close()
+    self.assertEqual(capture.GetOutput(),
+                     'abc\n[... 6 bytes omitted ...]\njkl')
+    self.assertEqual(capture.omitted, 6)
+    self.assertEqual(capture.total_bytes, 12)
+
+
+class TestRunCommandAsync(cros_test_lib.TestCase):
+  """Tests for RunCommandAsync."""
+
+  def testConcurrent(self):
+    """Verify several commands run at once, and their output is collected."""
+    start = time.time()
+    handles = [cros_build_lib.RunCommandAsync(
+        ['sh', '-c', 'sleep 0.5; echo %d' % i], redirect_stdout=True,
+        print_cmd=False) for i in range(5)]
+    self.assertEqual(handles[0].poll(), None)
+    results = [x.result() for x in handles]
+    self.assertTrue(time.time() - start < 2.5)
+    self.assertEqual([x.output for x in results],
+                     ['%d\n' % i for i in range(5)])
+    self.assertEqual([x.returncode for x in results], [0] * 5)
+
+  def testInput(self):
+    """Verify input is fed to the command."""
+    handle = cros_build_lib.RunCommandAsync(['cat'], input='hello',
+                                            redirect_stdout=True,
+                                            print_cmd=False)
+    self.assertEqual(handle.result().output, 'hello')
+
+  def testFailure(self):
+    """Verify failures are raised when the result is fetched."""
+    handle = cros_build_lib.RunCommandAsync(['false'], print_cmd=False)
+    self.assertRaises(cros_build_lib.RunCommandError, handle.result)
+    handle = cros_build_lib.RunCommandAsync(['false'], error_code_ok=True,
+                                            print_cmd=False)
+    self.assertEqual(handle.result().returncode, 1)
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      cros_build_lib.RunCommandAsync, ['/does/not/exist'],
+                      print_cmd=False)
+
+  def testWaitAndCancel(self):
+    """Verify waiting can time out, and commands can be cancelled."""
+    with cros_build_lib.RunCommandAsync(['sleep', '60'], print_cmd=False,
+                                        kill_timeout=0.5) as handle:
+      self.assertEqual(handle.wait(timeout=0.1), None)
+    self.assertEqual(handle.poll(), -signal.SIGTERM)
+    self.assertEqual(handle.result().returncode, -signal.SIGTERM)
+
+
 class TestRetries(cros_test_lib.MoxTestCase):
 
   def testRetryReturn(self):
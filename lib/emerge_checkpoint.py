@@ -0,0 +1,108 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Checkpoints that let parallel_emerge resume an interrupted run.
+
+A checkpoint consists of two files:
+  path: A pickle of the plan for the run (e.g. the dependency graph), along
+    with a fingerprint of the plan.
+  path.log: A log of the packages that have been merged or failed so far,
+    one JSON object per line. The first line holds the fingerprint of the plan
+    the log belongs to, so a log is never matched up with the wrong plan.
+"""
+
+import cPickle
+import hashlib
+import json
+
+from chromite.lib import osutils
+
+
+class Checkpoint(object):
+  """Save and restore the progress of a parallel_emerge run."""
+
+  COMPLETED = 'completed'
+  FAILED = 'failed'
+
+  def __init__(self, path):
+    self.path = path
+    self.log_path = path + '.log'
+    self.fingerprint = None
+
+  def Start(self, plan):
+    """Save the plan for a new run, and clear out any previous progress.
+
+    Args:
+      plan: A picklable object describing the run.
+    """
+    blob = cPickle.dumps(plan, cPickle.HIGHEST_PROTOCOL)
+    self.fingerprint = hashlib.sha1(blob).hexdigest()
+    data = cPickle.dumps(dict(fingerprint=self.fingerprint, plan=blob),
+                         cPickle.HIGHEST_PROTOCOL)
+    osutils.WriteFile(self.path, data, mode='wb', atomic=True, makedirs=True)
+    osutils.WriteFile(self.log_path,
+                      json.dumps(dict(fingerprint=self.fingerprint)) + '\n',
+                      atomic=True)
+
+  def Load(self):
+    """Load the plan and progress of a previous run.
+
+    Once a checkpoint has been loaded, further progress is appended to it.
+
+    Returns:
+      A tuple (plan, completed, failed), where completed and failed are sets
+      of the targets that were merged or that failed last time. Returns None
+      if there is no usable checkpoint.
+    """
+    try:
+      data = cPickle.loads(osutils.ReadFile(self.path, mode='rb'))
+      blob = data['plan']
+      if hashlib.sha1(blob).hexdigest() != data['fingerprint']:
+        return None
+      plan = cPickle.loads(blob)
+      with open(self.log_path) as f:
+        lines = f.readlines()
+    except (EnvironmentError, EOFError, KeyError, TypeError,
+            cPickle.UnpicklingError):
+      return None
+
+    try:
+      header = json.loads(lines[0])
+    except (IndexError, ValueError):
+      return None
+    if header.get('fingerprint') != data['fingerprint']:
+      return None
+
+    # Later entries override earlier ones, so that a package that failed and
+    # was then merged successfully counts as merged.
+    status = {}
+    for line in lines[1:]:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        continue
+      status[entry['target']] = entry['status']
+    completed = set(k for k, v in status.iteritems() if v == self.COMPLETED)
+    failed = set(k for k, v in status.iteritems() if v == self.FAILED)
+
+    self.fingerprint = data['fingerprint']
+    return plan, completed, failed
+
+  def _Append(self, target, status):
+    line = json.dumps(dict(target=target, status=status)) + '\n'
+    osutils.WriteFile(self.log_path, line, mode='a')
+
+  def MarkCompleted(self, target):
+    """Record that target was merged successfully."""
+    self._Append(target, self.COMPLETED)
+
+  def MarkFailed(self, target):
+    """Record that target failed to merge."""
+    self._Append(target, self.FAILED)
+
+  def Remove(self):
+    """Delete the checkpoint, e.g. once the run has finished successfully."""
+    osutils.SafeUnlink(self.path)
+    osutils.SafeUnlink(self.log_path)
+    self.fingerprint = None
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the emerge_checkpoint.py module."""
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import cros_test_lib
+from chromite.lib import emerge_checkpoint
+from chromite.lib import osutils
+
+
+class CheckpointTest(cros_test_lib.TempDirTestCase):
+  """Tests for the Checkpoint class."""
+
+  PLAN = {'deps_map': {'sys-libs/zlib-1.2': {'needs': {}, 'provides': set()}}}
+
+  def setUp(self):
+    self.path = os.path.join(self.tempdir, 'checkpoints', 'checkpoint')
+    self.checkpoint = emerge_checkpoint.Checkpoint(self.path)
+
+  def testMissing(self):
+    """Verify that a missing checkpoint can't be loaded."""
+    self.assertEqual(self.checkpoint.Load(), None)
+
+  def testRoundTrip(self):
+    """Verify that progress is restored, with later entries winning."""
+    self.checkpoint.Start(self.PLAN)
+    self.checkpoint.MarkFailed('a')
+    self.checkpoint.MarkCompleted('b')
+    self.checkpoint.MarkCompleted('a')
+    self.checkpoint.MarkFailed('c')
+
+    checkpoint = emerge_checkpoint.Checkpoint(self.path)
+    plan, completed, failed = checkpoint.Load()
+    self.assertEqual(plan, self.PLAN)
+    self.assertEqual(completed, set(['a', 'b']))
+    self.assertEqual(failed, set(['c']))
+
+    # Progress made after resuming is appended to the same checkpoint.
+    checkpoint.MarkCompleted('c')
+    _, completed, failed = emerge_checkpoint.Checkpoint(self.path).Load()
+    self.assertEqual(completed, set(['a', 'b', 'c']))
+    self.assertEqual(failed, set())
+
+  def testRestart(self):
+    """Verify that starting a new run discards previous progress."""
+    self.checkpoint.Start(self.PLAN)
+    self.checkpoint.MarkCompleted('a')
+    self.checkpoint.Start({'deps_map': {}})
+    plan, completed, _ = self.checkpoint.Load()
+    self.assertEqual(plan, {'deps_map': {}})
+    self.assertEqual(completed, set())
+
+  def testMismatchedLog(self):
+    """Verify that a log from a different run is rejected."""
+    self.checkpoint.Start(self.PLAN)
+    log = osutils.ReadFile(self.checkpoint.log_path)
+    self.checkpoint.Start({'deps_map': {}})
+    osutils.WriteFile(self.checkpoint.log_path, log)
+    self.assertEqual(self.checkpoint.Load(), None)
+
+  def testRemove(self):
+    """Verify that removed checkpoints can't be loaded."""
+    self.checkpoint.Start(self.PLAN)
+    self.checkpoint.Remove()
+    self.assertFalse(os.path.exists(self.path))
+    self.assertEqual(self.checkpoint.Load(), None)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
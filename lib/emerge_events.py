@@ -0,0 +1,130 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Machine readable log of what parallel_emerge did, and when.
+
+The event log is a file of JSON objects, one per line. Every event has an
+"event" field naming it and a "ts" field holding the time it happened (in
+seconds since the epoch). The events are:
+  fetch_start, fetch_end, build_start, build_end: A job started or finished.
+    These have "target" and "pid" (the worker that ran the job) fields, and
+    end events also have a "retcode" field.
+  state: A snapshot of the scheduler, with the number of running and ready
+    jobs in each queue, the load average and the number of build slots.
+
+The log can be converted into the Chrome trace event format, which can be
+loaded into chrome://tracing to see what each worker was doing over time.
+"""
+
+import json
+
+# The trace "processes" that fetch and build workers are shown under.
+_TRACE_PIDS = {'fetch': 1, 'build': 2}
+
+# Fields of state events that are shown as counters in traces.
+_TRACE_COUNTERS = {
+    'queues': ('fetch_jobs', 'fetch_ready', 'build_jobs', 'build_ready',
+               'retries'),
+    'load': ('load',),
+    'slots': ('build_jobs', 'build_slots'),
+}
+
+
+class EventLog(object):
+  """Write the events of one run to an event log.
+
+  Any existing log at the path is replaced, so that it only holds one run.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self._file = open(path, 'w')
+
+  def Log(self, event, ts, **kwargs):
+    """Append an event to the log.
+
+    Args:
+      event: The name of the event.
+      ts: The time the event happened, in seconds since the epoch.
+      kwargs: Other fields of the event.
+    """
+    kwargs.update(event=event, ts=ts)
+    self._file.write(json.dumps(kwargs, sort_keys=True) + '\n')
+    self._file.flush()
+
+  def Close(self):
+    self._file.close()
+
+
+def ReadEvents(path):
+  """Yield the events in an event log, skipping malformed lines."""
+  with open(path) as f:
+    for line in f:
+      try:
+        yield json.loads(line)
+      except ValueError:
+        continue
+
+
+def ConvertToTrace(events):
+  """Convert events to the Chrome trace event format.
+
+  Each job becomes a complete ("X") event on the lane of the worker that ran
+  it, and state events become counters.
+
+  Args:
+    events: An iterable of events, as returned by ReadEvents.
+
+  Returns:
+    A dict that can be serialized to JSON and loaded into a trace viewer.
+  """
+  trace, started, lanes = [], {}, set()
+  epoch = None
+
+  def Micros(ts):
+    return int((ts - epoch) * 1000000)
+
+  for event in events:
+    name, ts = event['event'], event['ts']
+    if epoch is None:
+      epoch = ts
+
+    if name == 'state':
+      for counter, fields in _TRACE_COUNTERS.iteritems():
+        args = dict((x, event[x]) for x in fields if x in event)
+        if args:
+          trace.append(dict(name=counter, ph='C', ts=Micros(ts), pid=0,
+                            args=args))
+      continue
+
+    kind, _, edge = name.partition('_')
+    if kind not in _TRACE_PIDS:
+      continue
+    key = (kind, event['target'], event['pid'])
+    if edge == 'start':
+      started[key] = ts
+    elif edge == 'end' and key in started:
+      start = started.pop(key)
+      trace.append(dict(name=event['target'], cat=kind, ph='X',
+                        ts=Micros(start), dur=Micros(ts) - Micros(start),
+                        pid=_TRACE_PIDS[kind], tid=event['pid'],
+                        args={'retcode': event.get('retcode')}))
+      lanes.add((kind, event['pid']))
+
+  # Jobs that never finished are shown as running until the end of the log.
+  for (kind, target, pid), start in started.iteritems():
+    trace.append(dict(name=target, cat=kind, ph='X', ts=Micros(start),
+                      dur=Micros(ts) - Micros(start), pid=_TRACE_PIDS[kind],
+                      tid=pid, args={'retcode': None}))
+    lanes.add((kind, pid))
+
+  # Name the processes and worker lanes.
+  for kind, pid in _TRACE_PIDS.iteritems():
+    trace.append(dict(name='process_name', ph='M', pid=pid,
+                      args={'name': '%s workers' % kind}))
+  for kind, pid in sorted(lanes):
+    trace.append(dict(name='thread_name', ph='M', pid=_TRACE_PIDS[kind],
+                      tid=pid, args={'name': '%s worker %s' % (kind, pid)}))
+
+  return {'traceEvents': trace, 'displayTimeUnit': 'ms'}
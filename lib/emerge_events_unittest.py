@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the emerge_events.py module."""
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import cros_test_lib
+from chromite.lib import emerge_events
+
+
+class EventLogTest(cros_test_lib.TempDirTestCase):
+  """Tests for writing and converting event logs."""
+
+  def setUp(self):
+    self.path = os.path.join(self.tempdir, 'events.json')
+
+  def _WriteLog(self):
+    log = emerge_events.EventLog(self.path)
+    log.Log('fetch_start', 100, target='sys-libs/zlib-1.2', pid=10)
+    log.Log('fetch_end', 101, target='sys-libs/zlib-1.2', pid=10, retcode=0)
+    log.Log('build_start', 101, target='sys-libs/zlib-1.2', pid=20)
+    log.Log('state', 101.5, fetch_jobs=0, fetch_ready=0, build_jobs=1,
+            build_ready=0, retries=0, build_slots=4, load=1.5)
+    log.Log('build_end', 103, target='sys-libs/zlib-1.2', pid=20, retcode=1)
+    log.Log('build_start', 103, target='sys-apps/portage-2.1', pid=21)
+    log.Close()
+
+  def testReadEvents(self):
+    """Verify that events are read back in order."""
+    self._WriteLog()
+    with open(self.path, 'a') as f:
+      f.write('{"event": "bui')
+    events = list(emerge_events.ReadEvents(self.path))
+    self.assertEqual([x['event'] for x in events],
+                     ['fetch_start', 'fetch_end', 'build_start', 'state',
+                      'build_end', 'build_start'])
+    self.assertEqual(events[4]['retcode'], 1)
+
+  def testReplaceLog(self):
+    """Verify that a new log replaces the events of the previous run."""
+    self._WriteLog()
+    log = emerge_events.EventLog(self.path)
+    log.Log('build_start', 200, target='sys-libs/zlib-1.2', pid=30)
+    log.Close()
+    events = list(emerge_events.ReadEvents(self.path))
+    self.assertEqual([x['ts'] for x in events], [200])
+
+  def testConvertToTrace(self):
+    """Verify that jobs become complete events on per-worker lanes."""
+    self._WriteLog()
+    trace = emerge_events.ConvertToTrace(emerge_events.ReadEvents(self.path))
+    events = trace['traceEvents']
+    jobs = sorted((x['cat'], x['name'], x['ts'], x['dur'], x['tid'])
+                  for x in events if x['ph'] == 'X')
+    self.assertEqual(jobs, [
+        ('build', 'sys-apps/portage-2.1', 3000000, 0, 21),
+        ('build', 'sys-libs/zlib-1.2', 1000000, 2000000, 20),
+        ('fetch', 'sys-libs/zlib-1.2', 0, 1000000, 10),
+    ])
+    counters = dict((x['name'], x['args']) for x in events if x['ph'] == 'C')
+    self.assertEqual(counters['load'], {'load': 1.5})
+    self.assertEqual(counters['slots'], {'build_jobs': 1, 'build_slots': 4})
+    lanes = [x['args']['name'] for x in events if x['name'] == 'thread_name']
+    self.assertEqual(sorted(lanes), ['build worker 20', 'build worker 21',
+                                     'fetch worker 10'])
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -0,0 +1,162 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Persistent record of how long individual packages took to merge.
+
+parallel_emerge appends an entry to the history every time it finishes a
+merge, and reads the history back to estimate how long packages will take.
+The history is stored as a file of JSON objects, one per line, so that it can
+be appended to cheaply and read without portage being available.
+"""
+
+import json
+import os
+
+from chromite.lib import locking
+from chromite.lib import osutils
+
+# Where the history is stored by default. This can be overridden by setting
+# PARALLEL_EMERGE_HISTORY in the environment.
+DEFAULT_HISTORY_PATH = '/var/cache/parallel_emerge/history.json'
+
+# The number of samples we keep for each (package, board, binary) key when
+# the history is compacted.
+MAX_SAMPLES = 5
+
+
+def GetHistoryPath():
+  """Returns the path to the history file to use."""
+  return os.environ.get('PARALLEL_EMERGE_HISTORY', DEFAULT_HISTORY_PATH)
+
+
+def _Median(values):
+  values = sorted(values)
+  return values[len(values) // 2]
+
+
+class BuildHistory(object):
+  """Read and append per-package merge durations.
+
+  Each entry records:
+    cpv: The full package name (e.g. chromeos-base/chromeos-0.0.1-r60).
+    cp: The package name without the version (e.g. chromeos-base/chromeos).
+    board: The board the package was merged for, or None for the host.
+    binary: Whether the package was installed from a binary package.
+    start: The time the merge started, in seconds since the epoch.
+    seconds: How long the merge took.
+    retcode: The exit code of the merge.
+    rss: The peak resident memory used by the merge in bytes, if known.
+  """
+
+  def __init__(self, path=None):
+    if path is None:
+      path = GetHistoryPath()
+    self.path = path
+    self._entries = None
+
+  def _GetLock(self):
+    """Returns the lock that guards the history file against Compact."""
+    osutils.SafeMakedirs(os.path.dirname(self.path))
+    return locking.FileLock(self.path + '.lock', verbose=False)
+
+  def Record(self, cpv, cp, board, binary, start, seconds, retcode=0,
+             rss=None):
+    """Append an entry to the history file.
+
+    Entries are small, so appending them is atomic with respect to other
+    writers of the history.  Appenders share a read lock, which Compact
+    takes exclusively while it rewrites the file.
+    """
+    entry = dict(cpv=cpv, cp=cp, board=board, binary=bool(binary),
+                 start=start, seconds=seconds, retcode=retcode)
+    if rss is not None:
+      entry['rss'] = rss
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    with self._GetLock() as lock:
+      lock.read_lock()
+      osutils.WriteFile(self.path, line, mode='a')
+    if self._entries is not None:
+      self._entries.append(entry)
+
+  def Load(self):
+    """Returns a list of all entries in the history, oldest first.
+
+    Missing history files are treated as empty, and malformed lines (e.g.
+    from a process that was killed halfway through writing) are skipped.
+    """
+    if self._entries is None:
+      self._entries = []
+      try:
+        f = open(self.path)
+      except IOError:
+        return self._entries
+      with f:
+        for line in f:
+          try:
+            self._entries.append(json.loads(line))
+          except ValueError:
+            continue
+    return self._entries
+
+  def _Summarize(self, board, binary, field, combine):
+    """Returns a dict mapping CPs to a summary of |field| in recent merges.
+
+    Only successful merges of the requested type are considered. Samples from
+    |board| take precedence, but packages that have never been merged for
+    |board| fall back to samples from any board.
+
+    Args:
+      board: The board to look at merges for (None for the host).
+      binary: Whether to look at binary merges or source builds.
+      field: The field of each entry to summarize.
+      combine: Function that reduces a list of recent samples to one value.
+    """
+    samples, fallback = {}, {}
+    for entry in self.Load():
+      if entry.get('retcode') != 0 or entry.get('binary') != binary:
+        continue
+      cp, value = entry['cp'], entry.get(field)
+      if value is None:
+        continue
+      fallback.setdefault(cp, []).append(value)
+      if entry.get('board') == board:
+        samples.setdefault(cp, []).append(value)
+
+    summary = {}
+    for cp, values in fallback.iteritems():
+      values = samples.get(cp, values)
+      summary[cp] = combine(values[-MAX_SAMPLES:])
+    return summary
+
+  def GetDurations(self, board, binary):
+    """Returns a dict mapping CPs to their typical merge time in seconds.
+
+    See _Summarize for how samples are selected.
+    """
+    return self._Summarize(board, binary, 'seconds', _Median)
+
+  def GetPeakMemory(self, board, binary):
+    """Returns a dict mapping CPs to the most memory they recently used.
+
+    See _Summarize for how samples are selected.
+    """
+    return self._Summarize(board, binary, 'rss', max)
+
+  def Compact(self, max_samples=MAX_SAMPLES):
+    """Rewrite the history, keeping only recent entries for each key."""
+    with self._GetLock() as lock:
+      lock.write_lock()
+      # Reload the history, so that entries appended by other processes since
+      # it was loaded aren't lost.
+      self._entries = None
+      kept, counts = [], {}
+      for entry in reversed(self.Load()):
+        key = (entry.get('cp'), entry.get('board'), entry.get('binary'))
+        counts[key] = counts.get(key, 0) + 1
+        if counts[key] <= max_samples:
+          kept.append(entry)
+      kept.reverse()
+      lines = [json.dumps(x, sort_keys=True) + '\n' for x in kept]
+      osutils.WriteFile(self.path, lines, atomic=True)
+      self._entries = kept
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the emerge_history.py module."""
+
+import os
+import select
+import sys
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import cros_test_lib
+from chromite.lib import emerge_history
+from chromite.lib import osutils
+
+
+class BuildHistoryTest(cros_test_lib.TempDirTestCase):
+  """Tests for the BuildHistory class."""
+
+  def setUp(self):
+    self.path = os.path.join(self.tempdir, 'history', 'history.json')
+    self.history = emerge_history.BuildHistory(self.path)
+
+  def _Record(self, cp, seconds, board='x86-generic', binary=False,
+              retcode=0, rss=None):
+    self.history.Record(cp + '-1.0', cp, board, binary, 0, seconds, retcode,
+                        rss=rss)
+
+  def testMissingHistory(self):
+    """Verify that a missing history file is treated as empty."""
+    self.assertEqual(self.history.Load(), [])
+    self.assertEqual(self.history.GetDurations('x86-generic', False), {})
+
+  def testRecordAndReload(self):
+    """Verify that recorded entries can be read back by a new object."""
+    self._Record('sys-libs/zlib', 10)
+    self._Record('sys-libs/zlib', 5, binary=True)
+    history = emerge_history.BuildHistory(self.path)
+    self.assertEqual(len(history.Load()), 2)
+    self.assertEqual(history.GetDurations('x86-generic', False),
+                     {'sys-libs/zlib': 10})
+    self.assertEqual(history.GetDurations('x86-generic', True),
+                     {'sys-libs/zlib': 5})
+
+  def testCorruptLines(self):
+    """Verify that partially written lines are ignored."""
+    self._Record('sys-libs/zlib', 10)
+    osutils.WriteFile(self.path, '{"cp": "sys-libs/', mode='a')
+    history = emerge_history.BuildHistory(self.path)
+    self.assertEqual(len(history.Load()), 1)
+
+  def testDurations(self):
+    """Verify that failures are ignored and boards fall back to each other."""
+    for seconds in (10, 30, 20):
+      self._Record('chromeos-base/chromeos-chrome', seconds)
+    self._Record('chromeos-base/chromeos-chrome', 1000, retcode=1)
+    self._Record('chromeos-base/chromeos-chrome', 99, board='amd64-generic')
+    self._Record('sys-libs/zlib', 7, board='amd64-generic')
+    durations = self.history.GetDurations('x86-generic', False)
+    self.assertEqual(durations, {'chromeos-base/chromeos-chrome': 20,
+                                 'sys-libs/zlib': 7})
+
+  def testPeakMemory(self):
+    """Verify that the largest recent memory usage is reported."""
+    self._Record('chromeos-base/chromeos-chrome', 10, rss=2000)
+    self._Record('chromeos-base/chromeos-chrome', 10, rss=3000)
+    self._Record('chromeos-base/chromeos-chrome', 10, rss=1000)
+    self._Record('sys-libs/zlib', 10)
+    self.assertEqual(self.history.GetPeakMemory('x86-generic', False),
+                     {'chromeos-base/chromeos-chrome': 3000})
+
+  def testCompact(self):
+    """Verify that compaction keeps only the most recent samples."""
+    for seconds in range(10):
+      self._Record('sys-libs/zlib', seconds)
+    self._Record('sys-libs/zlib', 100, board=None)
+    self.history.Compact(max_samples=3)
+    history = emerge_history.BuildHistory(self.path)
+    self.assertEqual([x['seconds'] for x in history.Load()], [7, 8, 9, 100])
+
+  def testCompactKeepsNewEntries(self):
+    """Verify that compaction keeps entries appended by other writers."""
+    self._Record('sys-libs/zlib', 1)
+    self.history.Load()
+    other = emerge_history.BuildHistory(self.path)
+    other.Record('sys-libs/ncurses-1.0', 'sys-libs/ncurses', 'x86-generic',
+                 False, 0, 2)
+    self.history.Compact()
+    history = emerge_history.BuildHistory(self.path)
+    self.assertEqual([x['cp'] for x in history.Load()],
+                     ['sys-libs/zlib', 'sys-libs/ncurses'])
+
+  def testCompactWaitsForLock(self):
+    """Verify that compaction waits for writers holding the lock."""
+    self._Record('sys-libs/zlib', 1)
+    lock = self.history._GetLock()  # pylint: disable=W0212
+    lock.read_lock()
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      try:
+        os.close(reader)
+        emerge_history.BuildHistory(self.path).Compact()
+        os.write(writer, 'x')
+      finally:
+        os._exit(0)
+    os.close(writer)
+    try:
+      # The child can't compact while we hold the lock.
+      self.assertEqual(select.select([reader], [], [], 0.5)[0], [])
+    finally:
+      lock.close()
+      self.assertEqual(os.read(reader, 1), 'x')
+      os.waitpid(pid, 0)
+      os.close(reader)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
@@ -0,0 +1,232 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Archive holding the output of every package merged by parallel_emerge.
+
+Rather than writing a temporary file for each package, parallel_emerge sends
+the output of its merges to a single process, which compresses the output of
+each package as it arrives and appends it to one archive file.
+
+The archive is a sequence of records, each consisting of a header (the record
+type, the id of the log it belongs to, and the length of the payload)
+followed by the payload:
+  OPEN: Starts a new log. The payload is the name of the log.
+  DATA: A chunk of the zlib stream holding the log's contents.
+  FINISH: Marks the log as complete. The payload is empty.
+Records of different logs are interleaved, but the DATA records of each log
+concatenate into a single zlib stream. Logs that were still being written when
+the archive was closed can still be read, up to the last flushed record.
+"""
+
+import errno
+import os
+import select
+import struct
+import time
+import zlib
+
+# The record header: type, log id, and payload length.
+_HEADER = struct.Struct('!BII')
+_OPEN, _DATA, _FINISH = range(3)
+
+# How many bytes of the most recent output of each log to keep in memory, for
+# answering Tail() queries.
+TAIL_SIZE = 4096
+
+# How often, in seconds, to check whether a merge process has exited while it
+# is quiet.
+_POLL_INTERVAL = 0.1
+# How long to keep forwarding output once a merge process has exited.
+_DRAIN_TIMEOUT = 1
+
+
+class _Log(object):
+  """The state of a single log in the archive."""
+
+  __slots__ = ('log_id', 'compressor', 'records', 'tail')
+
+  def __init__(self, log_id):
+    self.log_id = log_id
+    self.compressor = zlib.compressobj()
+    # The offset and length of each DATA record of this log.
+    self.records = []
+    self.tail = ''
+
+
+class LogArchive(object):
+  """Write the output of many packages to one compressed archive."""
+
+  def __init__(self, path, tail_size=TAIL_SIZE):
+    self.path = path
+    self._file = open(path, 'wb')
+    self._tail_size = tail_size
+    self._logs = {}
+
+  def _AddRecord(self, kind, log_id, payload=''):
+    """Append a record to the archive, returning the offset of the payload."""
+    offset = self._file.tell() + _HEADER.size
+    self._file.write(_HEADER.pack(kind, log_id, len(payload)) + payload)
+    return offset
+
+  def _GetLog(self, name):
+    """Look up the log called name, starting it if necessary."""
+    log = self._logs.get(name)
+    if log is None:
+      log = self._logs[name] = _Log(len(self._logs))
+      self._AddRecord(_OPEN, log.log_id, name.encode('utf-8'))
+    return log
+
+  def _AddData(self, log, data):
+    if data:
+      offset = self._AddRecord(_DATA, log.log_id, data)
+      log.records.append((offset, len(data)))
+
+  def Write(self, name, data):
+    """Append data to the log called name."""
+    log = self._GetLog(name)
+    if log.compressor is None:
+      raise ValueError('Log %s has already been finished' % name)
+    self._AddData(log, log.compressor.compress(data))
+    log.tail = (log.tail + data)[-self._tail_size:]
+
+  def Finish(self, name):
+    """Mark the log called name as complete."""
+    log = self._GetLog(name)
+    if log.compressor is not None:
+      self._AddData(log, log.compressor.flush(zlib.Z_FINISH))
+      self._AddRecord(_FINISH, log.log_id)
+      log.compressor = None
+      log.tail = ''
+
+  def IsFinished(self, name):
+    """Returns whether the log called name has been finished."""
+    log = self._logs.get(name)
+    return log is not None and log.compressor is None
+
+  def Read(self, name):
+    """Returns the contents of the log called name so far."""
+    log = self._logs.get(name)
+    if log is None:
+      return ''
+    if log.compressor is not None:
+      self._AddData(log, log.compressor.flush(zlib.Z_SYNC_FLUSH))
+    self._file.flush()
+
+    decompressor = zlib.decompressobj()
+    chunks = []
+    with open(self.path, 'rb') as f:
+      for offset, length in log.records:
+        f.seek(offset)
+        chunks.append(decompressor.decompress(f.read(length)))
+    return ''.join(chunks)
+
+  def Tail(self, name, lines=1):
+    """Returns the last few lines that were written to a running log.
+
+    Only lines that were written recently are available, so fewer lines may
+    be returned than were asked for.
+    """
+    log = self._logs.get(name)
+    if log is None or not log.tail:
+      return []
+    # Only show the last update of lines that are redrawn (e.g. progress
+    # bars).
+    tail = log.tail.rstrip('\n').split('\n')[-lines:]
+    return [x.rstrip('\r').rpartition('\r')[2] for x in tail]
+
+  def Close(self):
+    """Close the archive. Unfinished logs are left as they are."""
+    for log in self._logs.itervalues():
+      if log.compressor is not None:
+        self._AddData(log, log.compressor.flush(zlib.Z_SYNC_FLUSH))
+    self._file.close()
+
+
+def ReadLogs(path):
+  """Read all of the logs in an archive.
+
+  A truncated record at the end of the archive (e.g. because parallel_emerge
+  was killed while writing it) is ignored.
+
+  Yields:
+    Tuples of (name, contents, finished), in the order the logs were started.
+  """
+  names, decompressors, chunks, finished = [], {}, {}, set()
+  with open(path, 'rb') as f:
+    while True:
+      header = f.read(_HEADER.size)
+      if len(header) < _HEADER.size:
+        break
+      kind, log_id, length = _HEADER.unpack(header)
+      payload = f.read(length)
+      if len(payload) < length:
+        break
+      if kind == _OPEN:
+        names.append((log_id, payload.decode('utf-8')))
+        decompressors[log_id] = zlib.decompressobj()
+        chunks[log_id] = []
+      elif kind == _DATA:
+        try:
+          chunks[log_id].append(decompressors[log_id].decompress(payload))
+        except zlib.error:
+          break
+      elif kind == _FINISH:
+        finished.add(log_id)
+
+  for log_id, name in names:
+    yield name, ''.join(chunks[log_id]), log_id in finished
+
+
+def _RetryOnEintr(func, *args):
+  """Call func(*args), retrying if it is interrupted by a signal."""
+  while True:
+    try:
+      return func(*args)
+    except (OSError, select.error) as ex:
+      if ex.args[0] != errno.EINTR:
+        raise
+
+
+def ForwardOutput(pid, fd, write, drain_timeout=_DRAIN_TIMEOUT):
+  """Forward the output of a merge process until it exits.
+
+  Daemons and other background processes started by the merge may hold the
+  pipe open long after the merge has exited, so we don't wait for the pipe to
+  be closed. Once the merge process has exited, output is forwarded for at
+  most drain_timeout more seconds.
+
+  Args:
+    pid: The pid of the merge process, a child of this process.
+    fd: The read end of the pipe holding its output. It is closed on return.
+    write: Function to call with each chunk of output.
+    drain_timeout: How long to keep forwarding output after the merge process
+      has exited.
+
+  Returns:
+    The wait status of the merge process.
+  """
+  status = deadline = None
+  try:
+    while True:
+      timeout = _POLL_INTERVAL
+      if deadline is not None:
+        timeout = max(0, deadline - time.time())
+      readable = _RetryOnEintr(select.select, [fd], [], [], timeout)[0]
+      if readable:
+        data = _RetryOnEintr(os.read, fd, 65536)
+        if not data:
+          break
+        write(data)
+      if status is None:
+        reaped, wait_status = _RetryOnEintr(os.waitpid, pid, os.WNOHANG)
+        if reaped:
+          status = wait_status
+          deadline = time.time() + drain_timeout
+      elif time.time() >= deadline:
+        break
+  finally:
+    os.close(fd)
+  if status is None:
+    status = _RetryOnEintr(os.waitpid, pid, 0)[1]
+  return status
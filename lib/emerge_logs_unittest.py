@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the emerge_logs.py module."""
+
+import os
+import signal
+import subprocess
+import sys
+import time
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import cros_test_lib
+from chromite.lib import emerge_logs
+from chromite.lib import osutils
+
+
+class LogArchiveTest(cros_test_lib.TempDirTestCase):
+  """Tests for the LogArchive class."""
+
+  def setUp(self):
+    self.path = os.path.join(self.tempdir, 'logs')
+    self.logs = emerge_logs.LogArchive(self.path)
+
+  def testInterleaved(self):
+    """Verify interleaved output of several logs is kept apart."""
+    self.logs.Write('build/a', 'a1\n')
+    self.logs.Write('build/b', 'b1\n')
+    self.logs.Write('build/a', 'a2\n')
+    self.logs.Finish('build/a')
+    self.assertTrue(self.logs.IsFinished('build/a'))
+    self.assertFalse(self.logs.IsFinished('build/b'))
+    self.assertEqual(self.logs.Read('build/a'), 'a1\na2\n')
+    self.assertEqual(self.logs.Read('build/b'), 'b1\n')
+
+    # Logs that are still running can be read repeatedly.
+    self.logs.Write('build/b', 'b2\n')
+    self.assertEqual(self.logs.Read('build/b'), 'b1\nb2\n')
+    self.assertEqual(self.logs.Read('missing'), '')
+
+  def testFinishEmpty(self):
+    """Verify logs can be finished without any output."""
+    self.logs.Finish('build/a')
+    self.assertTrue(self.logs.IsFinished('build/a'))
+    self.assertEqual(self.logs.Read('build/a'), '')
+    self.assertRaises(ValueError, self.logs.Write, 'build/a', 'late')
+
+  def testTail(self):
+    """Verify the last lines of running logs are available."""
+    self.assertEqual(self.logs.Tail('build/a'), [])
+    self.logs.Write('build/a', 'one\ntwo\n')
+    self.logs.Write('build/a', 'fetching 10%\rfetching 20%\n')
+    self.assertEqual(self.logs.Tail('build/a', lines=2),
+                     ['two', 'fetching 20%'])
+
+  def testReadLogs(self):
+    """Verify archives can be read back, even if they are truncated."""
+    self.logs.Write('build/a', 'a' * 100000)
+    self.logs.Finish('build/a')
+    self.logs.Write('fetch/b', 'b\n')
+    self.logs.Close()
+    self.assertEqual(list(emerge_logs.ReadLogs(self.path)),
+                     [('build/a', 'a' * 100000, True),
+                      ('fetch/b', 'b\n', False)])
+
+    data = osutils.ReadFile(self.path)
+    osutils.WriteFile(self.path, data[:-2])
+    self.assertEqual([x[0] for x in emerge_logs.ReadLogs(self.path)],
+                     ['build/a', 'fetch/b'])
+
+
+class ForwardOutputTest(cros_test_lib.TestCase):
+  """Tests for the ForwardOutput function."""
+
+  def _Fork(self, child):
+    """Run child() in a subprocess writing to a pipe, and forward its output.
+
+    Returns:
+      A tuple of (wait status, output).
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(read_fd)
+      os.dup2(write_fd, 1)
+      try:
+        child()
+      finally:
+        os._exit(3)
+    os.close(write_fd)
+    output = []
+    status = emerge_logs.ForwardOutput(pid, read_fd, output.append,
+                                       drain_timeout=0.2)
+    return status, ''.join(output)
+
+  def testForwardOutput(self):
+    """Verify all of the output and the exit status are returned."""
+    def _Child():
+      os.write(1, 'a' * 100000)
+      os.write(1, 'b\n')
+    status, output = self._Fork(_Child)
+    self.assertEqual(os.WEXITSTATUS(status), 3)
+    self.assertEqual(output, 'a' * 100000 + 'b\n')
+
+  def testBackgroundProcess(self):
+    """Verify we don't wait for background processes holding the pipe."""
+    def _Child():
+      proc = subprocess.Popen(['sleep', '30'])
+      os.write(1, '%d\n' % proc.pid)
+    start = time.time()
+    status, output = self._Fork(_Child)
+    os.kill(int(output), signal.SIGKILL)
+    self.assertTrue(time.time() - start < 10)
+    self.assertEqual(os.WEXITSTATUS(status), 3)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
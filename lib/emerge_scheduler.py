@@ -0,0 +1,369 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Scheduling policy used by parallel_emerge, and a simulator for it.
+
+Nothing in this module depends on portage, so scheduler changes can be
+evaluated offline: Simulate() replays the policy that parallel_emerge uses to
+pick the next package to build against a dependency graph (either one saved
+by parallel_emerge, or one made by GenerateGraph) with a fixed number of
+virtual build slots.
+
+A dependency graph (deps_map) is a dict mapping packages to dicts with:
+  needs: A dict whose keys are the packages this package needs first.
+  provides: The set of packages that need this package.
+  tprovides: The set of packages that need this package, directly or not.
+  action: "merge" or "nomerge".
+  binary: Whether the package is installed from a binary package.
+  nodeps: Whether the package can be merged before its dependencies.
+  idx: The position of the package in emerge's install list.
+"""
+
+import heapq
+import math
+import random
+
+# Estimated number of seconds it takes to merge a package when we have no
+# better information about it. Used for critical path scheduling.
+DEFAULT_SOURCE_SECONDS = 60
+DEFAULT_BINARY_SECONDS = 5
+
+
+def EstimateSeconds(deps_map, pkg, durations):
+  """Estimate how many seconds it will take to merge pkg.
+
+  Args:
+    deps_map: The dependency graph.
+    pkg: The package to estimate.
+    durations: A dict mapping packages to the number of seconds they are
+      expected to take to merge. Packages that aren't listed are estimated
+      based on whether they are binary packages or not.
+  """
+  info = deps_map[pkg]
+  if info['action'] == 'nomerge':
+    return 0
+  seconds = durations.get(pkg)
+  if seconds is None:
+    if info['binary']:
+      seconds = DEFAULT_BINARY_SECONDS
+    else:
+      seconds = DEFAULT_SOURCE_SECONDS
+  return seconds
+
+
+def _AnnotateLongestPaths(deps_map, edges, field, weight):
+  """Annotate each package with the weight of the longest path from it.
+
+  Args:
+    deps_map: The dependency graph. Must be acyclic.
+    edges: The field of each package listing the packages it leads to (e.g.
+      "needs" or "provides").
+    field: The field to store the result in.
+    weight: A function returning the weight of a package.
+  """
+  # Walk the graph in post-order without recursing, so that long chains of
+  # dependencies don't hit the Python recursion limit.
+  for root in deps_map:
+    if field in deps_map[root]:
+      continue
+    stack = [(root, False)]
+    while stack:
+      pkg, expanded = stack.pop()
+      info = deps_map[pkg]
+      if field in info:
+        continue
+      if expanded:
+        longest = max([deps_map[x][field] for x in info[edges]] or [0])
+        info[field] = weight(pkg) + longest
+      else:
+        stack.append((pkg, True))
+        stack.extend((x, False) for x in info[edges]
+                     if field not in deps_map[x])
+
+
+def CalculateCriticalPaths(deps_map, durations=None):
+  """Annotate each package with the length of its critical path.
+
+  The critical path of a package is the weighted length of the longest chain
+  of packages that cannot start until that package has been merged, including
+  the package itself. Starting the package with the longest critical path
+  first keeps the long poles of the build from starting late.
+
+  The result is stored in the "cpath" field of each entry in deps_map, which
+  TargetState uses to prioritize packages.
+
+  Args:
+    deps_map: The dependency graph. Must be acyclic.
+    durations: A dict mapping packages to the number of seconds they are
+      expected to take to merge. See EstimateSeconds.
+  """
+  durations = durations or {}
+  _AnnotateLongestPaths(deps_map, 'provides', 'cpath',
+                        lambda pkg: EstimateSeconds(deps_map, pkg, durations))
+
+
+def CalculateEarliestStarts(deps_map, durations=None):
+  """Annotate each package with the earliest time it could start merging.
+
+  This is the weighted length of the longest chain of packages that must be
+  merged before this one, and is stored in the "estart" field of each entry
+  in deps_map. TargetState uses it to fetch packages in roughly the order
+  that the build will need them.
+
+  Args:
+    deps_map: The dependency graph. Must be acyclic.
+    durations: A dict mapping packages to the number of seconds they are
+      expected to take to merge. See EstimateSeconds.
+  """
+  durations = durations or {}
+  weight = lambda pkg: EstimateSeconds(deps_map, pkg, durations)
+  _AnnotateLongestPaths(deps_map, 'needs', 'estart', weight)
+  for pkg, info in deps_map.iteritems():
+    info['estart'] -= weight(pkg)
+
+
+class TargetState(object):
+
+  __slots__ = ('target', 'info', 'score', 'fetch_score', 'prefetched',
+               'fetched_successfully')
+
+  def __init__(self, target, info):
+    self.target, self.info = target, info
+    self.fetched_successfully = False
+    self.prefetched = False
+    self.score = self.fetch_score = None
+    self.update_score()
+
+  def __cmp__(self, other):
+    return cmp(self.score, other.score)
+
+  def update_score(self):
+    self.score = (
+        -self.info.get('cpath', 0),
+        -len(self.info['tprovides']),
+        len(self.info['needs']),
+        not self.info['binary'],
+        -len(self.info['provides']),
+        self.info['idx'],
+        self.target,
+        )
+    # Fetch packages that are ready to be built first, then the packages
+    # that the build is likely to reach soonest.
+    self.fetch_score = (
+        bool(self.info['needs']),
+        self.info.get('estart', 0),
+        -self.info.get('cpath', 0),
+        -len(self.info['tprovides']),
+        self.info['idx'],
+        self.target,
+        )
+
+
+class ScoredHeap(object):
+  """A heap of TargetStates, ordered by one of their score attributes.
+
+  Scores are looked up when items are added, so sort() must be called after
+  updating the scores of items in the heap.
+  """
+
+  __slots__ = ('heap', '_heap_set', '_key')
+
+  def __init__(self, initial=(), key='score'):
+    self.heap = list()
+    self._heap_set = set()
+    self._key = key
+    if initial:
+      self.multi_put(initial)
+
+  def get(self):
+    _, item = heapq.heappop(self.heap)
+    self._heap_set.remove(item.target)
+    return item
+
+  def peek(self):
+    return self.heap[0][1]
+
+  def put(self, item):
+    if not isinstance(item, TargetState):
+      raise ValueError("Item %r isn't a TargetState" % (item,))
+    heapq.heappush(self.heap, (getattr(item, self._key), item))
+    self._heap_set.add(item.target)
+
+  def multi_put(self, sequence):
+    sequence = list(sequence)
+    self.heap.extend((getattr(x, self._key), x) for x in sequence)
+    self._heap_set.update(x.target for x in sequence)
+    self.sort()
+
+  def sort(self):
+    self.heap = [(getattr(x, self._key), x) for _, x in self.heap]
+    heapq.heapify(self.heap)
+
+  def __contains__(self, target):
+    return target in self._heap_set
+
+  def __nonzero__(self):
+    return bool(self.heap)
+
+  def __len__(self):
+    return len(self.heap)
+
+
+class SimulationResult(object):
+  """The outcome of a simulated build.
+
+  Attributes:
+    slots: The number of build slots that were simulated.
+    makespan: How many seconds the whole build took.
+    work: The total number of seconds spent merging packages.
+    critical_path: The weighted length of the longest chain of dependencies.
+      No schedule can finish faster than this.
+  """
+
+  __slots__ = ('slots', 'makespan', 'work', 'critical_path')
+
+  def __init__(self, slots, makespan, work, critical_path):
+    self.slots = slots
+    self.makespan = makespan
+    self.work = work
+    self.critical_path = critical_path
+
+  @property
+  def lower_bound(self):
+    """The fastest any schedule could merge the graph with our slots."""
+    return max(self.critical_path, float(self.work) / self.slots)
+
+  @property
+  def utilization(self):
+    """The fraction of slot time that was spent merging packages."""
+    if not self.makespan:
+      return 1.0
+    return float(self.work) / (self.slots * self.makespan)
+
+  @property
+  def efficiency(self):
+    """How close the makespan came to the lower bound (1.0 is optimal)."""
+    if not self.makespan:
+      return 1.0
+    return float(self.lower_bound) / self.makespan
+
+
+def Simulate(deps_map, durations=None, slots=1, critical_path=False):
+  """Replay the parallel_emerge scheduling policy against a graph.
+
+  Packages are assumed to take exactly as long as their estimated duration,
+  and fetches are assumed to be instantaneous, so the result shows how well
+  the build queue is ordered rather than how fast the network is. The load
+  average and memory budget are not modelled.
+
+  Args:
+    deps_map: The dependency graph. Must be acyclic. It is not modified.
+    durations: A dict mapping packages to the number of seconds they take to
+      merge. See EstimateSeconds.
+    slots: The number of packages that can be merged at once.
+    critical_path: Whether to prioritize packages by their critical path, as
+      parallel_emerge --critical-path does.
+
+  Returns:
+    A SimulationResult.
+  """
+  durations = durations or {}
+
+  # Copy the parts of the graph that the scheduler modifies.
+  deps_map = dict((pkg, dict(info, needs=dict(info['needs'])))
+                  for pkg, info in deps_map.iteritems())
+  for info in deps_map.itervalues():
+    info.pop('cpath', None)
+    info.pop('estart', None)
+  if critical_path:
+    CalculateCriticalPaths(deps_map, durations)
+  CalculateEarliestStarts(deps_map, durations)
+  weight = lambda pkg: EstimateSeconds(deps_map, pkg, durations)
+  longest = max([info['estart'] + weight(pkg)
+                 for pkg, info in deps_map.iteritems()] or [0])
+
+  state_map = dict((pkg, TargetState(pkg, info))
+                   for pkg, info in deps_map.iteritems())
+  ready = ScoredHeap(x for x in state_map.itervalues() if not x.info['needs'])
+
+  def Finish(target):
+    # This mirrors EmergeQueue._Finish, with every package already fetched.
+    this_pkg = deps_map[target]
+    if this_pkg['needs'] and this_pkg['nodeps']:
+      this_pkg['action'] = 'nomerge'
+      return
+    for dep in this_pkg['provides']:
+      dep_pkg = deps_map[dep]
+      del dep_pkg['needs'][target]
+      state_map[dep].update_score()
+      if not dep_pkg['needs']:
+        if dep_pkg['nodeps'] and dep_pkg['action'] == 'nomerge':
+          Finish(dep)
+        else:
+          ready.put(state_map[dep])
+    del deps_map[target]
+
+  running, now, work = [], 0, 0
+  while deps_map:
+    while ready and len(running) < slots:
+      state = ready.get()
+      if state.info['action'] == 'nomerge':
+        Finish(state.target)
+        continue
+      seconds = weight(state.target)
+      heapq.heappush(running, (now + seconds, state.target))
+      work += seconds
+
+    if not running:
+      raise ValueError('Deadlock! Circular dependencies!')
+    now, target = heapq.heappop(running)
+    Finish(target)
+
+  return SimulationResult(slots, now, work, longest)
+
+
+def GenerateGraph(packages, seed=None, max_needs=3, window=200,
+                  binary_fraction=0.5):
+  """Generate a synthetic dependency graph, with durations.
+
+  Each package needs up to max_needs packages chosen from the window
+  packages before it, which gives long chains of dependencies similar to
+  real builds. Durations are drawn from a log-normal distribution, so that a
+  few packages take much longer than the rest.
+
+  Args:
+    packages: The number of packages in the graph.
+    seed: Seed for the random number generator, for reproducible graphs.
+    max_needs: The most packages any package needs.
+    window: How far back in the graph dependencies are chosen from.
+    binary_fraction: The fraction of packages installed from binaries.
+
+  Returns:
+    A tuple (deps_map, durations).
+  """
+  rand = random.Random(seed)
+  names = ['synthetic/pkg%d-1.0' % i for i in xrange(packages)]
+  deps_map, durations = {}, {}
+  for i, pkg in enumerate(names):
+    binary = rand.random() < binary_fraction
+    candidates = names[max(0, i - window):i]
+    needs = rand.sample(candidates, min(len(candidates),
+                                        rand.randint(0, max_needs)))
+    deps_map[pkg] = {'needs': dict((x, 'buildtime') for x in needs),
+                     'provides': set(), 'action': 'merge', 'binary': binary,
+                     'nodeps': False, 'idx': i}
+    for dep in needs:
+      deps_map[dep]['provides'].add(pkg)
+    mean = math.log(DEFAULT_BINARY_SECONDS if binary else
+                    DEFAULT_SOURCE_SECONDS)
+    durations[pkg] = max(1, int(rand.lognormvariate(mean, 1)))
+
+  # Packages only provide packages that come after them, so walk backwards.
+  for pkg in reversed(names):
+    info = deps_map[pkg]
+    info['tprovides'] = info['provides'].copy()
+    for dep in info['provides']:
+      info['tprovides'].update(deps_map[dep]['tprovides'])
+
+  return deps_map, durations
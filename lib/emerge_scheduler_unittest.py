@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Unittests for the emerge_scheduler.py module."""
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+
+from chromite.lib import cros_test_lib
+from chromite.lib import emerge_scheduler
+
+
+def _MakeGraph(edges, binary=()):
+  """Make a dependency graph from a dict mapping packages to their needs."""
+  deps_map = {}
+  for idx, pkg in enumerate(sorted(edges)):
+    deps_map[pkg] = {'needs': dict((x, 'buildtime') for x in edges[pkg]),
+                     'provides': set(), 'action': 'merge',
+                     'binary': pkg in binary, 'nodeps': False, 'idx': idx}
+  for pkg, needs in edges.iteritems():
+    for dep in needs:
+      deps_map[dep]['provides'].add(pkg)
+  for pkg in deps_map:
+    tprovides, pending = set(), list(deps_map[pkg]['provides'])
+    while pending:
+      dep = pending.pop()
+      if dep not in tprovides:
+        tprovides.add(dep)
+        pending.extend(deps_map[dep]['provides'])
+    deps_map[pkg]['tprovides'] = tprovides
+  return deps_map
+
+
+class LongestPathTest(cros_test_lib.TestCase):
+  """Tests for CalculateCriticalPaths and CalculateEarliestStarts."""
+
+  def setUp(self):
+    # a -> b -> d, a -> c -> d, where c takes much longer than b.
+    self.deps_map = _MakeGraph({'a': [], 'b': ['a'], 'c': ['a'],
+                                'd': ['b', 'c']}, binary=['b'])
+    self.durations = {'a': 10, 'c': 100, 'd': 1}
+
+  def testCriticalPaths(self):
+    """Verify critical paths follow the slowest chain of dependents."""
+    emerge_scheduler.CalculateCriticalPaths(self.deps_map, self.durations)
+    cpaths = dict((k, v['cpath']) for k, v in self.deps_map.iteritems())
+    default = emerge_scheduler.DEFAULT_BINARY_SECONDS
+    self.assertEqual(cpaths, {'a': 111, 'b': default + 1, 'c': 101, 'd': 1})
+
+  def testEarliestStarts(self):
+    """Verify packages can't start before their slowest dependency chain."""
+    emerge_scheduler.CalculateEarliestStarts(self.deps_map, self.durations)
+    estarts = dict((k, v['estart']) for k, v in self.deps_map.iteritems())
+    self.assertEqual(estarts, {'a': 0, 'b': 10, 'c': 10, 'd': 110})
+
+  def testNomerge(self):
+    """Verify packages that aren't merged take no time."""
+    self.deps_map['c']['action'] = 'nomerge'
+    emerge_scheduler.CalculateCriticalPaths(self.deps_map, self.durations)
+    self.assertEqual(self.deps_map['c']['cpath'], 1)
+
+
+class ScoredHeapTest(cros_test_lib.TestCase):
+  """Tests for the ScoredHeap class."""
+
+  def testOrdering(self):
+    """Verify items come out in score order, and sort() picks up changes."""
+    deps_map = _MakeGraph({'a': [], 'b': [], 'c': []})
+    states = dict((k, emerge_scheduler.TargetState(k, v))
+                  for k, v in deps_map.iteritems())
+    heap = emerge_scheduler.ScoredHeap(states.itervalues())
+    self.assertEqual(len(heap), 3)
+    self.assertTrue('b' in heap)
+    self.assertEqual(heap.peek().target, 'a')
+
+    deps_map['c']['cpath'] = 100
+    states['c'].update_score()
+    heap.sort()
+    self.assertEqual([heap.get().target for _ in range(3)], ['c', 'a', 'b'])
+    self.assertFalse(heap)
+
+  def testRejectsOtherItems(self):
+    """Verify only TargetStates can be added."""
+    heap = emerge_scheduler.ScoredHeap()
+    self.assertRaises(ValueError, heap.put, 'a')
+
+
+class SimulateTest(cros_test_lib.TestCase):
+  """Tests for Simulate."""
+
+  def testSerial(self):
+    """Verify a single slot takes as long as all the work together."""
+    deps_map = _MakeGraph({'a': [], 'b': ['a'], 'c': []})
+    durations = {'a': 3, 'b': 4, 'c': 5}
+    result = emerge_scheduler.Simulate(deps_map, durations, slots=1)
+    self.assertEqual(result.makespan, 12)
+    self.assertEqual(result.work, 12)
+    self.assertEqual(result.utilization, 1.0)
+
+  def testCriticalPath(self):
+    """Verify critical path scheduling starts long chains first."""
+    # 'x' sorts first by default, but 'a' -> 'b' is the long pole.
+    deps_map = _MakeGraph({'a': [], 'b': ['a'], 'x': [], 'y': []})
+    deps_map['a']['idx'] = 3
+    durations = {'a': 10, 'b': 10, 'x': 10, 'y': 10}
+    default = emerge_scheduler.Simulate(deps_map, durations, slots=2)
+    cpath = emerge_scheduler.Simulate(deps_map, durations, slots=2,
+                                      critical_path=True)
+    self.assertEqual(cpath.makespan, 20)
+    self.assertEqual(cpath.critical_path, 20)
+    self.assertEqual(cpath.efficiency, 1.0)
+    self.assertTrue(default.makespan >= cpath.makespan)
+
+  def testUnmodified(self):
+    """Verify the graph passed in is left alone."""
+    deps_map = _MakeGraph({'a': [], 'b': ['a']})
+    emerge_scheduler.Simulate(deps_map, slots=2, critical_path=True)
+    self.assertEqual(deps_map['b']['needs'], {'a': 'buildtime'})
+    self.assertFalse('cpath' in deps_map['a'])
+
+  def testSyntheticGraph(self):
+    """Verify synthetic graphs are reproducible and can be simulated."""
+    deps_map, durations = emerge_scheduler.GenerateGraph(200, seed=1)
+    again, _ = emerge_scheduler.GenerateGraph(200, seed=1)
+    self.assertEqual(deps_map, again)
+    self.assertEqual(len(deps_map), 200)
+    for slots in (1, 8):
+      result = emerge_scheduler.Simulate(deps_map, durations, slots=slots)
+      self.assertEqual(result.work, sum(durations.values()))
+      self.assertTrue(result.makespan >= result.lower_bound)
+      self.assertTrue(0 < result.efficiency <= 1)
+
+
+if __name__ == '__main__':
+  cros_test_lib.main()
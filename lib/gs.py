@@ -7,6 +7,8 @@
 
 import logging
 import os
+import subprocess
+import tempfile
 
 from chromite.buildbot import constants
 from chromite.lib import cache
@@ -71,6 +73,50 @@ class GSNoSuchKey(GSContextException):
   """Thrown when google storage returns code=NoSuchKey."""
 
 
+class GSStream(object):
+  """A read-only file object for a GS object, as gsutil downloads it.
+
+  Once all of the object has been read, the exit status of gsutil is checked,
+  so a failed download raises an exception rather than looking like a short
+  object.
+  """
+
+  def __init__(self, cmd, path, env):
+    self.name = path
+    self._stderr = tempfile.TemporaryFile()
+    self._proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                  stderr=self._stderr, env=env, close_fds=True)
+
+  def read(self, size=-1):
+    data = self._proc.stdout.read(size)
+    if not data and size:
+      self._CheckExit()
+    return data
+
+  def _CheckExit(self):
+    if self._proc.wait():
+      self._stderr.seek(0)
+      error = self._stderr.read()
+      msg = 'Failed to download %s:\n%s' % (self.name, error)
+      if 'code=NoSuchKey' in error:
+        raise GSNoSuchKey(msg)
+      raise GSContextException(msg)
+
+  def close(self):
+    """Stop the download, if it hasn't finished."""
+    if self._proc.poll() is None:
+      self._proc.terminate()
+      self._proc.wait()
+    self._proc.stdout.close()
+    self._stderr.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, _type, _value, _traceback):
+    self.close()
+
+
 class GSContext(object):
   """A class to wrap common google storage operations."""
 
@@ -206,6 +252,17 @@ class GSContext(object):
     """Returns the contents of a GS object."""
     return self._DoCommand(['cat', path], redirect_stdout=True)
 
+  def Open(self, path):
+    """Returns a GSStream that reads a GS object as it is downloaded.
+
+    Unlike the other commands, reading the stream can't be retried.
+    """
+    cmd = [self.gsutil_bin, 'cat', path]
+    logging.debug('%s: streaming %r', self.__class__.__name__, cmd)
+    env = os.environ.copy()
+    env['BOTO_CONFIG'] = self.boto_file
+    return GSStream(cmd, path, env)
+
   def CopyInto(self, local_path, remote_dir, filename=None, acl=None,
                version=None):
     """Upload a local file into a directory in google storage.
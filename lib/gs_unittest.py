@@ -315,5 +315,40 @@ detail=A nonempty x-goog-project-id header is required for this request."""
     self.assertRaises(gs.GSContextException, self.ctx._InitBoto)
 
 
+class OpenTest(cros_test_lib.TempDirTestCase):
+  """Tests for streaming GS objects with GSContext.Open."""
+
+  def _GetContext(self, script):
+    gsutil = os.path.join(self.tempdir, 'gsutil')
+    osutils.WriteFile(gsutil, '#!/bin/sh\n%s\n' % script)
+    os.chmod(gsutil, 0755)
+    boto_file = os.path.join(self.tempdir, 'boto')
+    osutils.Touch(boto_file)
+    return gs.GSContext(boto_file=boto_file, gsutil_bin=gsutil)
+
+  def testRead(self):
+    """Verify the object is read as gsutil writes it."""
+    ctx = self._GetContext('echo "$1 $2 $BOTO_CONFIG"')
+    with ctx.Open('gs://abc/1') as stream:
+      self.assertEqual(stream.name, 'gs://abc/1')
+      self.assertEqual(stream.read(),
+                       'cat gs://abc/1 %s\n' % ctx.boto_file)
+
+  def testFailure(self):
+    """Verify a failed download raises once the stream is read."""
+    ctx = self._GetContext('echo partial; echo "code=NoSuchKey" >&2; exit 1')
+    with ctx.Open('gs://abc/1') as stream:
+      self.assertEqual(stream.read(4), 'part')
+      self.assertEqual(stream.read(), 'ial\n')
+      self.assertRaises(gs.GSNoSuchKey, stream.read)
+
+  def testClose(self):
+    """Verify closing the stream early stops the download."""
+    ctx = self._GetContext('while :; do echo data; done')
+    stream = ctx.Open('gs://abc/1')
+    self.assertEqual(stream.read(5), 'data\n')
+    stream.close()
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -13,6 +13,10 @@ import tempfile
 from chromite.lib import cros_build_lib
 
 
+class LockNotAcquiredError(Exception):
+  """Signals that a lock could not be acquired without blocking."""
+
+
 class _Lock(cros_build_lib.MasterPidContextManager):
 
   """Base lockf based locking.  Derivatives need to override _GetFd"""
@@ -42,7 +46,7 @@ class _Lock(cros_build_lib.MasterPidContextManager):
   def _GetFd(self):
     raise NotImplementedError(self, '_GetFd')
 
-  def _enforce_lock(self, flags, message):
+  def _enforce_lock(self, flags, message, blocking=True):
     # Try nonblocking first, if it fails, display the context/message,
     # and then wait on the lock.
     try:
@@ -51,8 +55,10 @@ class _Lock(cros_build_lib.MasterPidContextManager):
     except EnvironmentError as e:
       if e.errno == errno.EDEADLOCK:
         self.unlock()
-      elif e.errno != errno.EAGAIN:
+      elif e.errno not in (errno.EAGAIN, errno.EACCES):
         raise
+    if not blocking:
+      raise LockNotAcquiredError(self.description or self)
     if self.description:
       message = '%s: blocking while %s' % (self.description, message)
     if self._verbose:
@@ -65,21 +71,23 @@ class _Lock(cros_build_lib.MasterPidContextManager):
       self.unlock()
       fcntl.lockf(self.fd, flags)
 
-  def read_lock(self, message="taking read lock"):
+  def read_lock(self, message="taking read lock", blocking=True):
     """
     Take a read lock (shared), downgrading from write if required.
 
     Args:
       message: A description of what/why this lock is being taken.
+      blocking: If False, don't wait for the lock if someone else holds it.
     Returns:
       self, allowing it to be used as a `with` target.
     Raises:
       IOError if the operation fails in some way.
+      LockNotAcquiredError if blocking is False and the lock is held.
     """
-    self._enforce_lock(fcntl.LOCK_SH, message)
+    self._enforce_lock(fcntl.LOCK_SH, message, blocking=blocking)
     return self
 
-  def write_lock(self, message="taking write lock"):
+  def write_lock(self, message="taking write lock", blocking=True):
     """
     Take a write lock (exclusive), upgrading from read if required.
 
@@ -91,12 +99,14 @@ class _Lock(cros_build_lib.MasterPidContextManager):
 
     Args:
       message: A description of what/why this lock is being taken.
+      blocking: If False, don't wait for the lock if someone else holds it.
     Returns:
       self, allowing it to be used as a `with` target.
     Raises:
       IOError if the operation fails in some way.
+      LockNotAcquiredError if blocking is False and the lock is held.
     """
-    self._enforce_lock(fcntl.LOCK_EX, message)
+    self._enforce_lock(fcntl.LOCK_EX, message, blocking=blocking)
     return self
 
   def unlock(self):
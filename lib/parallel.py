@@ -5,15 +5,19 @@
 """Module for running cbuildbot stages in the background."""
 
 import collections
+import cPickle
 import contextlib
 import errno
 import functools
 import multiprocessing
 import os
 import Queue
+import resource
 import signal
 import sys
 import tempfile
+import threading
+import time
 import traceback
 
 from chromite.buildbot import cbuildbot_results as results_lib
@@ -21,6 +25,15 @@ from chromite.buildbot import cbuildbot_results as results_lib
 _PRINT_INTERVAL = 1
 _BUFSIZE = 1024
 
+# How often, in seconds, adaptive task runners reconsider how many workers
+# should be running tasks.
+_ADAPT_INTERVAL = 5
+# How much throughput has to improve after adding a worker for us to keep it.
+_ADAPT_GAIN = 1.05
+# How many intervals to wait before adding a worker again after adding one
+# didn't help.
+_ADAPT_HOLD = 6
+
 
 class BackgroundFailure(results_lib.StepFailure):
   pass
@@ -63,52 +76,26 @@ class _BackgroundSteps(multiprocessing.Process):
       if ex.errno != errno.ESRCH:
         raise
 
-  def WaitForStep(self):
+  def WaitForStep(self, live_output=None, replay=True):
     """Wait for the next step to complete.
 
     Output from the step is printed as the step runs.
 
     If an exception occurs, return a string containing the traceback.
+
+    Args:
+      live_output: If set, a _LiveOutput to poll while we wait.
+      replay: Whether to print the output of the step.
     """
     assert not self.Empty()
     _step, output = self._steps.popleft()
+    return _PrintStepOutput(output.name, functools.partial(self._queue.get,
+                                                           True),
+                            live_output=live_output, replay=replay)
 
-    # Flush stdout and stderr to be sure no output is interleaved.
-    sys.stdout.flush()
-    sys.stderr.flush()
-
-    # File position pointers are shared across processes, so we must open
-    # our own file descriptor to ensure output is not lost.
-    output_name = output.name
-    with open(output_name, 'r') as output:
-      os.unlink(output_name)
-      pos = 0
-      more_output = True
-      while more_output:
-        # Check whether the process is finished.
-        try:
-          error, results = self._queue.get(True, _PRINT_INTERVAL)
-          more_output = False
-        except Queue.Empty:
-          more_output = True
-
-        # Print output so far.
-        output.seek(pos)
-        buf = output.read(_BUFSIZE)
-        while len(buf) > 0:
-          sys.stdout.write(buf)
-          pos += len(buf)
-          if len(buf) < _BUFSIZE:
-            break
-          buf = output.read(_BUFSIZE)
-        sys.stdout.flush()
-
-    # Propagate any results.
-    for result in results:
-      results_lib.Results.Record(*result)
-
-    # If a traceback occurred, return it.
-    return error
+  def GetStepOutputs(self):
+    """Return a list of (step, output_name) for the steps not yet waited on."""
+    return [(step, output.name) for step, output in self._steps]
 
   def Empty(self):
     """Return True if there are any steps left to run."""
@@ -132,57 +119,504 @@ class _BackgroundSteps(multiprocessing.Process):
 
   def _RunSteps(self):
     """Internal method for running the list of steps."""
+    _SetupStepSignals()
+    cancel = False
+    while self._steps:
+      step, output = self._steps.popleft()
+      # If there was a fatal exception, don't run any more steps.
+      error, results, fatal = _RunStep(None if cancel else step, output,
+                                       self._started)
+      cancel = cancel or fatal is not None
+      self._queue.put((error, results))
 
-    # The default handler for SIGINT sometimes forgets to actually raise the
-    # exception (and we can reproduce this using unit tests), so we define a
-    # custom one instead.
-    def kill_us(_sig_num, _frame):
-      raise KeyboardInterrupt('SIGINT received')
-    signal.signal(signal.SIGINT, kill_us)
 
+class _StepPool(object):
+  """Run a list of functions in a fixed number of background processes.
+
+  Rather than forking a process for each step, this starts a pool of worker
+  processes, each of which repeatedly claims the next step that hasn't been
+  started yet and runs it. The output of each step is saved to its own
+  temporary file, and is printed in the original order of the steps when the
+  'WaitForStep' function is called, just like _BackgroundSteps.
+  """
+
+  def __init__(self, steps, processes):
+    """Create a new _StepPool object.
+
+    Args:
+      steps: A list of functions to run.
+      processes: The number of worker processes to start.
+    """
+    self._steps = [(step, tempfile.NamedTemporaryFile(delete=False, bufsize=0))
+                   for step in steps]
+    # The index of the next step to be claimed by a worker.
+    self._next_step = multiprocessing.Value('i', 0)
+    self._queue = multiprocessing.Queue()
+    self._workers = []
+    for _ in xrange(min(processes, len(self._steps))):
+      started = multiprocessing.Event()
+      worker = multiprocessing.Process(target=self._RunWorker, args=(started,))
+      self._workers.append((worker, started))
+    # The index of the next step to print, and the results of the steps that
+    # finished before we got to them.
+    self._waiting = 0
+    self._finished = {}
+
+  def start(self):
+    """Start the worker processes after flushing output/err."""
     sys.stdout.flush()
     sys.stderr.flush()
-    orig_stdout, orig_stderr = sys.stdout, sys.stderr
-    stdout_fileno = sys.__stdout__.fileno()
-    stderr_fileno = sys.__stderr__.fileno()
-    orig_stdout_fd, orig_stderr_fd = map(os.dup,
-                                         [stdout_fileno, stderr_fileno])
-    cancel = False
-    while self._steps:
-      step, output = self._steps.popleft()
-      # Send all output to a named temporary file.
-      os.dup2(output.fileno(), stdout_fileno)
-      os.dup2(output.fileno(), stderr_fileno)
-      # Replace std[out|err] with unbuffered file objects
-      sys.stdout = os.fdopen(sys.__stdout__.fileno(), 'w', 0)
-      sys.stderr = os.fdopen(sys.__stderr__.fileno(), 'w', 0)
-      error = None
+    for worker, _started in self._workers:
+      worker.start()
+
+  def join(self):
+    """Wait for the worker processes to exit."""
+    for worker, _started in self._workers:
+      # Workers can't exit until the results they've queued have been read
+      # (e.g. the results of steps skipped after we halted), so keep reading.
+      while worker.is_alive():
+        try:
+          self._queue.get(True, _PRINT_INTERVAL)
+        except Queue.Empty:
+          pass
+      worker.join()
+
+    # Clean up the output of any steps that we didn't print.
+    for _step, output in self._steps[self._waiting:]:
       try:
-        results_lib.Results.Clear()
-        self._started.set()
-        if not cancel:
-          step()
-      except results_lib.StepFailure as ex:
-        error = str(ex)
-      except BaseException as ex:
-        error = traceback.format_exc()
-        # If it's a fatal exception, don't run any more steps.
-        if isinstance(ex, (SystemExit, KeyboardInterrupt)):
-          cancel = True
+        os.unlink(output.name)
+      except OSError as ex:
+        if ex.errno != errno.ENOENT:
+          raise
+
+  def Kill(self):
+    """Kill the running steps, and skip the steps that haven't started."""
+    for worker, started in self._workers:
+      started.wait()
+      # Kill the children nicely with a KeyboardInterrupt.
+      try:
+        os.kill(worker.pid, signal.SIGINT)
+      except OSError as ex:
+        if ex.errno != errno.ESRCH:
+          raise
+
+  def Empty(self):
+    """Return True if there are any steps left to run."""
+    return self._waiting >= len(self._steps)
+
+  def WaitForStep(self, live_output=None, replay=True):
+    """Wait for the next step to complete.
+
+    See _BackgroundSteps.WaitForStep.
+    """
+    assert not self.Empty()
+    idx = self._waiting
+    self._waiting += 1
+
+    def _GetResult(timeout):
+      while idx not in self._finished:
+        finished_idx, error, results = self._queue.get(True, timeout)
+        self._finished[finished_idx] = (error, results)
+      return self._finished.pop(idx)
+
+    _step, output = self._steps[idx]
+    return _PrintStepOutput(output.name, _GetResult, live_output=live_output,
+                            replay=replay)
+
+  def GetStepOutputs(self):
+    """Return a list of (step, output_name) for the steps not yet waited on."""
+    return [(step, output.name) for step, output in self._steps[self._waiting:]]
+
+  def _ClaimStep(self):
+    """Return the index of the next step to run, or None if we're done."""
+    with self._next_step.get_lock():
+      idx = self._next_step.value
+      if idx >= len(self._steps):
+        return None
+      self._next_step.value += 1
+      return idx
+
+  def _RunWorker(self, started):
+    """Run steps until there are none left."""
+    # Only interrupt steps while they're running, so that we never interrupt
+    # a worker while it holds the locks shared with the other workers.
+    self._running = self._halted = False
+    signal.signal(signal.SIGINT, self._HandleInterrupt)
+    started.set()
+    while True:
+      idx = self._ClaimStep()
+      if idx is None:
+        break
+      # Like _BackgroundSteps, once we've been interrupted we skip the rest
+      # of the steps, but still report them so that nobody waits on them.
+      step, output = self._steps[idx]
+      if not self._halted:
+        step = functools.partial(self._RunInterruptibleStep, step)
+      else:
+        step = None
+      error, results, _fatal = _RunStep(step, output)
+      self._queue.put((idx, error, results))
+
+  def _RunInterruptibleStep(self, step):
+    """Run a step, allowing _HandleInterrupt to interrupt it."""
+    self._running = True
+    try:
+      step()
+    finally:
+      self._running = False
+
+  def _HandleInterrupt(self, _sig_num, _frame):
+    """Skip the remaining steps, and interrupt the running one if any."""
+    self._halted = True
+    if self._running:
+      raise KeyboardInterrupt('SIGINT received')
+
+
+class _BackgroundThread(threading.Thread):
+  """Run a function in a background thread.
+
+  This has the same interface as _BackgroundSteps, but is much cheaper to
+  start, and the function shares memory with the rest of the process. Output
+  is not captured, so it is printed as soon as it is written. Threads cannot
+  be interrupted, so Kill only stops steps that haven't started yet.
+  """
+
+  def __init__(self, step, semaphore=None, halted=None):
+    """Create a new _BackgroundThread object.
+
+    Args:
+      step: The function to run.
+      semaphore: If set, acquired for the duration of the step.
+      halted: If set, an Event which, if set when the step is about to start,
+        means that the step should be skipped.
+    """
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self._step = step
+    self._semaphore = semaphore
+    self._halted = halted or threading.Event()
+    self._error = None
+    self._waited = False
+
+  def run(self):
+    """Run the step, saving any failure for WaitForStep."""
+    if self._semaphore is not None:
+      self._semaphore.acquire()
+    try:
+      if not self._halted.is_set():
+        with _RecordStepUsage(self._step, rusage=False):
+          self._step()
+    except results_lib.StepFailure as ex:
+      self._error = str(ex)
+    except BaseException:
+      self._error = traceback.format_exc()
+    finally:
+      if self._semaphore is not None:
+        self._semaphore.release()
+
+  def join(self, timeout=None):
+    """Wait for the thread to exit."""
+    if timeout is not None:
+      threading.Thread.join(self, timeout)
+      return
+    # Waiting without a timeout can't be interrupted with Ctrl-C.
+    while self.is_alive():
+      threading.Thread.join(self, _PRINT_INTERVAL)
+
+  def Kill(self):
+    """Skip the step if it hasn't started yet."""
+    self._halted.set()
+
+  def Empty(self):
+    """Return True if the step has been waited for."""
+    return self._waited
+
+  def WaitForStep(self, live_output=None, replay=True):
+    """Wait for the step to complete.
+
+    If an exception occurs, return a string containing the traceback.
+    """
+    # The output of threads isn't captured, so there's nothing to print.
+    del live_output, replay
+    self.join()
+    self._waited = True
+    return self._error
+
+  def GetStepOutputs(self):
+    """Threads don't capture output, so there's nothing to follow."""
+    return []
+
+
+def _SetupStepSignals():
+  """Set up signal handlers in a process that runs steps."""
+  # The default handler for SIGINT sometimes forgets to actually raise the
+  # exception (and we can reproduce this using unit tests), so we define a
+  # custom one instead.
+  def kill_us(_sig_num, _frame):
+    raise KeyboardInterrupt('SIGINT received')
+  signal.signal(signal.SIGINT, kill_us)
+
+
+def _RunStep(step, output, started=None):
+  """Run a step, sending all of its output to a temporary file.
+
+  Args:
+    step: The function to run. If None, nothing is run, but the step is
+      still reported as finished.
+    output: The temporary file to send output to. It is closed afterwards.
+    started: If set, an event to set once output has been redirected.
+
+  Returns:
+    A tuple (error, results, fatal). error is None if the step succeeded, or
+    a string describing the failure. results is a tuple of the results and
+    the usage the step recorded in results_lib.Results, including the usage
+    of the step itself. If the step was interrupted by a fatal exception
+    (SystemExit or KeyboardInterrupt), fatal is the exception; otherwise it
+    is None.
+  """
+  sys.stdout.flush()
+  sys.stderr.flush()
+  orig_stdout, orig_stderr = sys.stdout, sys.stderr
+  stdout_fileno = sys.__stdout__.fileno()
+  stderr_fileno = sys.__stderr__.fileno()
+  orig_stdout_fd, orig_stderr_fd = map(os.dup,
+                                       [stdout_fileno, stderr_fileno])
+  # Send all output to a named temporary file.
+  os.dup2(output.fileno(), stdout_fileno)
+  os.dup2(output.fileno(), stderr_fileno)
+  # Replace std[out|err] with unbuffered file objects
+  sys.stdout = os.fdopen(sys.__stdout__.fileno(), 'w', 0)
+  sys.stderr = os.fdopen(sys.__stderr__.fileno(), 'w', 0)
+  error = fatal = None
+  try:
+    results_lib.Results.Clear()
+    if started is not None:
+      started.set()
+    if step is not None:
+      with _RecordStepUsage(step):
+        step()
+  except results_lib.StepFailure as ex:
+    error = str(ex)
+  except BaseException as ex:
+    error = traceback.format_exc()
+    if isinstance(ex, (SystemExit, KeyboardInterrupt)):
+      fatal = ex
+
+  sys.stdout.flush()
+  sys.stderr.flush()
+  output.close()
+  sys.stdout, sys.stderr = orig_stdout, orig_stderr
+  os.dup2(orig_stdout_fd, stdout_fileno)
+  os.dup2(orig_stderr_fd, stderr_fileno)
+  map(os.close, [orig_stdout_fd, orig_stderr_fd])
+  results = (results_lib.Results.Get(), results_lib.Results.GetUsage())
+  return error, results, fatal
+
+
+def _GetResourceUsage():
+  """Return (user_time, sys_time, max_rss) of this process and its children.
+
+  CPU times include the children that have been waited for. max_rss is the
+  peak of this process or any of those children, whichever is larger.
+  """
+  own = resource.getrusage(resource.RUSAGE_SELF)
+  children = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return (own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime,
+          max(own.ru_maxrss, children.ru_maxrss))
+
 
+@contextlib.contextmanager
+def _RecordUsage(name, rusage=True, record=None):
+  """Record the resources used by the body in results_lib.Results.
+
+  Args:
+    name: The name to record the usage under.
+    rusage: Whether to measure CPU time and memory. This doesn't work in
+      threads, because the usage of the whole process would be measured.
+    record: If set, a function to pass the StepUsage to, rather than
+      recording it in results_lib.Results.
+  """
+  if record is None:
+    record = results_lib.Results.RecordUsage
+  start = time.time()
+  if rusage:
+    start_user, start_sys, _ = _GetResourceUsage()
+  try:
+    yield
+  finally:
+    user_time = sys_time = max_rss = None
+    if rusage:
+      end_user, end_sys, max_rss = _GetResourceUsage()
+      user_time, sys_time = end_user - start_user, end_sys - start_sys
+    record(results_lib.StepUsage(
+        name, time.time() - start, user_time, sys_time, max_rss))
+
+
+@contextlib.contextmanager
+def _RecordStepUsage(step, rusage=True):
+  """Record the resources used by the body as the usage of step.
+
+  The workers of BackgroundTaskRunner are skipped, because they record the
+  usage of their tasks themselves.
+  """
+  if isinstance(step, functools.partial) and step.func is _TaskRunner:
+    yield
+  else:
+    with _RecordUsage(_GetStepName(step), rusage=rusage):
+      yield
+
+
+def _AddUsage(total, usage):
+  """Return the sum of two StepUsage objects, keeping the name of |usage|.
+
+  Args:
+    total: The StepUsage to add to, or None.
+    usage: The StepUsage to add.
+  """
+  if total is None:
+    return usage
+  def _Sum(a, b):
+    return None if a is None or b is None else a + b
+  return results_lib.StepUsage(
+      usage.name, total.wall_time + usage.wall_time,
+      _Sum(total.user_time, usage.user_time),
+      _Sum(total.sys_time, usage.sys_time),
+      None if usage.max_rss is None else max(total.max_rss, usage.max_rss))
+
+
+def _PrintStepOutput(output_name, get_result, live_output=None, replay=True):
+  """Print the output of a step as it runs, until it finishes.
+
+  Args:
+    output_name: The name of the temporary file holding the step's output.
+      It is deleted once we've opened it.
+    get_result: Function taking a timeout, which returns the (error, results)
+      of the step once it has finished, or raises Queue.Empty if it doesn't
+      finish in time.
+    live_output: If set, a _LiveOutput to poll while we wait.
+    replay: Whether to print the output of the step to stdout.
+
+  Returns:
+    None if the step succeeded, or a string describing the failure (e.g. a
+    traceback).
+  """
+  # Flush stdout and stderr to be sure no output is interleaved.
+  sys.stdout.flush()
+  sys.stderr.flush()
+
+  # File position pointers are shared across processes, so we must open
+  # our own file descriptor to ensure output is not lost.
+  with open(output_name, 'r') as output:
+    os.unlink(output_name)
+    pos = 0
+    more_output = True
+    while more_output:
+      # Check whether the process is finished.
+      try:
+        error, results = get_result(_PRINT_INTERVAL)
+        more_output = False
+      except Queue.Empty:
+        more_output = True
+
+      if live_output is not None:
+        live_output.Poll()
+      if not replay:
+        continue
+
+      # Print output so far.
+      output.seek(pos)
+      buf = output.read(_BUFSIZE)
+      while len(buf) > 0:
+        sys.stdout.write(buf)
+        pos += len(buf)
+        if len(buf) < _BUFSIZE:
+          break
+        buf = output.read(_BUFSIZE)
       sys.stdout.flush()
-      sys.stderr.flush()
-      output.close()
-      sys.stdout, sys.stderr = orig_stdout, orig_stderr
-      os.dup2(orig_stdout_fd, stdout_fileno)
-      os.dup2(orig_stderr_fd, stderr_fileno)
-      map(os.close, [orig_stdout_fd, orig_stderr_fd])
-      results = results_lib.Results.Get()
-      self._queue.put((error, results))
+
+  # Propagate any results.
+  stage_results, usage = results
+  for result in stage_results:
+    results_lib.Results.Record(*result)
+  for step_usage in usage:
+    results_lib.Results.RecordUsage(step_usage)
+
+  # If a traceback occurred, return it.
+  return error
+
+
+def _GetStepName(step):
+  """Return a short name for a step, for prefixing its output."""
+  name = getattr(step, '__name__', None)
+  if name is None and isinstance(step, functools.partial):
+    return _GetStepName(step.func)
+  if name is None:
+    return repr(step)
+  owner = getattr(step, 'im_self', None)
+  if owner is not None:
+    name = '%s.%s' % (owner.__class__.__name__, name)
+  return name
+
+
+class _LiveOutput(object):
+  """Copy the output of running steps to a stream as it is written.
+
+  Each complete line written by a step is copied to the stream, prefixed with
+  the name of the step, as soon as we poll for it. This lets output from all
+  of the steps be followed live, rather than only the output of the step
+  that is being printed in sequence.
+  """
+
+  def __init__(self, stream, step_outputs):
+    """Create a new _LiveOutput object.
+
+    Args:
+      stream: The file object to copy output to.
+      step_outputs: A list of (step, output_name) for each step to follow.
+    """
+    self._stream = stream
+    names = [_GetStepName(step) for step, _output_name in step_outputs]
+    self._steps = []
+    for idx, (name, (_step, output_name)) in enumerate(zip(names,
+                                                           step_outputs)):
+      # Number steps which share a name, so their output can be told apart.
+      if names.count(name) > 1:
+        name = '%s#%d' % (name, idx)
+      # Open our own file descriptor, so that we keep reading even after
+      # the file is unlinked, and aren't affected by the position of others.
+      fd = os.open(output_name, os.O_RDONLY)
+      # Each step holds its prefix, fd and any incomplete line read so far.
+      self._steps.append(['[%s] ' % name, fd, ''])
+
+  def Poll(self):
+    """Copy any complete lines written since we last polled."""
+    for step in self._steps:
+      prefix, fd, partial = step
+      while True:
+        buf = os.read(fd, _BUFSIZE)
+        if not buf:
+          break
+        partial += buf
+      lines = partial.split('\n')
+      step[2] = lines.pop()
+      for line in lines:
+        self._stream.write('%s%s\n' % (prefix, line))
+    self._stream.flush()
+
+  def Close(self):
+    """Copy any remaining output, including incomplete lines."""
+    self.Poll()
+    for prefix, fd, partial in self._steps:
+      if partial:
+        self._stream.write('%s%s\n' % (prefix, partial))
+      os.close(fd)
+    self._stream.flush()
+    self._steps = []
 
 
 @contextlib.contextmanager
-def _ParallelSteps(steps, max_parallel=None, halt_on_error=False):
+def _ParallelSteps(steps, max_parallel=None, halt_on_error=False,
+                   pooled=False, live_output=None, replay=True, threads=False):
   """Run a list of functions in parallel.
 
   This function launches the provided functions in the background, yields,
@@ -201,19 +635,54 @@ def _ParallelSteps(steps, max_parallel=None, halt_on_error=False):
       By default, run all tasks in parallel.
     halt_on_error: After the first exception occurs, halt any running steps,
       and squelch any further output, including any exceptions that might occur.
+    pooled: If True, run the steps in max_parallel (by default, one per CPU)
+      long-lived worker processes, rather than forking a process per step.
+      Steps run in a pool may see changes to global state made by earlier
+      steps in the same worker.
+    live_output: If set, a file object to which every line of output from
+      every step is copied as soon as it is written, prefixed with the name
+      of the step.
+    replay: If False, don't print the output of the steps in sequence. This
+      is useful when live_output is sys.stdout.
+    threads: If True, run the steps in threads rather than processes. Their
+      output isn't captured, and they can't be interrupted, so halt_on_error
+      only skips steps that haven't started yet.
   """
 
-  semaphore = None
-  if max_parallel is not None:
-    semaphore = multiprocessing.Semaphore(max_parallel)
+  if threads and live_output is not None:
+    raise ValueError('live_output requires steps to run in processes')
 
-  # First, start all the steps.
   bg_steps = []
-  for step in steps:
-    bg = _BackgroundSteps(semaphore)
-    bg.AddStep(step)
+  if threads:
+    semaphore = None
+    if max_parallel is not None:
+      semaphore = threading.Semaphore(max_parallel)
+    halted = threading.Event()
+    for step in steps:
+      bg = _BackgroundThread(step, semaphore=semaphore, halted=halted)
+      bg.start()
+      bg_steps.append(bg)
+  elif pooled:
+    # Start a fixed pool of workers, which run the steps between them.
+    bg = _StepPool(steps, max_parallel or multiprocessing.cpu_count())
     bg.start()
     bg_steps.append(bg)
+  else:
+    semaphore = None
+    if max_parallel is not None:
+      semaphore = multiprocessing.Semaphore(max_parallel)
+
+    # First, start all the steps.
+    for step in steps:
+      bg = _BackgroundSteps(semaphore)
+      bg.AddStep(step)
+      bg.start()
+      bg_steps.append(bg)
+
+  live = None
+  if live_output is not None:
+    live = _LiveOutput(live_output,
+                       [x for bg in bg_steps for x in bg.GetStepOutputs()])
 
   try:
     yield
@@ -226,17 +695,22 @@ def _ParallelSteps(steps, max_parallel=None, halt_on_error=False):
           bg.Kill()
           break
         else:
-          error = bg.WaitForStep()
+          error = bg.WaitForStep(live_output=live, replay=replay)
           if error is not None:
             tracebacks.append(error)
       bg.join()
 
+    if live is not None:
+      live.Close()
+
     # Propagate any exceptions.
     if tracebacks:
       raise BackgroundFailure('\n' + ''.join(tracebacks))
 
 
-def RunParallelSteps(steps, max_parallel=None, halt_on_error=False):
+def RunParallelSteps(steps, max_parallel=None, halt_on_error=False,
+                     pooled=False, live_output=None, replay=True,
+                     threads=False):
   """Run a list of functions in parallel.
 
   This function blocks until all steps are completed.
@@ -254,6 +728,27 @@ def RunParallelSteps(steps, max_parallel=None, halt_on_error=False):
       By default, run all tasks in parallel.
     halt_on_error: After the first exception occurs, halt any running steps,
       and squelch any further output, including any exceptions that might occur.
+    pooled: If True, run the steps in a fixed pool of max_parallel worker
+      processes rather than forking a process per step. This is much cheaper
+      when there are many small steps.
+    live_output: If set, a file object (e.g. sys.stderr, or a log file) to
+      which every line of output from every step is copied as soon as it is
+      written, prefixed with the name of the step. This shows what all of
+      the steps are doing while they run, rather than only the first step
+      that hasn't finished yet.
+    replay: If False, don't print the output of the steps in sequence once
+      they finish. Use this with live_output=sys.stdout to only stream the
+      output live.
+    threads: If True, run the steps in threads rather than processes. This
+      avoids the cost of forking for steps that mostly wait on subprocesses
+      or the network, and lets steps share in-memory state. The output of
+      threads is printed as it is written rather than in sequence, and
+      running threads can't be halted.
+
+  Returns:
+    A list of results_lib.StepUsage objects, describing the resources used
+    by each of the steps, and by any parallel steps or tasks that they ran.
+    These are also recorded in results_lib.Results.
 
   Example:
     # This snippet will execute in parallel:
@@ -264,16 +759,161 @@ def RunParallelSteps(steps, max_parallel=None, halt_on_error=False):
     RunParallelSteps(steps)
     # Blocks until all calls have completed.
   """
+  start = len(results_lib.Results.GetUsage())
   with _ParallelSteps(steps, max_parallel=max_parallel,
-                      halt_on_error=halt_on_error):
+                      halt_on_error=halt_on_error, pooled=pooled,
+                      live_output=live_output, replay=replay,
+                      threads=threads):
     pass
+  return results_lib.Results.GetUsage()[start:]
 
 
 class _AllTasksComplete(object):
   """Sentinel object to indicate that all tasks are complete."""
 
 
-def _TaskRunner(queue, task, onexit=None):
+class _ConcurrencyController(object):
+  """Decide how many workers should be running tasks at once.
+
+  The number of active workers starts at the minimum. Every interval, we are
+  told how the tasks did, and:
+    - If the load average is above max_load, a worker is removed.
+    - If we added a worker last time and throughput (tasks completed per
+      second) didn't improve, the worker is removed again, and we wait a
+      while before trying to add one again.
+    - If tasks have become much slower than the fastest we've seen without
+      throughput improving, the workers are contending with each other (e.g.
+      for the disk or network), so a worker is removed.
+    - Otherwise, if every active worker is busy, a worker is added.
+  """
+
+  def __init__(self, minimum, maximum, max_load):
+    """Create a new _ConcurrencyController object.
+
+    Args:
+      minimum: The fewest workers to keep active.
+      maximum: The most workers to make active.
+      max_load: Remove workers while the load average is above this.
+    """
+    self.minimum = minimum
+    self.maximum = maximum
+    self.max_load = max_load
+    self.limit = minimum
+    self._throughput = None
+    self._best_latency = None
+    self._grew = False
+    self._hold = 0
+
+  def Update(self, elapsed, completed, busy, running, load):
+    """Update the number of active workers, and return it.
+
+    Args:
+      elapsed: The number of seconds since the last update.
+      completed: The number of tasks completed since the last update.
+      busy: The total number of seconds taken by those tasks.
+      running: The number of tasks running right now.
+      load: The current load average.
+    """
+    throughput = float(completed) / elapsed
+    latency = float(busy) / completed if completed else None
+    slower = (latency is not None and self._best_latency is not None and
+              latency > 2 * self._best_latency)
+    no_gain = (self._throughput is not None and
+               throughput < self._throughput * _ADAPT_GAIN)
+
+    change = 0
+    if load > self.max_load:
+      change = -1
+    elif self._grew and no_gain:
+      change = -1
+      self._hold = _ADAPT_HOLD
+    elif slower and no_gain:
+      change = -1
+    elif self._hold:
+      self._hold -= 1
+    elif running >= self.limit:
+      change = 1
+
+    old_limit = self.limit
+    self.limit = max(self.minimum, min(self.maximum, self.limit + change))
+    self._grew = self.limit > old_limit
+    self._throughput = throughput
+    if latency is not None:
+      self._best_latency = min(latency, self._best_latency or latency)
+    return self.limit
+
+
+class _AdaptiveGate(object):
+  """Limit how many workers run tasks at once, and measure how they do.
+
+  Workers call Enter before each task and Exit after it. The number of
+  workers allowed to run tasks at once is changed with Resize, by holding
+  back the permits of the workers that should be idle.
+  """
+
+  def __init__(self, maximum):
+    self._maximum = maximum
+    self._semaphore = multiprocessing.Semaphore(maximum)
+    self._held = 0
+    self._limit = maximum
+    # Statistics about the tasks, shared by all of the workers.
+    self._running = multiprocessing.Value('i', 0)
+    self._completed = multiprocessing.Value('i', 0)
+    self._busy = multiprocessing.Value('d', 0)
+
+  def Enter(self):
+    """Wait until this worker may run a task."""
+    self._semaphore.acquire()
+    with self._running.get_lock():
+      self._running.value += 1
+    return time.time()
+
+  def Exit(self, start):
+    """Record that a task started at start has finished."""
+    with self._running.get_lock():
+      self._running.value -= 1
+      self._completed.value += 1
+      self._busy.value += time.time() - start
+    self._semaphore.release()
+
+  def Sample(self):
+    """Return (completed, busy, running) since the last sample, and reset."""
+    with self._running.get_lock():
+      sample = (self._completed.value, self._busy.value, self._running.value)
+      self._completed.value = 0
+      self._busy.value = 0
+    return sample
+
+  def Resize(self, limit):
+    """Allow up to limit workers to run tasks at once.
+
+    Permits that are in use can't be taken back until their tasks finish, so
+    shrinking may take effect gradually. Call Resize periodically to catch up.
+    """
+    self._limit = limit
+    while self._maximum - self._held > limit:
+      if not self._semaphore.acquire(False):
+        break
+      self._held += 1
+    while self._maximum - self._held < limit:
+      self._semaphore.release()
+      self._held -= 1
+
+
+def _AdaptConcurrency(gate, controller, stop):
+  """Resize gate according to controller every interval until stop is set."""
+  gate.Resize(controller.limit)
+  last = time.time()
+  while not stop.wait(_ADAPT_INTERVAL):
+    now = time.time()
+    completed, busy, running = gate.Sample()
+    controller.Update(now - last, completed, busy, running,
+                      os.getloadavg()[0])
+    gate.Resize(controller.limit)
+    last = now
+
+
+def _TaskRunner(queue, task, onexit=None, gate=None, rusage=True):
   """Run task(*input) for each input in the queue.
 
   Returns when it encounters an _AllTasksComplete object on the queue.
@@ -285,8 +925,16 @@ def _TaskRunner(queue, task, onexit=None):
       be run.
     task: Function to run on each queued input.
     onexit: Function to run after all inputs are processed.
+    gate: If set, an _AdaptiveGate to enter before running each task.
+    rusage: Whether to measure the CPU time and memory used by the tasks. See
+      _RecordUsage. The usage of all the tasks run by this worker is recorded
+      once, under the name of the task.
   """
+  name = _GetStepName(task)
   tracebacks = []
+  usage = [None]
+  def _Record(step_usage):
+    usage[0] = _AddUsage(usage[0], step_usage)
   while True:
     # Wait for a new item to show up on the queue. This is a blocking wait,
     # so if there's nothing to do, we just sit here.
@@ -297,10 +945,18 @@ def _TaskRunner(queue, task, onexit=None):
 
     # If no tasks failed yet, process the remaining tasks.
     if not tracebacks:
+      start = gate.Enter() if gate is not None else None
       try:
-        task(*x)
+        with _RecordUsage(name, rusage=rusage, record=_Record):
+          task(*x)
       except BaseException:
         tracebacks.append(traceback.format_exc())
+      finally:
+        if gate is not None:
+          gate.Exit(start)
+
+  if usage[0] is not None:
+    results_lib.Results.RecordUsage(usage[0])
 
   # Run exit handlers.
   if onexit:
@@ -312,7 +968,8 @@ def _TaskRunner(queue, task, onexit=None):
 
 
 @contextlib.contextmanager
-def BackgroundTaskRunner(task, queue=None, processes=None, onexit=None):
+def BackgroundTaskRunner(task, queue=None, processes=None, onexit=None,
+                         threads=False, adaptive=False, min_processes=1):
   """Run the specified task on each queued input in a pool of processes.
 
   This context manager starts a set of workers in the background, who each
@@ -347,24 +1004,58 @@ def BackgroundTaskRunner(task, queue=None, processes=None, onexit=None):
     processes: Number of processes to launch.
     onexit: Function to run in each background process after all inputs are
       processed.
+    threads: If True, run the task in threads rather than processes. See
+      RunParallelSteps.
+    adaptive: If True, start |processes| workers, but only let some of them
+      run tasks at once. Starting with min_processes, workers are added
+      while they are all busy and adding them improves throughput, and
+      removed when the tasks start contending with each other or the load
+      average exceeds the number of CPUs.
+    min_processes: With adaptive, the fewest workers to keep running tasks.
   """
 
   if queue is None:
-    queue = multiprocessing.Queue()
+    queue = Queue.Queue() if threads else multiprocessing.Queue()
 
   if not processes:
     processes = multiprocessing.cpu_count()
 
-  steps = [functools.partial(_TaskRunner, queue, task, onexit)] * processes
-  with _ParallelSteps(steps):
-    try:
-      yield queue
-    finally:
-      for _ in xrange(processes):
-        queue.put(_AllTasksComplete())
+  gate = controller = None
+  if adaptive:
+    gate = _AdaptiveGate(processes)
+    minimum = max(1, min(min_processes, processes))
+    controller = _ConcurrencyController(minimum, processes,
+                                        multiprocessing.cpu_count())
+    # Hold back the permits of the idle workers before any of them start.
+    gate.Resize(controller.limit)
+
+  runner = functools.partial(_TaskRunner, queue, task, onexit, gate,
+                             not threads)
+  runner.__name__ = '%s worker' % _GetStepName(task)
+  steps = [runner] * processes
+  stop = threading.Event()
+  adapter = None
+  try:
+    with _ParallelSteps(steps, threads=threads):
+      if adaptive:
+        adapter = threading.Thread(target=_AdaptConcurrency,
+                                   args=(gate, controller, stop))
+        adapter.daemon = True
+        adapter.start()
+      try:
+        yield queue
+      finally:
+        for _ in xrange(processes):
+          queue.put(_AllTasksComplete())
+  finally:
+    # Keep adapting until the workers have drained the queue and exited.
+    stop.set()
+    if adapter is not None:
+      adapter.join()
 
 
-def RunTasksInProcessPool(task, inputs, processes=None, onexit=None):
+def RunTasksInProcessPool(task, inputs, processes=None, onexit=None,
+                          threads=False):
   """Run the specified function with each supplied input in a pool of processes.
 
   This function runs task(*x) for x in inputs in a pool of processes. This
@@ -399,11 +1090,133 @@ def RunTasksInProcessPool(task, inputs, processes=None, onexit=None):
     processes: Number of processes, at most, to launch.
     onexit: Function to run in each background process after all inputs are
       processed.
+    threads: If True, run the tasks in threads rather than processes. See
+      RunParallelSteps.
   """
 
   if not processes:
     processes = min(multiprocessing.cpu_count(), len(inputs))
 
-  with BackgroundTaskRunner(task, processes=processes, onexit=onexit) as queue:
+  with BackgroundTaskRunner(task, processes=processes, onexit=onexit,
+                            threads=threads) as queue:
     for x in inputs:
       queue.put(x)
+
+
+def _ResultTask(results, task, pickle, cancel, idx, args):
+  """Run task(*args), and put (idx, success, result) on the results queue.
+
+  If pickle is True, the result is pickled here, rather than in the queue's
+  feeder thread, so that results which can't be pickled are reported as
+  failures of the task. If the cancel event is set, the task is skipped.
+  """
+  if cancel.is_set():
+    return
+  try:
+    result = task(*args)
+    if pickle:
+      result = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+  except BaseException:
+    results.put((idx, False, None))
+    raise
+  results.put((idx, True, result))
+
+
+def IterTasksInProcessPool(task, inputs, processes=None, onexit=None,
+                           ordered=True, threads=False):
+  """Run task(*x) for each x in inputs in a pool of processes, yielding results.
+
+  This is like RunTasksInProcessPool, except that the return value of each
+  task is yielded back to the caller as soon as it is available. Return
+  values must be picklable, unless the tasks are run in threads.
+
+  The output from these tasks is saved to a temporary file, and printed in
+  order, as if the tasks were run in sequence, once all of the tasks have
+  completed.
+
+  If exceptions occur in the tasks, no further results are yielded. Once all
+  of the tasks that were already running have finished, a BackgroundFailure
+  is raised with full stack traces of all exceptions.
+
+  If the caller stops iterating early, the inputs that haven't started are
+  skipped, and the results of the tasks that are still running are thrown
+  away.
+
+  Example:
+    def GetSize(path):
+      ...
+    paths = ['a', 'b', 'c']
+    sizes = {}
+    for i, size in enumerate(IterTasksInProcessPool(GetSize,
+                                                    [[x] for x in paths])):
+      sizes[paths[i]] = size
+
+  Args:
+    task: Function to run on each input.
+    inputs: List of inputs.
+    processes: Number of processes, at most, to launch.
+    onexit: Function to run in each background process after all inputs are
+      processed.
+    ordered: If True, results are yielded in the same order as inputs.
+      Otherwise, results are yielded in the order that the tasks complete.
+    threads: If True, run the tasks in threads rather than processes. Results
+      are then passed back as they are, without being copied. See
+      RunParallelSteps.
+  """
+  inputs = list(inputs)
+  if not processes:
+    processes = min(multiprocessing.cpu_count(), len(inputs))
+
+  if threads:
+    results = Queue.Queue()
+    cancel = threading.Event()
+    loads = lambda x: x
+  else:
+    results = multiprocessing.Queue()
+    cancel = multiprocessing.Event()
+    loads = cPickle.loads
+  wrapper = functools.partial(_ResultTask, results, task, not threads, cancel)
+  wrapper.__name__ = _GetStepName(task)
+  drainer = None
+  try:
+    with BackgroundTaskRunner(wrapper, processes=processes, onexit=onexit,
+                              threads=threads) as queue:
+      for idx, x in enumerate(inputs):
+        queue.put([idx, x])
+
+      pending, next_idx = {}, 0
+      remaining = len(inputs)
+      try:
+        while remaining:
+          idx, success, result = results.get()
+          remaining -= 1
+          if not success:
+            # Leave the with block, so that the failure is raised.
+            break
+          if not ordered:
+            yield loads(result)
+            continue
+          pending[idx] = result
+          while next_idx in pending:
+            yield loads(pending.pop(next_idx))
+            next_idx += 1
+      finally:
+        if remaining:
+          # We're leaving early, because of a failure or because the caller
+          # stopped iterating. Skip the inputs that haven't started, and
+          # read the results of the running tasks until the workers exit, so
+          # that they aren't blocked writing results that nobody reads.
+          cancel.set()
+          drainer = threading.Thread(target=_DrainResults, args=(results,))
+          drainer.daemon = True
+          drainer.start()
+  finally:
+    if drainer is not None:
+      results.put(None)
+      drainer.join()
+
+
+def _DrainResults(results):
+  """Discard results from the queue until None is read."""
+  while results.get() is not None:
+    pass
@@ -4,14 +4,18 @@
 # found in the LICENSE file.
 
 import contextlib
+import functools
 import multiprocessing
 import os
 import sys
 import tempfile
+import threading
 import time
 import Queue
+import StringIO
 
 sys.path.insert(0, os.path.abspath('%s/../../..' % __file__))
+from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import parallel
 from chromite.lib import partial_mock
@@ -33,18 +37,33 @@ class ParallelMock(partial_mock.PartialMock):
   """
 
   TARGET = 'chromite.lib.parallel'
-  ATTRS = ('_ParallelSteps',)
+  ATTRS = ('_ParallelSteps', 'IterTasksInProcessPool')
 
   @contextlib.contextmanager
-  def _ParallelSteps(self, steps, max_parallel=None, halt_on_error=False):
+  def _ParallelSteps(self, steps, max_parallel=None, halt_on_error=False,
+                     pooled=False, live_output=None, replay=True,
+                     threads=False):
     assert max_parallel is None or isinstance(max_parallel, (int, long))
     assert isinstance(halt_on_error, bool)
+    assert isinstance(pooled, bool)
+    assert isinstance(replay, bool)
+    assert isinstance(threads, bool)
     try:
       yield
     finally:
       for step in steps:
         step()
 
+  def IterTasksInProcessPool(self, task, inputs, processes=None, onexit=None,
+                             ordered=True, threads=False):
+    assert isinstance(ordered, bool)
+    assert isinstance(threads, bool)
+    for x in inputs:
+      yield task(*x)
+    if onexit:
+      for _ in xrange(processes or 1):
+        onexit()
+
 
 class BackgroundTaskVerifier(partial_mock.PartialMock):
   """Verify that queues are empty after BackgroundTaskRunner runs.
@@ -59,11 +78,13 @@ class BackgroundTaskVerifier(partial_mock.PartialMock):
   ATTRS = ('BackgroundTaskRunner',)
 
   @contextlib.contextmanager
-  def BackgroundTaskRunner(self, task, queue=None, processes=None, onexit=None):
+  def BackgroundTaskRunner(self, task, queue=None, processes=None, onexit=None,
+                           threads=False, **kwargs):
     if queue is None:
-      queue = multiprocessing.Queue()
+      queue = Queue.Queue() if threads else multiprocessing.Queue()
     try:
-      with self.backup['BackgroundTaskRunner'](task, queue, processes, onexit):
+      with self.backup['BackgroundTaskRunner'](task, queue, processes, onexit,
+                                               threads=threads, **kwargs):
         yield queue
     finally:
       try:
@@ -157,6 +178,240 @@ class TestFastPrinting(TestBackgroundWrapper):
     self.assertEquals(len(out), _TOTAL_BYTES)
 
 
+class TestStepPool(cros_test_lib.OutputTestCase):
+  """Test running steps in a pool of workers."""
+
+  def _PrintPid(self, idx):
+    sys.stdout.write('%d %d\n' % (idx, os.getpid()))
+
+  def testOrderedOutput(self):
+    """Verify many steps share a few workers, and output stays in order."""
+    steps = [functools.partial(self._PrintPid, i) for i in range(50)]
+    with self.OutputCapturer() as capture:
+      parallel.RunParallelSteps(steps, max_parallel=4, pooled=True)
+      lines = [x.split() for x in capture.GetStdout().splitlines()]
+    self.assertEqual([int(idx) for idx, _ in lines], range(50))
+    pids = set(pid for _, pid in lines)
+    self.assertTrue(1 <= len(pids) <= 4)
+    self.assertFalse(str(os.getpid()) in pids)
+
+  def testFailures(self):
+    """Verify failing steps don't stop the remaining steps."""
+    def _Exit():
+      sys.exit(1)
+    steps = [_Exit] + [functools.partial(self._PrintPid, i) for i in range(5)]
+    with self.OutputCapturer() as capture:
+      self.assertRaises(parallel.BackgroundFailure, parallel.RunParallelSteps,
+                        steps, max_parallel=1, pooled=True)
+      self.assertEqual(len(capture.GetStdout().splitlines()), 5)
+
+  def testHalting(self):
+    """Verify remaining steps are skipped after halting on an error."""
+    def _Fail():
+      raise ValueError()
+    steps = [_Fail] + [functools.partial(time.sleep, 0.01)] * 100
+    with self.OutputCapturer():
+      self.assertRaises(parallel.BackgroundFailure, parallel.RunParallelSteps,
+                        steps, max_parallel=2, halt_on_error=True,
+                        pooled=True)
+
+  def testEmpty(self):
+    """Verify an empty list of steps is fine."""
+    parallel.RunParallelSteps([], pooled=True)
+
+
+class TestLiveOutput(cros_test_lib.OutputTestCase):
+  """Test streaming the output of steps as it is written."""
+
+  def setUp(self):
+    self.live = StringIO.StringIO()
+
+  def _First(self):
+    sys.stdout.write('first\n')
+    # Wait until the second step has printed, which it does immediately.
+    time.sleep(2)
+    sys.stdout.write('partial')
+
+  def _Second(self):
+    sys.stdout.write('second\n')
+
+  def testLive(self):
+    """Verify output of later steps is seen before earlier steps finish."""
+    with self.OutputCapturer() as capture:
+      parallel.RunParallelSteps([self._First, self._Second],
+                                live_output=self.live)
+      self.assertEqual(capture.GetStdout(), 'first\npartialsecond\n')
+    lines = self.live.getvalue().splitlines()
+    self.assertEqual(sorted(lines[:2]),
+                     ['[TestLiveOutput._First] first',
+                      '[TestLiveOutput._Second] second'])
+    self.assertEqual(lines[2:], ['[TestLiveOutput._First] partial'])
+
+  def testNoReplay(self):
+    """Verify replay can be turned off, and duplicate names are numbered."""
+    steps = [functools.partial(self._Second)] * 2
+    with self.OutputCapturer() as capture:
+      parallel.RunParallelSteps(steps, live_output=self.live, replay=False,
+                                pooled=True)
+      self.assertEqual(capture.GetStdout(), '')
+    self.assertEqual(sorted(self.live.getvalue().splitlines()),
+                     ['[TestLiveOutput._Second#0] second',
+                      '[TestLiveOutput._Second#1] second'])
+
+
+class TestThreads(cros_test_lib.OutputTestCase, cros_test_lib.MockTestCase):
+  """Test running steps and tasks in threads."""
+
+  def setUp(self):
+    self.seen = []
+
+  def _Record(self, x):
+    self.seen.append(x)
+    return x * 2
+
+  def testSharedMemory(self):
+    """Verify threads run in this process, and share its memory."""
+    self.StartPatcher(BackgroundTaskVerifier())
+    parallel.RunTasksInProcessPool(self._Record, [[x] for x in range(10)],
+                                   processes=4, threads=True)
+    self.assertEqual(sorted(self.seen), range(10))
+
+  def testResults(self):
+    """Verify results are passed back without being pickled."""
+    results = parallel.IterTasksInProcessPool(
+        lambda: threading.current_thread(), [[]] * 3, threads=True)
+    for thread in results:
+      self.assertFalse(thread is threading.current_thread())
+
+  def testFailure(self):
+    """Verify failures in threads are raised as BackgroundFailure."""
+    steps = [functools.partial(self._Record, 1), sys.exit]
+    with self.OutputCapturer():
+      self.assertRaises(parallel.BackgroundFailure, parallel.RunParallelSteps,
+                        steps, threads=True)
+    self.assertEqual(self.seen, [1])
+
+  def testHalting(self):
+    """Verify steps that haven't started are skipped after a failure."""
+    def _SlowRecord(x):
+      time.sleep(0.1)
+      self._Record(x)
+    steps = [sys.exit] + [functools.partial(_SlowRecord, x) for x in range(10)]
+    with self.OutputCapturer():
+      self.assertRaises(parallel.BackgroundFailure, parallel.RunParallelSteps,
+                        steps, max_parallel=1, halt_on_error=True,
+                        threads=True)
+    self.assertTrue(len(self.seen) < 10)
+
+
+class TestAdaptive(cros_test_lib.MockTestCase):
+  """Test adaptive concurrency in BackgroundTaskRunner."""
+
+  def testController(self):
+    """Verify workers are added while they help, and removed otherwise."""
+    controller = parallel._ConcurrencyController(1, 4, max_load=8)
+    # All workers are busy, so add one.
+    self.assertEqual(controller.Update(5, 5, 5, 1, load=1), 2)
+    # Throughput doubled, so keep going.
+    self.assertEqual(controller.Update(5, 10, 10, 2, load=1), 3)
+    # Throughput didn't improve, so back off, and hold off for a while.
+    self.assertEqual(controller.Update(5, 10, 15, 3, load=1), 2)
+    for _ in xrange(parallel._ADAPT_HOLD):
+      self.assertEqual(controller.Update(5, 10, 10, 2, load=1), 2)
+    self.assertEqual(controller.Update(5, 10, 10, 2, load=1), 3)
+    # Too much load.
+    self.assertEqual(controller.Update(5, 15, 15, 3, load=9), 2)
+    # Tasks are much slower, and throughput didn't improve.
+    self.assertEqual(controller.Update(5, 5, 50, 2, load=1), 1)
+    # Never go below the minimum.
+    self.assertEqual(controller.Update(5, 5, 5, 1, load=9), 1)
+
+  def testIdleWorkers(self):
+    """Verify workers aren't added while some are idle."""
+    controller = parallel._ConcurrencyController(2, 4, max_load=8)
+    self.assertEqual(controller.Update(5, 5, 5, 1, load=1), 2)
+
+  def testGate(self):
+    """Verify the gate can be resized, and measures tasks."""
+    gate = parallel._AdaptiveGate(3)
+    gate.Resize(1)
+    start = gate.Enter()
+    self.assertFalse(gate._semaphore.acquire(False))
+    gate.Exit(start)
+    gate.Resize(3)
+    for _ in xrange(3):
+      self.assertTrue(gate._semaphore.acquire(False))
+    completed, _busy, running = gate.Sample()
+    self.assertEqual((completed, running), (1, 0))
+    self.assertEqual(gate.Sample()[0], 0)
+
+  def testAdaptiveRunner(self):
+    """Verify all tasks run when concurrency is adaptive."""
+    self.PatchObject(parallel, '_ADAPT_INTERVAL', 0.01)
+    self.StartPatcher(BackgroundTaskVerifier())
+    seen = multiprocessing.Queue()
+    with parallel.BackgroundTaskRunner(seen.put, processes=4,
+                                       adaptive=True) as queue:
+      for x in range(20):
+        queue.put([x])
+    self.assertEqual(sorted(seen.get() for _ in range(20)), range(20))
+
+  def testAdaptWhileDraining(self):
+    """Verify workers are added while the queued tasks are drained."""
+    self.PatchObject(parallel, '_ADAPT_INTERVAL', 0.05)
+    self.PatchObject(os, 'getloadavg', return_value=(0, 0, 0))
+    start = time.time()
+    with parallel.BackgroundTaskRunner(time.sleep, processes=8,
+                                       adaptive=True) as queue:
+      for _ in range(32):
+        queue.put([0.2])
+    # Run in sequence, the tasks would take 6.4 seconds.
+    self.assertTrue(time.time() - start < 3.2)
+
+
+class TestUsage(cros_test_lib.TestCase):
+  """Test measuring the resources used by steps and tasks."""
+
+  def setUp(self):
+    results_lib.Results.Clear()
+
+  def _Spin(self, seconds=0.2):
+    end = time.time() + seconds
+    while time.time() < end:
+      pass
+
+  def _Sleep(self, seconds=0.01):
+    time.sleep(seconds)
+
+  def testSteps(self):
+    """Verify the usage of each step is measured and returned."""
+    usage = parallel.RunParallelSteps([self._Spin, self._Sleep])
+    self.assertEqual(usage, results_lib.Results.GetUsage())
+    usage = dict((x.name, x) for x in usage)
+    self.assertEqual(sorted(usage), ['TestUsage._Sleep', 'TestUsage._Spin'])
+    spin = usage['TestUsage._Spin']
+    self.assertTrue(spin.wall_time >= 0.2)
+    self.assertTrue(spin.user_time + spin.sys_time > 0.1)
+    self.assertTrue(spin.max_rss > 0)
+    self.assertTrue(usage['TestUsage._Sleep'].user_time < 0.1)
+
+  def testTasks(self):
+    """Verify the usage of the tasks is summed, and recorded only once."""
+    parallel.RunTasksInProcessPool(self._Spin, [[0.1], [0.2]], processes=1)
+    usage = results_lib.Results.GetUsage()
+    self.assertEqual([x.name for x in usage], ['TestUsage._Spin'])
+    self.assertTrue(0.3 <= usage[0].wall_time < 0.6)
+    self.assertTrue(0.15 < usage[0].user_time + usage[0].sys_time < 0.6)
+    self.assertTrue(usage[0].max_rss > 0)
+
+  def testThreads(self):
+    """Verify only the wall time of threads is measured."""
+    usage = parallel.RunParallelSteps([self._Sleep], threads=True)
+    self.assertEqual(len(usage), 1)
+    self.assertTrue(usage[0].wall_time >= 0.01)
+    self.assertEqual(usage[0].user_time, None)
+
+
 class TestParallelMock(cros_test_lib.TestCase):
   """Test the ParallelMock class."""
 
@@ -184,6 +439,81 @@ class TestParallelMock(cros_test_lib.TestCase):
       self.assertEqual(10, self._calls)
 
 
+class TestIterTasks(cros_test_lib.OutputTestCase, cros_test_lib.MockTestCase):
+  """Test IterTasksInProcessPool."""
+
+  def _Square(self, x):
+    sys.stdout.write(_GREETING)
+    # Make later tasks finish first, so that ordering is exercised.
+    time.sleep(0.01 * (5 - x))
+    return x * x
+
+  def _Fail(self, x):
+    if x == 2:
+      raise ValueError('failed on %d' % x)
+    return x
+
+  def testOrdered(self):
+    """Verify results are yielded in order, and output is preserved."""
+    self.StartPatcher(BackgroundTaskVerifier())
+    with self.OutputCapturer() as capture:
+      results = list(parallel.IterTasksInProcessPool(
+          self._Square, [[x] for x in range(5)], processes=5))
+      output_str = capture.GetStdout()
+    self.assertEqual(results, [0, 1, 4, 9, 16])
+    self.assertEqual(output_str, _GREETING * 5)
+
+  def testUnordered(self):
+    """Verify all results are yielded when order doesn't matter."""
+    with self.OutputCapturer():
+      results = list(parallel.IterTasksInProcessPool(
+          self._Square, [[x] for x in range(5)], processes=5, ordered=False))
+    self.assertEqual(sorted(results), [0, 1, 4, 9, 16])
+
+  def testFailure(self):
+    """Verify failures are raised as BackgroundFailure."""
+    self.StartPatcher(BackgroundTaskVerifier())
+    results = []
+    def _Consume():
+      for result in parallel.IterTasksInProcessPool(
+          self._Fail, [[x] for x in range(4)], processes=1):
+        results.append(result)
+    with self.OutputCapturer():
+      self.assertRaises(parallel.BackgroundFailure, _Consume)
+    self.assertEqual(results, [0, 1])
+
+  def _FailFirst(self, x):
+    if x == 0:
+      time.sleep(0.2)
+      raise ValueError('failed on %d' % x)
+    return 'x' * 1024 * 1024
+
+  def testEarlyFailure(self):
+    """Verify an early failure doesn't hang on large pending results."""
+    start = time.time()
+    with self.OutputCapturer():
+      self.assertRaises(parallel.BackgroundFailure, list,
+                        parallel.IterTasksInProcessPool(
+                            self._FailFirst, [[x] for x in range(50)],
+                            processes=2, ordered=True))
+    self.assertTrue(time.time() - start < 60)
+
+  def testAbandoned(self):
+    """Verify abandoning the results doesn't hang the workers."""
+    results = parallel.IterTasksInProcessPool(
+        self._FailFirst, [[x] for x in range(1, 50)], processes=2,
+        ordered=False)
+    with self.OutputCapturer():
+      self.assertEqual(len(next(results)), 1024 * 1024)
+      results.close()
+
+  def testMock(self):
+    """Make sure IterTasksInProcessPool is mocked out."""
+    with ParallelMock():
+      results = parallel.IterTasksInProcessPool(self._Fail, [[0], [1]])
+      self.assertEqual(list(results), [0, 1])
+
+
 class TestExceptions(cros_test_lib.OutputTestCase, cros_test_lib.MockTestCase):
   """Test cases where child processes raise exceptions."""
 
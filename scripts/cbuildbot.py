@@ -10,9 +10,7 @@ Used by Chromium OS buildbot configuration for all Chromium OS builds including
 full and pre-flight-queue builds.
 """
 
-import distutils.version
 import errno
-import glob
 import logging
 import optparse
 import os
@@ -47,6 +45,9 @@ cros_build_lib.STRICT_SUDO = True
 
 _DEFAULT_LOG_DIR = 'cbuildbot_logs'
 _BUILDBOT_LOG_FILE = 'cbuildbot.log'
+# With --compress_log, how big the compressed log may get before a new one is
+# started.
+_LOG_ROTATE_SIZE = 64 * 1024 * 1024
 _DEFAULT_EXT_BUILDROOT = 'trybot'
 _DEFAULT_INT_BUILDROOT = 'trybot-internal'
 _DISTRIBUTED_TYPES = [constants.COMMIT_QUEUE_TYPE, constants.PFQ_TYPE,
@@ -325,6 +326,7 @@ class Builder(object):
         print '\n\n\n@@@BUILD_STEP Report@@@\n'
         results_lib.Results.Report(sys.stdout, self.archive_urls,
                                    self.release_tag)
+        results_lib.Results.ReportUsage(sys.stdout)
         success = results_lib.Results.BuildSucceededSoFar()
         if exception_thrown and success:
           success = False
@@ -565,18 +567,7 @@ def _BackupPreviousLog(log_file, backup_limit=25):
   Args:
     log_file: The absolute path to the previous log.
   """
-  if os.path.exists(log_file):
-    old_logs = sorted(glob.glob(log_file + '.*'),
-                      key=distutils.version.LooseVersion)
-
-    if len(old_logs) >= backup_limit:
-      os.remove(old_logs[0])
-
-    last = 0
-    if old_logs:
-      last = int(old_logs.pop().rpartition('.')[2])
-
-    os.rename(log_file, log_file + '.' + str(last + 1))
+  tee.BackupLog(log_file, backup_limit=backup_limit)
 
 
 def _RunBuildStagesWrapper(options, build_config):
@@ -840,6 +831,10 @@ def _CreateParser():
                            help='This adds HW test for remote trybot')
   parser.add_option('--log_dir', dest='log_dir', type='path',
                     help=('Directory where logs are stored.'))
+  parser.add_option('--compress_log', action='store_true',
+                    dest='compress_log', default=False,
+                    help=('Gzip the log, and start a new one every %d MiB.'
+                          % (_LOG_ROTATE_SIZE / 1024 / 1024)))
   group.add_remote_option('--maxarchives', dest='max_archive_builds',
                           default=3, type='int',
                           help="Change the local saved build count limit.")
@@ -1248,6 +1243,8 @@ def main(argv):
   log_file = None
   if options.tee:
     log_file = os.path.join(options.log_dir, _BUILDBOT_LOG_FILE)
+    if options.compress_log:
+      log_file += '.gz'
     osutils.SafeMakedirs(options.log_dir)
     _BackupPreviousLog(log_file)
 
@@ -1266,7 +1263,8 @@ def main(argv):
     options.preserve_paths = set(['manifest-versions', '.cache',
                                   'manifest-versions-internal'])
     if log_file is not None:
-      stack.Add(tee.Tee, log_file)
+      stack.Add(tee.Tee, log_file, compress=options.compress_log,
+                rotate_size=_LOG_ROTATE_SIZE)
       options.preserve_paths.add(_DEFAULT_LOG_DIR)
 
     if options.cgroups:
@@ -0,0 +1,30 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Run commands sent over a unix socket, inside the chroot.
+
+This is started by chroot_server.ChrootServer; it isn't meant to be run by
+hand.
+"""
+
+from chromite.lib import chroot_server
+from chromite.lib import commandline
+from chromite.lib import cros_build_lib
+
+
+def _GetParser():
+  """Returns the parser to use for this module."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('--socket', required=True,
+                      help='Path of the unix socket to listen on')
+  return parser
+
+
+def main(argv):
+  parser = _GetParser()
+  options = parser.parse_args(argv)
+
+  cros_build_lib.AssertInsideChroot()
+  chroot_server.Serve(options.socket)
+  return 0
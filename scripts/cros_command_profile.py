@@ -0,0 +1,47 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Summarize the commands recorded with CROS_COMMAND_PROFILE.
+
+Run a build with CROS_COMMAND_PROFILE set to a directory, then point this
+script at the directory to see which commands took the most time, or which
+functions spent the most time running commands.
+"""
+
+from chromite.lib import command_profile
+from chromite.lib import commandline
+
+
+def _GetParser():
+  """Returns the parser to use for this module."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('--by', choices=('command', 'caller'), default='command',
+                      help='Group the commands by what was run, or by the '
+                           'function that ran them')
+  parser.add_argument('--depth', type=int, default=1,
+                      help='With --by=caller, how many frames of the stack '
+                           'to group by')
+  parser.add_argument('--limit', type=int, default=30,
+                      help='How many groups to show')
+  parser.add_argument('profile_dir', type='path',
+                      help='Directory that CROS_COMMAND_PROFILE was set to')
+  return parser
+
+
+def main(argv):
+  parser = _GetParser()
+  options = parser.parse_args(argv)
+
+  records = list(command_profile.LoadRecords(options.profile_dir))
+  summaries = command_profile.Summarize(records, by=options.by,
+                                        depth=options.depth)
+  total = sum(x.total for x in summaries)
+  print '%d commands, %.1fs in total' % (len(records), total)
+  print '%9s %6s %8s %8s %6s %10s  %s' % ('total', 'count', 'mean', 'longest',
+                                        'failed', 'output', options.by)
+  for summary in summaries[:options.limit]:
+    print '%8.1fs %6d %7.2fs %7.2fs %6d %10d  %s' % (
+        summary.total, summary.count, summary.mean, summary.longest,
+        summary.failures, summary.output_bytes, summary.key)
+  return 0
@@ -23,10 +23,8 @@ Some caveats:
 
 import errno
 import logging
-import multiprocessing
 import optparse
 import os
-import Queue
 
 from chromite.buildbot import constants
 from chromite.buildbot import portage_utilities
@@ -41,8 +39,6 @@ class WorkonProjectsMonitor(object):
 
   Members:
     _tasks: A list of the (project, path) pairs to check.
-    _result_queue: A queue. When GetProjectModificationTimes is called,
-      (project, mtime) tuples are pushed onto the end of this queue.
   """
 
   def __init__(self, projects):
@@ -54,17 +50,19 @@ class WorkonProjectsMonitor(object):
     manifest = git.ManifestCheckout.Cached(constants.SOURCE_ROOT)
     self._tasks = [(name, manifest.GetProjectPath(name, True))
                    for name in set(projects).intersection(manifest.projects)]
-    self._result_queue = multiprocessing.Queue(len(self._tasks))
 
-  def _EnqueueProjectModificationTime(self, project, path):
-    """Calculate the last time that this project was modified, and enqueue it.
+  def _GetProjectModificationTime(self, _project, path):
+    """Calculate the last time that this project was modified.
 
     Args:
-      project: The project to look at.
+      _project: The project to look at.
       path: The path associated with the specified project.
+
+    Returns:
+      The modification time, or None if the project isn't checked out.
     """
     if os.path.isdir(path):
-      self._result_queue.put((project, self._LastModificationTime(path)))
+      return self._LastModificationTime(path)
 
   def _LastModificationTime(self, path):
     """Calculate the last time a directory subtree was modified.
@@ -83,19 +81,14 @@ class WorkonProjectsMonitor(object):
     Returns:
       A dictionary mapping project names to last modification times.
     """
-    task = self._EnqueueProjectModificationTime
-    parallel.RunTasksInProcessPool(task, self._tasks)
+    task = self._GetProjectModificationTime
+    results = parallel.IterTasksInProcessPool(task, self._tasks)
 
     # Create a dictionary mapping project names to last modification times.
-    # All of the workon projects are already stored in the queue, so we can
-    # retrieve them all without waiting any longer.
     mtimes = {}
-    while True:
-      try:
-        project, mtime = self._result_queue.get_nowait()
-      except Queue.Empty:
-        break
-      mtimes[project] = mtime
+    for i, mtime in enumerate(results):
+      if mtime is not None:
+        mtimes[self._tasks[i][0]] = mtime
     return mtimes
 
 
@@ -14,11 +14,11 @@ Portage APIs. It is faster than standard emerge because it has a
 multiprocess model instead of an asynchronous model.
 """
 
-import codecs
 import copy
+import cPickle
 import errno
 import gc
-import heapq
+import hashlib
 import multiprocessing
 import os
 import Queue
@@ -72,12 +72,23 @@ import portage
 import portage.debug
 from portage.versions import vercmp
 
+from chromite.lib import emerge_checkpoint
+from chromite.lib import emerge_events
+from chromite.lib import emerge_history
+from chromite.lib import emerge_logs
+from chromite.lib import emerge_scheduler
+from chromite.lib import git
+
 
 def Usage():
   """Print usage."""
   print "Usage:"
   print " ./parallel_emerge [--board=BOARD] [--workon=PKGS]"
-  print "                   [--rebuild] [emerge args] package"
+  print "                   [--rebuild] [--critical-path] [--memory-budget=MB]"
+  print "                   [--cache-deps] [--event-log=FILE]"
+  print "                   [--log-archive=FILE]"
+  print "                   [--fetch-jobs=N] [--fetch-budget=MB] [--resume]"
+  print "                   [emerge args] package"
   print
   print "Packages specified as workon packages are always built from source."
   print
@@ -90,6 +101,55 @@ def Usage():
   print
   print "The --rebuild option rebuilds packages whenever their dependencies"
   print "are changed. This ensures that your build is correct."
+  print
+  print "The --critical-path option schedules packages by the estimated length"
+  print "of the longest chain of builds waiting on them, so that long poles"
+  print "like chromeos-chrome are started as early as possible."
+  print
+  print "The --memory-budget option only starts a new build when the memory"
+  print "it is expected to use, plus the memory used by the builds that are"
+  print "already running, fits within the given number of megabytes."
+  print
+  print "The --cache-deps option saves the dependency graph to disk, and reuses"
+  print "it on the next run if none of the overlays, configuration, installed"
+  print "packages or arguments have changed."
+  print
+  print "The --event-log option writes a machine readable log of when each"
+  print "package was fetched and built, and of the state of the scheduler."
+  print "An existing log is replaced. Use parallel_emerge_trace to convert it"
+  print "into a Chrome trace."
+  print
+  print "The --log-archive option keeps the compressed output of every package"
+  print "in the given file, which can be read with parallel_emerge_logs. By"
+  print "default, output is only kept until the merge finishes."
+  print
+  print "The --fetch-jobs option sets how many packages are downloaded at once"
+  print "(by default, the same as --jobs). The --fetch-budget option limits the"
+  print "total size of the binary packages being downloaded at once. Packages"
+  print "are downloaded in roughly the order the build will need them."
+  print
+  print "The --resume option picks up where the last run with the same"
+  print "arguments left off, without recalculating dependencies. Packages that"
+  print "were merged last time are skipped, and packages that failed are"
+  print "tried again."
+
+
+def ParseIntArg(arg, minimum=None):
+  """Parse the value of an --option=N argument, exiting if it is invalid.
+
+  Args:
+    arg: The argument, including the option name.
+    minimum: If set, the smallest valid value.
+  """
+  name, _, value = arg.partition("=")
+  try:
+    result = int(value)
+  except ValueError:
+    result = None
+  if result is None or (minimum is not None and result < minimum):
+    print "Invalid %s: %s" % (name, value)
+    sys.exit(1)
+  return result
 
 
 # Global start time
@@ -98,6 +158,30 @@ GLOBAL_START = time.time()
 # Whether process has been killed by a signal.
 KILLED = multiprocessing.Event()
 
+# Estimated peak memory (in bytes) used to merge a package when we have no
+# better information about it. Used when --memory-budget is specified.
+DEFAULT_SOURCE_MEMORY = 512 * 1024 * 1024
+DEFAULT_BINARY_MEMORY = 64 * 1024 * 1024
+
+# How often (in seconds) to print a status update when nothing is happening.
+STATUS_INTERVAL = 60
+
+# How often (in seconds) to recheck the load average while we are holding back
+# jobs because the load is too high. The kernel only updates the load average
+# every 5 seconds, so there's no point in checking much more often than this.
+LOAD_POLL_INTERVAL = 1
+
+# How often (in seconds) to sample the memory used by running jobs when
+# --memory-budget is specified.
+MEMORY_POLL_INTERVAL = 5
+
+# Where dependency graphs are cached when --cache-deps is specified.
+DEPS_CACHE_DIR = "/var/cache/parallel_emerge"
+
+# Emerge options that don't affect the dependency graph, and so shouldn't
+# invalidate the cache.
+DEPS_CACHE_IGNORED_OPTS = ("--jobs", "--load-average")
+
 
 class EmergeData(object):
   """This simple struct holds various emerge variables.
@@ -203,10 +287,22 @@ class DepGraphGenerator(object):
     PrintDepsMap(deps_graph)
   """
 
-  __slots__ = ["board", "emerge", "package_db", "show_output"]
+  __slots__ = ["board", "cache_deps", "critical_path", "deps_fingerprint",
+               "emerge", "event_log", "fetch_budget", "fetch_jobs",
+               "log_archive", "memory_budget", "package_db", "resume",
+               "show_output"]
 
   def __init__(self):
     self.board = None
+    self.cache_deps = False
+    self.deps_fingerprint = None
+    self.event_log = None
+    self.log_archive = None
+    self.fetch_budget = None
+    self.fetch_jobs = None
+    self.resume = False
+    self.critical_path = False
+    self.memory_budget = None
     self.emerge = EmergeData()
     self.package_db = {}
     self.show_output = False
@@ -237,6 +333,24 @@ class DepGraphGenerator(object):
         emerge_args.append("--useoldpkg-atoms=%s" % force_remote_binary)
       elif arg == "--show-output":
         self.show_output = True
+      elif arg == "--critical-path":
+        self.critical_path = True
+      elif arg == "--cache-deps":
+        self.cache_deps = True
+      elif arg.startswith("--event-log="):
+        self.event_log = arg.replace("--event-log=", "")
+      elif arg.startswith("--log-archive="):
+        self.log_archive = arg.replace("--log-archive=", "")
+      elif arg.startswith("--memory-budget="):
+        self.memory_budget = ParseIntArg(arg) * 1024 * 1024
+      elif arg.startswith("--fetch-jobs="):
+        self.fetch_jobs = ParseIntArg(arg, minimum=1)
+      elif arg.startswith("--fetch-budget="):
+        self.fetch_budget = ParseIntArg(arg) * 1024 * 1024
+      elif arg == "--resume":
+        # Note that we handle --resume ourselves, rather than using emerge's
+        # version, which relies on state in the mtimedb that we don't keep.
+        self.resume = True
       elif arg == "--rebuild":
         emerge_args.append("--rebuild-if-unbuilt")
       else:
@@ -375,10 +489,20 @@ class DepGraphGenerator(object):
     if "--usepkg" in opts:
       emerge.trees[root]["bintree"].populate("--getbinpkg" in opts)
 
-  def CreateDepgraph(self, emerge, packages):
-    """Create an emerge depgraph object."""
+  def CreateDepgraph(self, emerge, packages, nodeps=False):
+    """Create an emerge depgraph object.
+
+    Args:
+      emerge: An EmergeData() object.
+      packages: The atoms to merge.
+      nodeps: If True, only look at the specified packages and not at their
+        dependencies. Returns False instead of exiting if the packages can't
+        be merged.
+    """
     # Setup emerge options.
     emerge_opts = emerge.opts.copy()
+    if nodeps:
+      emerge_opts["--nodeps"] = True
 
     # Ask portage to build a dependency graph. with the options we specified
     # above.
@@ -390,6 +514,8 @@ class DepGraphGenerator(object):
 
     # Is it impossible to honor the user's request? Bail!
     if not success:
+      if nodeps:
+        return False
       depgraph.display_problems()
       sys.exit(1)
 
@@ -402,6 +528,20 @@ class DepGraphGenerator(object):
     if "--pretend" not in emerge.opts:
       vardb.counter_tick()
     vardb.flush_cache()
+    return True
+
+  def SetupSpinner(self):
+    """Quiet down portage before calculating dependencies."""
+    emerge = self.emerge
+
+    # Tell emerge to be quiet. We print plenty of info ourselves so we don't
+    # need any extra output from portage.
+    portage.util.noiselimit = -1
+
+    # My favorite feature: The silent spinner. It doesn't spin. Ever.
+    # I'd disable the colors by default too, but they look kind of cool.
+    emerge.spinner = stdout_spinner()
+    emerge.spinner.update = emerge.spinner.update_quiet
 
   def GenDependencyTree(self):
     """Get dependency tree info from emerge.
@@ -416,14 +556,7 @@ class DepGraphGenerator(object):
     # Create a list of packages to merge
     packages = set(emerge.cmdline_packages[:])
 
-    # Tell emerge to be quiet. We print plenty of info ourselves so we don't
-    # need any extra output from portage.
-    portage.util.noiselimit = -1
-
-    # My favorite feature: The silent spinner. It doesn't spin. Ever.
-    # I'd disable the colors by default too, but they look kind of cool.
-    emerge.spinner = stdout_spinner()
-    emerge.spinner.update = emerge.spinner.update_quiet
+    self.SetupSpinner()
 
     if "--quiet" not in emerge.opts:
       print "Calculating deps..."
@@ -640,21 +773,7 @@ class DepGraphGenerator(object):
 
       # Remove the packages we don't want, simplifying the graph and making
       # it easier for us to crack cycles.
-      for pkg in sorted(rm_pkgs):
-        this_pkg = deps_map[pkg]
-        needs = this_pkg["needs"]
-        provides = this_pkg["provides"]
-        for dep in needs:
-          dep_provides = deps_map[dep]["provides"]
-          dep_provides.update(provides)
-          dep_provides.discard(pkg)
-          dep_provides.discard(dep)
-        for target in provides:
-          target_needs = deps_map[target]["needs"]
-          target_needs.update(needs)
-          target_needs.pop(pkg, None)
-          target_needs.pop(target, None)
-        del deps_map[pkg]
+      RemovePackages(deps_map, rm_pkgs)
 
     def PrintCycleBreak(basedep, dep, mycycle):
       """Print details about a cycle that we are planning on breaking.
@@ -739,6 +858,220 @@ class DepGraphGenerator(object):
       FindRecursiveProvides(pkg, seen)
     return deps_map
 
+  def _DepsCachePath(self):
+    """Returns the path where the dependency graph is cached."""
+    name = "depgraph-%s.pickle" % (self.board or "host")
+    return os.path.join(DEPS_CACHE_DIR, name)
+
+  def GetDepsFingerprint(self):
+    """Calculate a fingerprint of everything that affects the deps graph.
+
+    This covers the requested atoms and emerge options, the overlays (their
+    git HEADs and any local modifications), the portage configuration, the
+    installed packages and the available binary packages. The fingerprint is
+    only calculated once, and saved in self.deps_fingerprint.
+    """
+    if self.deps_fingerprint is not None:
+      return self.deps_fingerprint
+
+    emerge = self.emerge
+    settings = emerge.settings
+    root = settings["ROOT"]
+    fingerprint = hashlib.sha1()
+
+    def Add(*items):
+      for item in items:
+        fingerprint.update(repr(item))
+        fingerprint.update("\0")
+
+    def AddTree(path):
+      """Add the modification times of everything under path."""
+      for dirpath, dirnames, filenames in os.walk(path, followlinks=True):
+        dirnames.sort()
+        for name in sorted(filenames) + [""]:
+          try:
+            Add(name, os.stat(os.path.join(dirpath, name)).st_mtime)
+          except OSError:
+            Add(name, None)
+
+    opts = [(k, v) for k, v in emerge.opts.iteritems()
+            if k not in DEPS_CACHE_IGNORED_OPTS]
+    Add(portage.VERSION, self.board, emerge.action, sorted(opts),
+        sorted(emerge.cmdline_packages))
+    for var in ("ACCEPT_KEYWORDS", "ARCH", "CHOST", "FEATURES", "USE"):
+      Add(var, settings.get(var))
+
+    overlays = [settings["PORTDIR"]] + settings.get("PORTDIR_OVERLAY",
+                                                    "").split()
+    for overlay in overlays:
+      head = git.RunGit(overlay, ["rev-parse", "HEAD"], error_code_ok=True)
+      status = git.RunGit(overlay, ["status", "--porcelain", "--", "."],
+                          error_code_ok=True)
+      if head.returncode == 0 and status.returncode == 0:
+        Add(overlay, head.output, status.output)
+      else:
+        Add(overlay)
+        AddTree(overlay)
+
+    config_root = settings["PORTAGE_CONFIGROOT"]
+    for path in ("etc/make.conf", "etc/make.profile", "etc/portage"):
+      path = os.path.join(config_root, path)
+      Add(path, os.path.realpath(path))
+      if os.path.isdir(path):
+        AddTree(path)
+      elif os.path.exists(path):
+        Add(hashlib.sha1(open(path).read()).hexdigest())
+
+    # Every merge or unmerge modifies a category directory in the vdb.
+    vdb = os.path.join(root, portage.VDB_PATH)
+    if os.path.isdir(vdb):
+      for category in sorted(os.listdir(vdb)):
+        Add(category, os.stat(os.path.join(vdb, category)).st_mtime)
+
+    if "--usepkg" in emerge.opts:
+      Add(sorted(emerge.trees[root]["bintree"].dbapi.cpv_all()))
+
+    self.deps_fingerprint = fingerprint.hexdigest()
+    return self.deps_fingerprint
+
+  def SaveDependencyGraph(self, deps_map):
+    """Save the dependency graph so that it can be reused next time."""
+    cache = {
+        "fingerprint": self.GetDepsFingerprint(),
+        "deps_map": deps_map,
+        "favorites": [str(x) for x in self.emerge.favorites],
+    }
+    path = self._DepsCachePath()
+    try:
+      if not os.path.isdir(DEPS_CACHE_DIR):
+        os.makedirs(DEPS_CACHE_DIR)
+      with open(path + ".tmp", "wb") as f:
+        cPickle.dump(cache, f, protocol=cPickle.HIGHEST_PROTOCOL)
+      os.rename(path + ".tmp", path)
+    except EnvironmentError as ex:
+      print "Unable to save dependency cache: %s" % ex
+
+  def _LoadPackages(self, deps_map):
+    """Load the portage objects for the packages in a saved deps graph.
+
+    We ask portage to resolve exactly the packages in the graph without
+    looking at their dependencies, which is much faster than calculating the
+    graph from scratch, and gives us the depgraph and Package objects that we
+    need to merge the packages.
+
+    Returns:
+      True if portage agrees with the saved graph about which packages to
+      merge, and whether to use binary packages for them.
+    """
+    emerge = self.emerge
+    self.SetupSpinner()
+    if not self.CreateDepgraph(emerge, ["=%s" % x for x in deps_map],
+                               nodeps=True):
+      return False
+
+    root = emerge.settings["ROOT"]
+    package_db = {}
+    for pkg in emerge.depgraph.altlist():
+      if isinstance(pkg, Package) and pkg.root == root:
+        package_db[pkg.cpv] = pkg
+
+    valid = set(package_db) == set(deps_map) and all(
+        (pkg.type_name == "binary") == deps_map[cpv]["binary"]
+        for cpv, pkg in package_db.iteritems())
+    if valid:
+      self.package_db.update(package_db)
+    return valid
+
+  def GetCheckpoint(self):
+    """Returns the checkpoint used to resume runs for our board."""
+    name = "checkpoint-%s" % (self.board or "host")
+    return emerge_checkpoint.Checkpoint(os.path.join(DEPS_CACHE_DIR, name))
+
+  def LoadCheckpoint(self, checkpoint, args):
+    """Load the remaining dependency graph from an interrupted run.
+
+    Args:
+      checkpoint: The emerge_checkpoint.Checkpoint to resume from.
+      args: The arguments to parallel_emerge, which must match the arguments
+        used for the interrupted run.
+
+    Returns:
+      The dependency graph of the packages that still need to be merged, or
+      None if the run can't be resumed.
+    """
+    emerge = self.emerge
+    result = checkpoint.Load()
+    if result is None:
+      print "No checkpoint to resume from; starting from scratch."
+      return None
+
+    plan, completed, failed = result
+    if plan["args"] != args:
+      print ("Checkpoint was made with different arguments; starting from "
+             "scratch.")
+      return None
+
+    deps_map = plan["deps_map"]
+    RemovePackages(deps_map, completed.intersection(deps_map))
+    if deps_map and not self._LoadPackages(deps_map):
+      print "Checkpoint doesn't match portage; starting from scratch."
+      return None
+
+    emerge.favorites = plan["favorites"]
+    print "Resuming: %d merged, %d failed, %d left to merge." % (
+        len(completed), len(failed), len(deps_map))
+    return deps_map
+
+  def StartCheckpoint(self, checkpoint, args, deps_map):
+    """Save the plan for this run, so that it can be resumed if it dies.
+
+    Returns:
+      The checkpoint, or None if it couldn't be saved.
+    """
+    plan = {"args": args, "deps_map": deps_map,
+            "favorites": [str(x) for x in self.emerge.favorites]}
+    try:
+      checkpoint.Start(plan)
+    except EnvironmentError as ex:
+      print "Unable to save checkpoint: %s" % ex
+      return None
+    return checkpoint
+
+  def LoadCachedDependencyGraph(self):
+    """Load the dependency graph saved by a previous run, if still valid.
+
+    The cached graph is validated by asking portage to resolve exactly the
+    packages it contains without looking at their dependencies, which also
+    gives us the portage objects we need to merge them.
+
+    Returns:
+      The dependency graph, or None if there is no valid cached graph.
+    """
+    emerge = self.emerge
+    start = time.time()
+    try:
+      with open(self._DepsCachePath(), "rb") as f:
+        cache = cPickle.load(f)
+    except (EnvironmentError, EOFError, cPickle.UnpicklingError):
+      return None
+
+    if cache.get("fingerprint") != self.GetDepsFingerprint():
+      if "--quiet" not in emerge.opts:
+        print "Dependency cache is out of date."
+      return None
+
+    deps_map = cache["deps_map"]
+    if not self._LoadPackages(deps_map):
+      if "--quiet" not in emerge.opts:
+        print "Dependency cache doesn't match portage; recalculating."
+      return None
+
+    emerge.favorites = cache["favorites"]
+    seconds = time.time() - start
+    if "--quiet" not in emerge.opts:
+      print "Loaded cached deps in %dm%.1fs" % (seconds / 60, seconds % 60)
+    return deps_map
+
   def PrintInstallPlan(self, deps_map):
     """Print an emerge-style install plan.
 
@@ -778,6 +1111,105 @@ class DepGraphGenerator(object):
     self.emerge.depgraph.display(install_plan)
 
 
+def _EstimateFromHistory(deps_map, summarize, board):
+  """Look up a per-CP summary of the build history for each package.
+
+  Args:
+    deps_map: The dependency graph.
+    summarize: A BuildHistory method taking (board, binary) and returning a
+      dict keyed by CP.
+    board: The board we're merging packages for (None for the host).
+
+  Returns:
+    A dict keyed by CPV. Packages that have never been merged before are
+    omitted.
+  """
+  summaries = {False: summarize(board, False), True: summarize(board, True)}
+  estimates = {}
+  for pkg, info in deps_map.iteritems():
+    value = summaries[info["binary"]].get(portage.versions.cpv_getkey(pkg))
+    if value is not None:
+      estimates[pkg] = value
+  return estimates
+
+
+def EstimateDurations(deps_map, history, board):
+  """Estimate how many seconds each package in deps_map will take to merge."""
+  return _EstimateFromHistory(deps_map, history.GetDurations, board)
+
+
+def EstimateMemory(deps_map, history, board):
+  """Estimate how many bytes each package in deps_map will need to merge."""
+  return _EstimateFromHistory(deps_map, history.GetPeakMemory, board)
+
+
+def GetProcessTreeMemory(pids):
+  """Calculate the resident memory used by the descendants of processes.
+
+  Args:
+    pids: The processes to look at.
+
+  Returns:
+    A dict mapping each pid to the total resident memory (in bytes) used by
+    its descendants. The processes themselves are not included.
+  """
+  page_size = os.sysconf("SC_PAGE_SIZE")
+  children, rss = {}, {}
+  for entry in os.listdir("/proc"):
+    if not entry.isdigit():
+      continue
+    try:
+      with open("/proc/%s/stat" % entry) as f:
+        stat = f.read()
+    except IOError:
+      # The process exited while we were looking at it.
+      continue
+    # The command name may contain spaces, so skip past it before splitting.
+    # The remaining fields start at the state (field 3): the parent pid is
+    # field 4 and the resident set size in pages is field 24.
+    fields = stat[stat.rfind(")") + 2:].split()
+    pid = int(entry)
+    children.setdefault(int(fields[1]), []).append(pid)
+    rss[pid] = int(fields[21]) * page_size
+
+  usage = {}
+  for pid in pids:
+    total, pending = 0, list(children.get(pid, []))
+    while pending:
+      child = pending.pop()
+      total += rss.get(child, 0)
+      pending.extend(children.get(child, []))
+    usage[pid] = total
+  return usage
+
+
+def RemovePackages(deps_map, pkgs):
+  """Remove packages from the dependency graph, propagating dependencies.
+
+  Packages that needed a removed package inherit its dependencies, so that
+  the ordering of the remaining packages is preserved.
+
+  Args:
+    deps_map: The dependency graph.
+    pkgs: The packages to remove.
+  """
+  for pkg in sorted(pkgs):
+    this_pkg = deps_map[pkg]
+    needs = this_pkg["needs"]
+    provides = this_pkg["provides"]
+    for dep in needs:
+      dep_provides = deps_map[dep]["provides"]
+      dep_provides.update(provides)
+      dep_provides.discard(pkg)
+      dep_provides.discard(dep)
+    for target in provides:
+      target_needs = deps_map[target]["needs"]
+      target_needs.update(needs)
+      target_needs.pop(pkg, None)
+      target_needs.pop(target, None)
+    del deps_map[pkg]
+
+
 def PrintDepsMap(deps_map):
   """Print dependency graph, for each package list it's prerequisites."""
   for i in sorted(deps_map):
@@ -790,12 +1222,12 @@ def PrintDepsMap(deps_map):
 
 
 class EmergeJobState(object):
-  __slots__ = ["done", "filename", "last_notify_timestamp", "last_output_seek",
+  __slots__ = ["done", "log_name", "last_notify_timestamp", "last_output_seek",
                "last_output_timestamp", "pkgname", "retcode", "start_timestamp",
-               "target", "fetch_only"]
+               "target", "fetch_only", "pid"]
 
-  def __init__(self, target, pkgname, done, filename, start_timestamp,
-               retcode=None, fetch_only=False):
+  def __init__(self, target, pkgname, done, log_name, start_timestamp,
+               retcode=None, fetch_only=False, pid=None):
 
     # The full name of the target we're building (e.g.
     # chromeos-base/chromeos-0.0.1-r60)
@@ -807,8 +1239,8 @@ class EmergeJobState(object):
     # Whether the job is done. (True if the job is done; false otherwise.)
     self.done = done
 
-    # The filename where output is currently stored.
-    self.filename = filename
+    # The name of the log in the log archive where output is stored.
+    self.log_name = log_name
 
     # The timestamp of the last time we printed the name of the log file. We
     # print this at the beginning of the job, so this starts at
@@ -833,6 +1265,10 @@ class EmergeJobState(object):
     # The timestamp when our job started.
     self.start_timestamp = start_timestamp
 
+    # The pid of the worker running our job. The merge itself runs in
+    # children of this process.
+    self.pid = pid
+
 
 def KillHandler(_signum, _frame):
   # Kill self and all subprocesses.
@@ -854,25 +1290,28 @@ def SetupWorkerSignals():
   signal.signal(signal.SIGINT, ExitHandler)
   signal.signal(signal.SIGTERM, ExitHandler)
 
-def EmergeProcess(output, *args, **kwargs):
+def EmergeProcess(log, *args, **kwargs):
   """Merge a package in a subprocess.
 
   Args:
-    output: Temporary file to write output.
+    log: Function to call with each chunk of output from the subprocess.
     *args: Arguments to pass to Scheduler constructor.
     **kwargs: Keyword arguments to pass to Scheduler constructor.
 
   Returns:
     The exit code returned by the subprocess.
   """
+  read_fd, write_fd = os.pipe()
   pid = os.fork()
   if pid == 0:
+    os.close(read_fd)
+    output = os.fdopen(write_fd, "w")
     try:
       # Sanity checks.
       if sys.stdout.fileno() != 1: raise Exception("sys.stdout.fileno() != 1")
       if sys.stderr.fileno() != 2: raise Exception("sys.stderr.fileno() != 2")
 
-      # - Redirect 1 (stdout) and 2 (stderr) at our temporary file.
+      # - Redirect 1 (stdout) and 2 (stderr) at our output pipe.
       # - Redirect 0 to point at sys.stdin. In this case, sys.stdin
       #   points at a file reading os.devnull, because multiprocessing mucks
       #   with sys.stdin.
@@ -913,23 +1352,26 @@ def EmergeProcess(output, *args, **kwargs):
     output.flush()
     os._exit(retval)
   else:
-    # Return the exit code of the subprocess.
-    return os.waitpid(pid, 0)[1]
+    # Forward output until the subprocess exits, then return its exit code.
+    os.close(write_fd)
+    return emerge_logs.ForwardOutput(pid, read_fd, log)
 
-def EmergeWorker(task_queue, job_queue, emerge, package_db, fetch_only=False):
+def EmergeWorker(task_queue, job_queue, print_queue, emerge, package_db,
+                 fetch_only=False):
   """This worker emerges any packages given to it on the task_queue.
 
   Args:
     task_queue: The queue of tasks for this worker to do.
     job_queue: The queue of results from the worker.
+    print_queue: The queue of the print worker, which collects our output.
     emerge: An EmergeData() object.
     package_db: A dict, mapping package ids to portage Package objects.
     fetch_only: A bool, indicating if we should just fetch the target.
 
-  It expects package identifiers to be passed to it via task_queue. When
-  a task is started, it pushes the (target, filename) to the started_queue.
-  The output is stored in filename. When a merge starts or finishes, we push
-  EmergeJobState objects to the job_queue.
+  It expects package identifiers to be passed to it via task_queue. When a
+  merge starts or finishes, we push EmergeJobState objects to the job_queue.
+  The output of the merge is sent to the print worker as it is produced, and
+  stored in the log archive under the job's log_name.
   """
 
   SetupWorkerSignals()
@@ -978,30 +1420,32 @@ def EmergeWorker(task_queue, job_queue, emerge, package_db, fetch_only=False):
     db_pkg.root_config = emerge.root_config
     install_list = [db_pkg]
     pkgname = db_pkg.pf
-    output = tempfile.NamedTemporaryFile(prefix=pkgname + "-", delete=False)
-    os.chmod(output.name, 644)
     start_timestamp = time.time()
-    job = EmergeJobState(target, pkgname, False, output.name, start_timestamp,
-                         fetch_only=fetch_only)
+    # Retried jobs get a new log, so make sure each job's log name is unique.
+    log_name = "%s/%s.%d.log" % ("fetch" if fetch_only else "build", target,
+                                 start_timestamp * 1000)
+    log = lambda data: print_queue.put(JobOutput(log_name, data))
+    job = EmergeJobState(target, pkgname, False, log_name, start_timestamp,
+                         fetch_only=fetch_only, pid=os.getpid())
     job_queue.put(job)
     if "--pretend" in opts:
       retcode = 0
     else:
       try:
         emerge.scheduler_graph.mergelist = install_list
-        retcode = EmergeProcess(output, settings, trees, mtimedb, opts,
+        retcode = EmergeProcess(log, settings, trees, mtimedb, opts,
             spinner, favorites=emerge.favorites,
             graph_config=emerge.scheduler_graph)
       except Exception:
-        traceback.print_exc(file=output)
+        log(traceback.format_exc())
         retcode = 1
-      output.close()
+    print_queue.put(JobOutput(log_name, None))
 
     if KILLED.is_set():
       return
 
-    job = EmergeJobState(target, pkgname, True, output.name, start_timestamp,
-                         retcode, fetch_only=fetch_only)
+    job = EmergeJobState(target, pkgname, True, log_name, start_timestamp,
+                         retcode, fetch_only=fetch_only, pid=os.getpid())
     job_queue.put(job)
 
 
@@ -1011,22 +1455,36 @@ class LinePrinter(object):
   def __init__(self, line):
     self.line = line
 
-  def Print(self, _seek_locations):
+  def Print(self, _logs, _seek_locations):
     print self.line
 
 
+class JobOutput(object):
+  """Helper object to pass output of a job to the print worker."""
+
+  def __init__(self, log_name, data):
+    """Save output of a job.
+
+    If data is None, the job has finished and its log is complete."""
+    self.log_name = log_name
+    self.data = data
+
+  def Print(self, logs, _seek_locations):
+    if self.data is None:
+      logs.Finish(self.log_name)
+    else:
+      logs.Write(self.log_name, self.data)
+
+
 class JobPrinter(object):
   """Helper object to print output of a job."""
 
-  def __init__(self, job, unlink=False):
-    """Print output of job.
-
-    If unlink is True, unlink the job output file when done."""
+  def __init__(self, job):
+    """Print output of job."""
     self.current_time = time.time()
     self.job = job
-    self.unlink = unlink
 
-  def Print(self, seek_locations):
+  def Print(self, logs, seek_locations):
 
     job = self.job
 
@@ -1038,30 +1496,26 @@ class JobPrinter(object):
 
     # Note that we're starting the job
     info = "job %s (%dm%.1fs)" % (job.pkgname, seconds / 60, seconds % 60)
-    last_output_seek = seek_locations.get(job.filename, 0)
+    last_output_seek = seek_locations.get(job.log_name, 0)
     if last_output_seek:
       print "=== Continue output for %s ===" % info
     else:
       print "=== Start output for %s ===" % info
 
-    # Print actual output from job
-    f = codecs.open(job.filename, encoding='utf-8', errors='replace')
-    f.seek(last_output_seek)
+    # Print actual output from job. We only skip past complete lines, so that
+    # a partial line is printed again in full next time.
+    output = logs.Read(job.log_name)[last_output_seek:]
+    lines = output.split("\n")
+    if not lines[-1]:
+      lines.pop()
     prefix = job.pkgname + ":"
-    for line in f:
+    for line in lines:
+      print prefix, line.decode("utf-8", "replace").encode("utf-8", "replace")
+    last_output_seek += output.rfind("\n") + 1
 
-      # Save off our position in the file
-      if line and line[-1] == "\n":
-        last_output_seek = f.tell()
-        line = line[:-1]
-
-      # Print our line
-      print prefix, line.encode('utf-8', 'replace')
-    f.close()
-
-    # Save our last spot in the file so that we don't print out the same
+    # Save our last spot in the log so that we don't print out the same
     # location twice.
-    seek_locations[job.filename] = last_output_seek
+    seek_locations[job.log_name] = last_output_seek
 
     # Note end of output section
     if job.done:
@@ -1069,12 +1523,31 @@ class JobPrinter(object):
     else:
       print "=== Still running: %s ===" % info
 
-    if self.unlink:
-      os.unlink(job.filename)
 
+class JobNotifier(object):
+  """Helper object to print a reminder that a job is still running."""
+
+  def __init__(self, job):
+    self.current_time = time.time()
+    self.job = job
 
-def PrintWorker(queue):
-  """A worker that prints stuff to the screen as requested."""
+  def Print(self, logs, _seek_locations):
+    job = self.job
+    seconds = self.current_time - job.start_timestamp
+    info = "Still building %s (%dm%.1fs)." % (job.pkgname, seconds / 60,
+                                              seconds % 60)
+    tail = logs.Tail(job.log_name)
+    if tail:
+      info += " Last output: %s" % tail[-1].strip()
+    print info
+
+
+def PrintWorker(queue, log_path):
+  """A worker that prints stuff to the screen as requested.
+
+  This worker also collects the output of all jobs into a log archive at
+  log_path, so that it can print their output when asked to.
+  """
 
   def ExitHandler(_signum, _frame):
     # Set KILLED flag.
@@ -1089,102 +1562,76 @@ def PrintWorker(queue):
   signal.signal(signal.SIGINT, ExitHandler)
   signal.signal(signal.SIGTERM, ExitHandler)
 
-  # seek_locations is a map indicating the position we are at in each file.
+  # seek_locations is a map indicating the position we are at in each log.
   # It starts off empty, but is set by the various Print jobs as we go along
-  # to indicate where we left off in each file.
+  # to indicate where we left off in each log.
   seek_locations = {}
-  while True:
-    try:
-      job = queue.get()
-      if job:
-        job.Print(seek_locations)
-        sys.stdout.flush()
-      else:
-        break
-    except IOError as ex:
-      if ex.errno == errno.EINTR:
-        # Looks like we received a signal. Keep printing.
-        continue
-      raise
-
-
-class TargetState(object):
-
-  __slots__ = ("target", "info", "score", "prefetched", "fetched_successfully")
-
-  def __init__(self, target, info):
-    self.target, self.info = target, info
-    self.fetched_successfully = False
-    self.prefetched = False
-    self.score = None
-    self.update_score()
-
-  def __cmp__(self, other):
-    return cmp(self.score, other.score)
+  logs = emerge_logs.LogArchive(log_path)
 
-  def update_score(self):
-    self.score = (
-        -len(self.info["tprovides"]),
-        len(self.info["needs"]),
-        not self.info["binary"],
-        -len(self.info["provides"]),
-        self.info["idx"],
-        self.target,
-        )
-
-
-class ScoredHeap(object):
-
-  __slots__ = ("heap", "_heap_set")
-
-  def __init__(self, initial=()):
-    self.heap = list()
-    self._heap_set = set()
-    if initial:
-      self.multi_put(initial)
-
-  def get(self):
-    item = heapq.heappop(self.heap)
-    self._heap_set.remove(item.target)
-    return item
-
-  def put(self, item):
-    if not isinstance(item, TargetState):
-      raise ValueError("Item %r isn't a TargetState" % (item,))
-    heapq.heappush(self.heap, item)
-    self._heap_set.add(item.target)
-
-  def multi_put(self, sequence):
-    sequence = list(sequence)
-    self.heap.extend(sequence)
-    self._heap_set.update(x.target for x in sequence)
-    self.sort()
-
-  def sort(self):
-    heapq.heapify(self.heap)
-
-  def __contains__(self, target):
-    return target in self._heap_set
-
-  def __nonzero__(self):
-    return bool(self.heap)
-
-  def __len__(self):
-    return len(self.heap)
+  # Output of finished jobs that we can't print until the worker that ran
+  # the job has sent us the rest of its output.
+  waiting = {}
+  try:
+    while True:
+      try:
+        job = queue.get()
+        if not job:
+          break
+        if (isinstance(job, JobPrinter) and job.job.done and
+            not logs.IsFinished(job.job.log_name)):
+          waiting.setdefault(job.job.log_name, []).append(job)
+          continue
+        job.Print(logs, seek_locations)
+        if isinstance(job, JobOutput) and job.data is None:
+          for printer in waiting.pop(job.log_name, []):
+            printer.Print(logs, seek_locations)
+        sys.stdout.flush()
+      except IOError as ex:
+        if ex.errno == errno.EINTR:
+          # Looks like we received a signal. Keep printing.
+          continue
+        raise
+
+    # Print whatever we have for jobs whose output never finished arriving.
+    for printers in waiting.itervalues():
+      for printer in printers:
+        printer.Print(logs, seek_locations)
+    sys.stdout.flush()
+  finally:
+    logs.Close()
 
 
 class EmergeQueue(object):
   """Class to schedule emerge jobs according to a dependency graph."""
 
-  def __init__(self, deps_map, emerge, package_db, show_output):
+  def __init__(self, deps_map, emerge, package_db, show_output, board=None,
+               history=None, durations=None, memory=None, memory_budget=None,
+               event_log=None, fetch_jobs=None, fetch_budget=None,
+               checkpoint=None, log_archive=None):
     # Store the dependency graph.
     self._deps_map = deps_map
+    # Where to record which packages have been merged, so that this run can
+    # be resumed if it dies.
+    self._checkpoint = checkpoint
+    # Where to log machine readable events, if anywhere.
+    self._event_log = event_log
+    # Where to record how long merges took, and our estimates for how long
+    # the remaining merges will take.
+    self._board = board
+    self._history = history
+    self._durations = durations or {}
+    # Our estimates for how much memory merges need, the most memory we
+    # want running merges to use in total, and the most memory we've seen
+    # each running merge use.
+    self._memory = memory or {}
+    self._memory_budget = memory_budget
+    self._peak_memory = {}
     self._state_map = {}
     # Initialize the running queue to empty
     self._build_jobs = {}
-    self._build_ready = ScoredHeap()
+    self._build_ready = emerge_scheduler.ScoredHeap()
     self._fetch_jobs = {}
-    self._fetch_ready = ScoredHeap()
+    self._fetch_ready = emerge_scheduler.ScoredHeap(key="fetch_score")
     # List of total package installs represented in deps_map.
     install_jobs = [x for x in deps_map if deps_map[x]["action"] == "merge"]
     self._total_jobs = len(install_jobs)
@@ -1208,35 +1655,67 @@ class EmergeQueue(object):
     procs = min(self._total_jobs,
                 emerge.opts.pop("--jobs", multiprocessing.cpu_count()))
     self._build_procs = self._fetch_procs = max(1, procs)
+    if fetch_jobs:
+      self._fetch_procs = max(1, min(self._total_jobs, fetch_jobs))
     self._load_avg = emerge.opts.pop("--load-average", None)
+
+    # If we're limiting how many bytes we download at once, look up how big
+    # each binary package is.
+    self._fetch_budget = fetch_budget
+    self._fetch_sizes = {}
+    if fetch_budget:
+      bindb = emerge.trees[emerge.settings["ROOT"]]["bintree"].dbapi
+      for target, info in deps_map.iteritems():
+        if info["binary"]:
+          try:
+            self._fetch_sizes[target] = int(bindb.aux_get(target, ["SIZE"])[0])
+          except (KeyError, ValueError):
+            pass
+    # Where the output of our jobs is collected. Unless the user asked to
+    # keep it, the archive is deleted when we're done.
+    self._log_archive = log_archive
+    self._remove_log_archive = log_archive is None
+    if log_archive is None:
+      fd, self._log_archive = tempfile.mkstemp(prefix="parallel_emerge-",
+                                               suffix=".logs")
+      os.close(fd)
+
     self._job_queue = multiprocessing.Queue()
     self._print_queue = multiprocessing.Queue()
 
     self._fetch_queue = multiprocessing.Queue()
-    args = (self._fetch_queue, self._job_queue, emerge, package_db, True)
+    args = (self._fetch_queue, self._job_queue, self._print_queue, emerge,
+            package_db, True)
     self._fetch_pool = multiprocessing.Pool(self._fetch_procs, EmergeWorker,
                                             args)
 
     self._build_queue = multiprocessing.Queue()
-    args = (self._build_queue, self._job_queue, emerge, package_db)
+    args = (self._build_queue, self._job_queue, self._print_queue, emerge,
+            package_db)
     self._build_pool = multiprocessing.Pool(self._build_procs, EmergeWorker,
                                             args)
 
-    self._print_worker = multiprocessing.Process(target=PrintWorker,
-                                                 args=[self._print_queue])
+    self._print_worker = multiprocessing.Process(
+        target=PrintWorker, args=[self._print_queue, self._log_archive])
     self._print_worker.start()
 
     # Initialize the failed queue to empty.
     self._retry_queue = []
     self._failed = set()
 
+    # Whether jobs are being held back because of the load average, and when
+    # we should next print a status update if nothing else happens.
+    self._throttled = False
+    self._next_status = 0
+
     # Setup an exit handler so that we print nice messages if we are
     # terminated.
     self._SetupExitHandler()
 
     # Schedule our jobs.
     self._state_map.update(
-        (pkg, TargetState(pkg, data)) for pkg, data in deps_map.iteritems())
+        (pkg, emerge_scheduler.TargetState(pkg, data))
+        for pkg, data in deps_map.iteritems())
     self._fetch_ready.multi_put(self._state_map.itervalues())
 
   def _SetupExitHandler(self):
@@ -1252,7 +1731,7 @@ class EmergeQueue(object):
       # Print our current job status
       for job in self._build_jobs.itervalues():
         if job:
-          self._print_queue.put(JobPrinter(job, unlink=True))
+          self._print_queue.put(JobPrinter(job))
 
       # Notify the user that we are exiting
       self._Print("Exiting on signal %s" % signum)
@@ -1284,6 +1763,32 @@ class EmergeQueue(object):
         self._build_queue.put(pkg_state)
         return True
 
+  def _EstimateMemory(self, target):
+    """Estimate the peak memory (in bytes) needed to merge target."""
+    memory = self._memory.get(target)
+    if memory is None:
+      if self._deps_map[target]["binary"]:
+        memory = DEFAULT_BINARY_MEMORY
+      else:
+        memory = DEFAULT_SOURCE_MEMORY
+    return memory
+
+  def _MemoryInUse(self):
+    """Calculate how much memory running jobs need, and note their peaks.
+
+    Jobs are assumed to need the larger of the memory they're currently using
+    and the memory we expect them to need at their peak.
+    """
+    pids = [job.pid for job in self._build_jobs.itervalues() if job]
+    usage = GetProcessTreeMemory(pids)
+    total = 0
+    for target, job in self._build_jobs.iteritems():
+      current = usage.get(job.pid, 0) if job else 0
+      peak = max(current, self._peak_memory.get(target, 0))
+      self._peak_memory[target] = peak
+      total += max(current, self._EstimateMemory(target))
+    return total
+
   def _ScheduleLoop(self):
     # If the current load exceeds our desired load average, don't schedule
     # more than one job.
@@ -1292,11 +1797,113 @@ class EmergeQueue(object):
     else:
       needed_jobs = self._build_procs
 
-    # Schedule more jobs.
+    # If we're limiting memory usage, figure out how much is left.
+    available = None
+    if self._memory_budget:
+      available = self._memory_budget - self._MemoryInUse()
+
+    # Schedule more jobs. We always allow at least one job to run, even if it
+    # won't fit in our memory budget.
+    out_of_memory = False
     while self._build_ready and len(self._build_jobs) < needed_jobs:
       state = self._build_ready.get()
-      if state.target not in self._failed:
-        self._Schedule(state)
+      if state.target in self._failed:
+        continue
+      if available is not None:
+        memory = self._EstimateMemory(state.target)
+        if memory > available and self._build_jobs:
+          self._build_ready.put(state)
+          out_of_memory = True
+          break
+        available -= memory
+      self._Schedule(state)
+
+    # Note whether we'd have scheduled more jobs if the load were lower or
+    # more memory were free, so that we know to keep an eye on them.
+    self._throttled = bool(
+        self._build_ready and
+        (out_of_memory or needed_jobs < self._build_procs) and
+        len(self._build_jobs) < self._build_procs)
+    self._LogState()
+
+  def _Checkpoint(self, target, success):
+    """Record whether target merged successfully in our checkpoint."""
+    if self._checkpoint is None:
+      return
+    try:
+      if success:
+        self._checkpoint.MarkCompleted(target)
+      else:
+        self._checkpoint.MarkFailed(target)
+    except EnvironmentError as ex:
+      self._Print("Unable to update checkpoint: %s" % ex)
+      self._checkpoint = None
+
+  def _LogState(self):
+    """Log a snapshot of our queues to the event log."""
+    if self._event_log is None:
+      return
+    self._event_log.Log(
+        "state", time.time(), fetch_jobs=len(self._fetch_jobs),
+        fetch_ready=len(self._fetch_ready), build_jobs=len(self._build_jobs),
+        build_ready=len(self._build_ready), retries=len(self._retry_queue),
+        pending=len(self._deps_map), build_slots=self._build_procs,
+        load=os.getloadavg()[0], throttled=self._throttled)
+
+  def _LogJob(self, job):
+    """Log that a job started or finished to the event log."""
+    if self._event_log is None:
+      return
+    kind = "fetch" if job.fetch_only else "build"
+    if job.done:
+      self._event_log.Log(kind + "_end", time.time(), target=job.target,
+                          pid=job.pid, retcode=job.retcode)
+    else:
+      self._event_log.Log(kind + "_start", job.start_timestamp,
+                          target=job.target, pid=job.pid)
+
+  def _WaitForJob(self):
+    """Wait for the next job update from the workers.
+
+    Workers push updates onto the job queue as soon as they start or finish a
+    job, so we wake up immediately when there is something to do. We only
+    wake up otherwise to print status updates, and to recheck the load average
+    if we're holding back jobs because the load is too high.
+
+    Returns:
+      An EmergeJobState object, or None if we timed out.
+    """
+    timeout = max(0, self._next_status - time.time())
+    if self._throttled:
+      timeout = min(timeout, LOAD_POLL_INTERVAL)
+    elif self._memory_budget and self._build_jobs:
+      # Keep track of how much memory running jobs use at their peak.
+      timeout = min(timeout, MEMORY_POLL_INTERVAL)
+    try:
+      return self._job_queue.get(timeout=timeout)
+    except Queue.Empty:
+      self._ScheduleLoop()
+      if time.time() >= self._next_status:
+        self._Status()
+      return None
+
+  def _ScheduleFetches(self):
+    """Start fetching packages, in the order the build will need them.
+
+    We never run more than self._fetch_procs fetches at once, and, if we have
+    a fetch budget, never start a fetch that would take the total size of the
+    packages being downloaded over budget (unless nothing else is running).
+    """
+    while self._fetch_ready and len(self._fetch_jobs) < self._fetch_procs:
+      state = self._fetch_ready.peek()
+      if self._fetch_budget and self._fetch_jobs:
+        in_flight = sum(self._fetch_sizes.get(x, 0) for x in self._fetch_jobs)
+        size = self._fetch_sizes.get(state.target, 0)
+        if in_flight + size > self._fetch_budget:
+          break
+      self._fetch_ready.get()
+      self._fetch_jobs[state.target] = None
+      self._fetch_queue.put(state)
 
   def _Print(self, line):
     """Print a single line."""
@@ -1306,6 +1913,7 @@ class EmergeQueue(object):
     """Print status."""
     current_time = time.time()
     no_output = True
+    self._next_status = current_time + STATUS_INTERVAL
 
     # Print interim output every minute if --show-output is used. Otherwise,
     # print notifications about running packages every 2 minutes, and print
@@ -1325,11 +1933,8 @@ class EmergeQueue(object):
           no_output = False
         elif (notify_interval and
               job.last_notify_timestamp + notify_interval < current_time):
-          job_seconds = current_time - job.start_timestamp
-          args = (job.pkgname, job_seconds / 60, job_seconds % 60, job.filename)
-          info = "Still building %s (%dm%.1fs). Logs in %s" % args
           job.last_notify_timestamp = current_time
-          self._Print(info)
+          self._print_queue.put(JobNotifier(job))
           no_output = False
 
     # If we haven't printed any messages yet, print a general status message
@@ -1348,8 +1953,45 @@ class EmergeQueue(object):
         if retries:
           line += "Retrying %s, " % (retries,)
       load =  " ".join(str(x) for x in os.getloadavg())
-      line += ("[Time %dm%.1fs Load %s]" % (seconds/60, seconds %60, load))
-      self._Print(line)
+      line += ("[Time %dm%.1fs Load %s" % (seconds/60, seconds %60, load))
+      eta = self._EstimateRemaining(current_time)
+      if eta is not None:
+        line += " ETA %dm%.1fs" % (eta / 60, eta % 60)
+      self._Print(line + "]")
+
+  def _EstimateRemaining(self, current_time):
+    """Estimate how many seconds it will take to merge remaining packages.
+
+    Returns None if we don't have any history to base the estimate on.
+    """
+    if not self._durations:
+      return None
+    work = longest = 0
+    for target, info in self._deps_map.iteritems():
+      if info["action"] != "merge":
+        continue
+      seconds = self._durations.get(target, 0)
+      job = self._build_jobs.get(target)
+      if job:
+        seconds = max(0, seconds - (current_time - job.start_timestamp))
+      work += seconds
+      longest = max(longest, seconds, info.get("cpath", 0))
+    return max(longest, work / self._build_procs)
+
+  def _RecordHistory(self, job):
+    """Record how long a finished build job took in our history."""
+    if self._history is None:
+      return
+    target = job.target
+    try:
+      self._history.Record(target, portage.versions.cpv_getkey(target),
+                           self._board, self._deps_map[target]["binary"],
+                           job.start_timestamp,
+                           time.time() - job.start_timestamp, job.retcode,
+                           rss=self._peak_memory.pop(target, None) or None)
+    except EnvironmentError as ex:
+      self._Print("Unable to record build history: %s" % ex)
+      self._history = None
 
   def _Finish(self, target):
     """Mark a target as completed and unblock dependencies."""
@@ -1409,6 +2051,10 @@ class EmergeQueue(object):
       self._job_queue.close()
       self._job_queue = None
 
+    if self._event_log is not None:
+      self._event_log.Close()
+      self._event_log = None
+
     # Now that our workers are finished, we can kill the print queue.
     if self._print_worker is not None:
       try:
@@ -1419,6 +2065,14 @@ class EmergeQueue(object):
         self._print_worker.terminate()
     self._print_queue = self._print_worker = None
 
+    if self._remove_log_archive and self._log_archive is not None:
+      try:
+        os.unlink(self._log_archive)
+      except OSError as ex:
+        if ex.errno != errno.ENOENT:
+          raise
+      self._log_archive = None
+
   def Run(self):
     """Run through the scheduled ebuilds.
 
@@ -1429,10 +2083,7 @@ class EmergeQueue(object):
       return
 
     # Start the fetchers.
-    for _ in xrange(min(self._fetch_procs, len(self._fetch_ready))):
-      state = self._fetch_ready.get()
-      self._fetch_jobs[state.target] = None
-      self._fetch_queue.put(state)
+    self._ScheduleFetches()
 
     # Print an update, then get going.
     self._Status()
@@ -1464,19 +2115,12 @@ class EmergeQueue(object):
             print "Deadlock! Circular dependencies!"
           sys.exit(1)
 
-      for _ in xrange(12):
-        try:
-          job = self._job_queue.get(timeout=5)
-          break
-        except Queue.Empty:
-          # Check if any more jobs can be scheduled.
-          self._ScheduleLoop()
-      else:
-        # Print an update every 60 seconds.
-        self._Status()
+      job = self._WaitForJob()
+      if job is None:
         continue
 
       target = job.target
+      self._LogJob(job)
 
       if job.fetch_only:
         if not job.done:
@@ -1490,18 +2134,14 @@ class EmergeQueue(object):
                       % (target, time.time() - job.start_timestamp))
 
           if self._show_output or job.retcode != 0:
-            self._print_queue.put(JobPrinter(job, unlink=True))
-          else:
-            os.unlink(job.filename)
+            self._print_queue.put(JobPrinter(job))
           # Failure or not, let build work with it next.
           if not self._deps_map[job.target]["needs"]:
             self._build_ready.put(state)
             self._ScheduleLoop()
 
           if self._fetch_ready:
-            state = self._fetch_ready.get()
-            self._fetch_queue.put(state)
-            self._fetch_jobs[state.target] = None
+            self._ScheduleFetches()
           else:
             # Minor optimization; shut down fetchers early since we know
             # the queue is empty.
@@ -1510,21 +2150,24 @@ class EmergeQueue(object):
 
       if not job.done:
         self._build_jobs[target] = job
-        self._Print("Started %s (logged in %s)" % (target, job.filename))
+        if self._remove_log_archive:
+          self._Print("Started %s" % target)
+        else:
+          self._Print("Started %s (logged in %s)" % (target, self._log_archive))
         continue
 
       # Print output of job
       if self._show_output or job.retcode != 0:
-        self._print_queue.put(JobPrinter(job, unlink=True))
-      else:
-        os.unlink(job.filename)
+        self._print_queue.put(JobPrinter(job))
       del self._build_jobs[target]
+      self._RecordHistory(job)
 
       seconds = time.time() - job.start_timestamp
       details = "%s (in %dm%.1fs)" % (target, seconds / 60, seconds % 60)
       previously_failed = target in self._failed
 
       # Complain if necessary.
+      self._Checkpoint(target, job.retcode == 0)
       if job.retcode != 0:
         # Handle job failure.
         if previously_failed:
@@ -1618,19 +2261,51 @@ def real_main(argv):
     print " Building package %s on %s" % (cmdline_packages,
                                           deps.board or "root")
 
-  deps_tree, deps_info = deps.GenDependencyTree()
+  # Arguments that must match for a run to be resumed.
+  checkpoint_args = [x for x in parallel_emerge_args if x != "--resume"]
+  checkpoint = deps.GetCheckpoint()
 
-  # You want me to be verbose? I'll give you two trees! Twice as much value.
-  if "--tree" in emerge.opts and "--verbose" in emerge.opts:
-    deps.PrintTree(deps_tree)
+  deps_graph = None
+  resumed = False
+  if deps.resume:
+    deps_graph = deps.LoadCheckpoint(checkpoint, checkpoint_args)
+    resumed = deps_graph is not None
+    if resumed and not deps_graph:
+      checkpoint.Remove()
+      print "Done"
+      return 0
 
-  deps_graph = deps.GenDependencyGraph(deps_tree, deps_info)
+  if deps_graph is None and deps.cache_deps:
+    deps_graph = deps.LoadCachedDependencyGraph()
+
+  if deps_graph is None:
+    deps_tree, deps_info = deps.GenDependencyTree()
+
+    # You want me to be verbose? I'll give you two trees! Twice as much value.
+    if "--tree" in emerge.opts and "--verbose" in emerge.opts:
+      deps.PrintTree(deps_tree)
+
+    deps_graph = deps.GenDependencyGraph(deps_tree, deps_info)
+    if deps.cache_deps:
+      deps.SaveDependencyGraph(deps_graph)
+
+  if "--pretend" in emerge.opts:
+    checkpoint = None
+  elif not resumed:
+    checkpoint = deps.StartCheckpoint(checkpoint, checkpoint_args, deps_graph)
 
   # OK, time to print out our progress so far.
   deps.PrintInstallPlan(deps_graph)
   if "--tree" in emerge.opts:
     PrintDepsMap(deps_graph)
 
+  # Now that we know the graph is acyclic, figure out the long poles.
+  history = emerge_history.BuildHistory()
+  durations = EstimateDurations(deps_graph, history, deps.board)
+  if deps.critical_path:
+    emerge_scheduler.CalculateCriticalPaths(deps_graph, durations)
+  emerge_scheduler.CalculateEarliestStarts(deps_graph, durations)
+
   # Are we upgrading portage? If so, and there are more packages to merge,
   # schedule a restart of parallel_emerge to merge the rest. This ensures that
   # we pick up all updates to portage settings before merging any more
@@ -1667,13 +2342,36 @@ def real_main(argv):
     os.execvp(args[0], args)
 
   # Run the queued emerges.
-  scheduler = EmergeQueue(deps_graph, emerge, deps.package_db, deps.show_output)
+  memory = None
+  if deps.memory_budget:
+    memory = EstimateMemory(deps_graph, history, deps.board)
+  event_log = None
+  if deps.event_log:
+    event_log = emerge_events.EventLog(deps.event_log)
+  scheduler = EmergeQueue(deps_graph, emerge, deps.package_db, deps.show_output,
+                          board=deps.board, history=history,
+                          durations=durations, memory=memory,
+                          memory_budget=deps.memory_budget,
+                          event_log=event_log, fetch_jobs=deps.fetch_jobs,
+                          fetch_budget=deps.fetch_budget,
+                          checkpoint=checkpoint,
+                          log_archive=deps.log_archive)
   try:
     scheduler.Run()
   finally:
     scheduler._Shutdown()
   scheduler = None
 
+  # Everything was merged, so there's nothing left to resume.
+  if checkpoint is not None:
+    checkpoint.Remove()
+
+  # Keep the build history from growing without bound.
+  try:
+    history.Compact()
+  except EnvironmentError as ex:
+    print "Unable to compact build history: %s" % ex
+
   clean_logs(emerge.settings)
 
   print "Done"
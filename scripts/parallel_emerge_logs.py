@@ -0,0 +1,45 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Read the logs in a parallel_emerge --log-archive file.
+
+With no other arguments, lists the logs in the archive. Logs whose names
+contain any of the given packages are printed, or, with --output-dir,
+extracted into separate files.
+"""
+
+import os
+import sys
+
+from chromite.lib import commandline
+from chromite.lib import emerge_logs
+from chromite.lib import osutils
+
+
+def _GetParser():
+  """Returns the parser to use for this module."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('--output-dir', type='path',
+                      help='Extract the logs into this directory')
+  parser.add_argument('archive', help='Log archive written by parallel_emerge')
+  parser.add_argument('packages', nargs='*', help='Packages to show logs for')
+  return parser
+
+
+def main(argv):
+  parser = _GetParser()
+  options = parser.parse_args(argv)
+
+  for name, data, finished in emerge_logs.ReadLogs(options.archive):
+    if options.packages and not any(x in name for x in options.packages):
+      continue
+    if options.output_dir:
+      path = os.path.join(options.output_dir, name.lstrip('/'))
+      osutils.WriteFile(path, data, makedirs=True)
+    elif options.packages:
+      sys.stdout.write(data)
+    else:
+      print '%s (%d bytes%s)' % (name, len(data),
+                                 '' if finished else ', incomplete')
+  return 0
@@ -0,0 +1,118 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Simulate the parallel_emerge scheduler offline, without portage.
+
+Replays the scheduling policy used by parallel_emerge against a dependency
+graph with a number of virtual build slots, and reports how long the build
+took (the makespan), how busy the slots were, and how close the makespan came
+to the best possible (the larger of the critical path and the total work
+divided by the number of slots).
+
+The graph can be one saved by parallel_emerge (--cache-deps, or the
+checkpoint of a run) along with durations from its build history. Without a
+graph, a suite of synthetic graphs is simulated, so that changes to the
+scheduling policy can be compared objectively.
+"""
+
+import cPickle
+import re
+
+from chromite.lib import commandline
+from chromite.lib import emerge_history
+from chromite.lib import emerge_scheduler
+
+# The sizes of the synthetic graphs in the benchmark suite.
+BENCHMARK_PACKAGES = (500, 1000, 2000)
+
+# The numbers of build slots to simulate by default.
+DEFAULT_JOBS = (4, 16, 64)
+
+# Matches a package version at the end of a CPV, like portage does.
+_VERSION_RE = re.compile(
+    r'-\d+(\.\d+)*[a-z]?(_(alpha|beta|pre|rc|p)\d*)*(-r\d+)?$')
+
+
+def _GetCP(cpv):
+  """Returns the package name of a CPV, without its version."""
+  return _VERSION_RE.sub('', cpv)
+
+
+def LoadGraph(path):
+  """Load a dependency graph saved by parallel_emerge.
+
+  Args:
+    path: A dependency cache written by parallel_emerge --cache-deps, a
+      checkpoint, or a pickle of the graph itself.
+  """
+  with open(path, 'rb') as f:
+    data = cPickle.load(f)
+  if 'plan' in data and 'fingerprint' in data:
+    data = cPickle.loads(data['plan'])
+  return data.get('deps_map', data)
+
+
+def GetDurations(deps_map, history, board):
+  """Look up how long each package in deps_map took in the build history."""
+  summaries = {False: history.GetDurations(board, False),
+               True: history.GetDurations(board, True)}
+  durations = {}
+  for pkg, info in deps_map.iteritems():
+    seconds = summaries[info['binary']].get(_GetCP(pkg))
+    if seconds is not None:
+      durations[pkg] = seconds
+  return durations
+
+
+def _PrintResults(name, deps_map, durations, jobs):
+  """Simulate both scheduling policies and print a line for each."""
+  for slots in jobs:
+    for policy in ('default', 'critical-path'):
+      result = emerge_scheduler.Simulate(
+          deps_map, durations, slots=slots,
+          critical_path=(policy == 'critical-path'))
+      print '%-16s %5d %-14s %10d %10d %6.1f%% %6.1f%%' % (
+          name, slots, policy, result.makespan, result.lower_bound,
+          result.utilization * 100, result.efficiency * 100)
+
+
+def _GetParser():
+  """Returns the parser to use for this module."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('--graph', type='path',
+                      help='Dependency graph saved by parallel_emerge')
+  parser.add_argument('--history', type='path',
+                      help='Build history to take durations from '
+                           '(default: %s)' % emerge_history.GetHistoryPath())
+  parser.add_argument('--board', default=None,
+                      help='Board to take durations from (default: host)')
+  parser.add_argument('--packages', type=int, action='append',
+                      help='Size of the synthetic graphs to simulate '
+                           '(default: %s)' % (BENCHMARK_PACKAGES,))
+  parser.add_argument('--seed', type=int, default=0,
+                      help='Seed for generating synthetic graphs')
+  parser.add_argument('--jobs', type=int, action='append',
+                      help='Number of build slots to simulate '
+                           '(default: %s)' % (DEFAULT_JOBS,))
+  return parser
+
+
+def main(argv):
+  parser = _GetParser()
+  options = parser.parse_args(argv)
+  jobs = options.jobs or DEFAULT_JOBS
+
+  print '%-16s %5s %-14s %10s %10s %7s %7s' % (
+      'graph', 'jobs', 'policy', 'makespan', 'bound', 'util', 'eff')
+  if options.graph:
+    deps_map = LoadGraph(options.graph)
+    history = emerge_history.BuildHistory(options.history)
+    durations = GetDurations(deps_map, history, options.board)
+    _PrintResults('%d packages' % len(deps_map), deps_map, durations, jobs)
+  else:
+    for packages in options.packages or BENCHMARK_PACKAGES:
+      deps_map, durations = emerge_scheduler.GenerateGraph(
+          packages, seed=options.seed)
+      _PrintResults('synthetic-%d' % packages, deps_map, durations, jobs)
+  return 0
@@ -0,0 +1,33 @@
+# Copyright (c) 2012 The Chromium OS Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Convert a parallel_emerge --event-log file into a Chrome trace.
+
+The resulting file can be loaded into chrome://tracing to see what each
+fetch and build worker was doing over the course of the build.
+"""
+
+import json
+
+from chromite.lib import commandline
+from chromite.lib import emerge_events
+
+
+def _GetParser():
+  """Returns the parser to use for this module."""
+  parser = commandline.ArgumentParser(description=__doc__)
+  parser.add_argument('event_log', help='Event log written by parallel_emerge')
+  parser.add_argument('output', help='Where to write the trace')
+  return parser
+
+
+def main(argv):
+  parser = _GetParser()
+  options = parser.parse_args(argv)
+
+  trace = emerge_events.ConvertToTrace(
+      emerge_events.ReadEvents(options.event_log))
+  with open(options.output, 'w') as f:
+    json.dump(trace, f)
+  return 0